@@ -0,0 +1,162 @@
+from vbo import VertexBuffer, InterleavedBuffer
+from ibo import IndexBuffer
+from model_loader import ModelLoader
+from geometry_arena import geometry_arenas
+
+class Geometry:
+    '''
+    GPU buffers of one mesh, shared by every model drawing that mesh. Each model keeps its own
+    vertex array, which references these buffers.
+    '''
+
+    def __init__(self):
+        """ Create an empty geometry, the buffers are uploaded by the first model that binds it """
+        self.vbos = {}
+        self.ibo = None
+        # name -> ArenaAllocation of the mesh in the geometry arenas
+        self.allocations = {}
+        self.gpu_bytes = 0
+
+    def vertex_buffer(self, name, data):
+        """ Return the vertex buffer of the named attribute, uploading the data on first use """
+        if name not in self.vbos:
+            self.vbos[name] = VertexBuffer(data)
+            self.gpu_bytes += data.nbytes
+        return self.vbos[name]
+
+    def interleaved_buffer(self, name, streams):
+        """ Return the named interleaved vertex buffer, built from the (name, data, BufferElement) streams on first use """
+        if name not in self.vbos:
+            self.vbos[name] = InterleavedBuffer(streams)
+            self.gpu_bytes += sum(data.nbytes for _, data, _ in streams)
+        return self.vbos[name]
+
+    def arena_allocation(self, name, elements, streams, levels, index_dtype):
+        """ Return the named allocation of the mesh in the geometry arena of its vertex format, copying the mesh on first use """
+        if name not in self.allocations:
+            arena = geometry_arenas.arena(elements, index_dtype)
+            self.allocations[name] = arena.allocate(streams, levels)
+            self.gpu_bytes += self.allocations[name].vertex_count * arena.stride + self.allocations[name].index_count * arena.index_dtype.itemsize
+        return self.allocations[name]
+
+    def free(self):
+        """ Return the arena allocations of the mesh, the other buffers are deleted with the geometry """
+        for allocation in self.allocations.values():
+            allocation.arena.free(allocation)
+        self.allocations = {}
+
+    def index_buffer(self, faces):
+        """ Return the index buffer, uploading the faces on first use """
+        if self.ibo is None:
+            self.ibo = IndexBuffer(faces)
+            self.gpu_bytes += faces.nbytes
+        return self.ibo
+
+
+class Asset:
+    '''
+    A model file loaded once and shared between models: its meshes (CPU data) and one Geometry per
+    mesh (GPU data). Transforms, shaders and instances stay with the models.
+    '''
+
+    def __init__(self, path, meshes):
+        self.path = path
+        self.meshes = meshes
+        self.geometries = [Geometry() for _ in meshes]
+        self.refcount = 0
+        # key of the asset in the registry that loaded it
+        self.key = None
+
+    def get_cpu_bytes(self):
+        """ Return the memory used by the mesh arrays """
+        total = 0
+        for mesh in self.meshes:
+            for array in [mesh.vertices, mesh.normals, mesh.textureCoords, mesh.faces, mesh.tangents, mesh.bitangents, mesh.colors]:
+                if array is not None:
+                    total += array.nbytes
+            total += sum(faces.nbytes for faces in mesh.lods)
+        return total
+
+    def get_gpu_bytes(self):
+        """ Return the memory used by the vertex and index buffers uploaded so far """
+        return sum(geometry.gpu_bytes for geometry in self.geometries)
+
+
+class AssetRegistry:
+    '''
+    Process wide registry of the loaded model files, reference counted. Assets that are no longer
+    used stay loaded (so that swapping a model back is free) until purge is called.
+    '''
+
+    def __init__(self):
+        """ Create an empty registry """
+        # (path, loading options) -> asset
+        self._assets = {}
+        # key -> sequence number of the release that left the asset unused, most recent last
+        self._unused = {}
+        self._releases = 0
+        # unused assets kept by swap_done, so that swapping back to a recent model is free
+        self.max_unused = 2
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, path, **flags):
+        """
+        Return the asset of a model file, loading it on first use.
+        :param path: the path of the model file, relative to the models directory
+        :param flags: the processing options passed to ModelLoader.load_model
+        """
+        key = (path, tuple(sorted(flags.items())))
+        asset = self._assets.get(key)
+
+        if asset is None:
+            asset = Asset(path, ModelLoader().load_model(path, **flags))
+            asset.key = key
+            self._assets[key] = asset
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        asset.refcount += 1
+        self._unused.pop(key, None)
+        return asset
+
+    def release(self, asset):
+        """ Drop one reference to an asset """
+        if asset.refcount == 0:
+            print('(W) Warning: releasing asset {} more times than it was acquired'.format(asset.path))
+            return
+        asset.refcount -= 1
+        if asset.refcount == 0 and asset.key in self._assets:
+            self._releases += 1
+            self._unused[asset.key] = self._releases
+
+    def purge(self, keep=0):
+        """
+        Drop the assets that are no longer referenced, but the keep most recently released. Their arena
+        allocations are returned to the arenas, their other buffers are deleted with them.
+        :return: the number of assets dropped
+        """
+        unused = sorted(self._unused, key=self._unused.get)
+        unused = unused[:max(len(unused) - keep, 0)]
+        for key in unused:
+            for geometry in self._assets[key].geometries:
+                geometry.free()
+            del self._assets[key]
+            del self._unused[key]
+        return len(unused)
+
+    def swap_done(self):
+        """ Called once a model was replaced, drops the unused assets beyond max_unused """
+        dropped = self.purge(keep=self.max_unused)
+        if dropped:
+            print('Dropped {} unused model assets'.format(dropped))
+        return dropped
+
+    def get_assets(self):
+        """ Return the loaded assets """
+        return list(self._assets.values())
+
+
+# model files are shared by every model of the application
+asset_registry = AssetRegistry()
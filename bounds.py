@@ -0,0 +1,78 @@
+import numpy as np
+
+# Bounding volumes: axis aligned boxes are (2, 3) arrays of their lower and upper corners, spheres are
+# (centre, radius) pairs. Functions taking transforms work on (K, 4, 4) stacks so that the bounds of
+# every instance of a model are derived in one go.
+
+
+def bounding_box(vertices):
+    '''
+    Returns the (2, 3) lower and upper corners of the box around the vertices.
+    '''
+    vertices = np.asarray(vertices, dtype=np.float32)
+    if len(vertices) == 0:
+        return np.zeros((2, 3), dtype=np.float32)
+    return np.stack([vertices.min(axis=0), vertices.max(axis=0)])
+
+
+def bounding_sphere(vertices):
+    '''
+    Returns the centre and radius of a sphere around the vertices, centred on their bounding box.
+    '''
+    vertices = np.asarray(vertices, dtype=np.float32)
+    if len(vertices) == 0:
+        return np.zeros(3, dtype=np.float32), 0.0
+    center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+    return center, float(np.linalg.norm(vertices - center, axis=1).max())
+
+
+def merge_boxes(boxes):
+    '''
+    Returns the box around a list of (2, 3) boxes.
+    '''
+    if len(boxes) == 0:
+        return np.zeros((2, 3), dtype=np.float32)
+    boxes = np.asarray(boxes, dtype=np.float32)
+    return np.stack([boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)])
+
+
+def merge_spheres(spheres):
+    '''
+    Returns a sphere around a list of (centre, radius) spheres.
+    '''
+    spheres = [(np.asarray(c, dtype=np.float32), r) for c, r in spheres]
+    if not spheres:
+        return np.zeros(3, dtype=np.float32), 0.0
+    lower = np.min([c - r for c, r in spheres], axis=0)
+    upper = np.max([c + r for c, r in spheres], axis=0)
+    center = (lower + upper) / 2
+    return center, float(max(np.linalg.norm(c - center) + r for c, r in spheres))
+
+
+def max_scale(matrices):
+    '''
+    Returns the largest axis scale of each of a stack of (K, 4, 4) transforms.
+    '''
+    return np.sqrt((matrices[:, :3, :3] ** 2).sum(axis=1).max(axis=1))
+
+
+def transform_boxes(box, matrices):
+    '''
+    Returns the (K, 2, 3) boxes around a box under each of a stack of (K, 4, 4) transforms: the centre
+    is transformed and the half extent is projected on each axis by the absolute linear part.
+    '''
+    box = np.asarray(box, dtype=np.float32)
+    center = (box[0] + box[1]) / 2
+    extent = (box[1] - box[0]) / 2
+    centers = matrices[:, :3, :3] @ center + matrices[:, :3, 3]
+    extents = np.abs(matrices[:, :3, :3]) @ extent
+    return np.stack([centers - extents, centers + extents], axis=1).astype(np.float32)
+
+
+def transform_spheres(sphere, matrices):
+    '''
+    Returns the (K, 3) centres and (K,) radii of a sphere under each of a stack of (K, 4, 4) transforms.
+    '''
+    center, radius = sphere
+    centers = matrices[:, :3, :3] @ np.asarray(center, dtype=np.float32) + matrices[:, :3, 3]
+    return centers.astype(np.float32), (radius * max_scale(matrices)).astype(np.float32)
@@ -103,7 +103,7 @@ class CarInstanced(ModelFromObjInstanced):
 
         """
         self.positions.append(positions)
-        self.shader.add_matrix(TransformMatrix())
+        self.add_matrix(TransformMatrix())
         self.current_grid_positions.append(0)
         self.current_cars += 1
 
@@ -125,10 +125,11 @@ class CarInstanced(ModelFromObjInstanced):
         d = b - a
         angle = np.arctan2(d[0], d[2])
         if angle == 0:
-            self.shader.matricies[index].reset()
+            self.matricies[index].reset()
         else:
-            self.shader.matricies[index].set_rotation([0, 1, 0], angle)
-        self.shader.matricies[index].translate(d_pos)
+            self.matricies[index].set_rotation([0, 1, 0], angle)
+        self.matricies[index].translate(d_pos)
+        self.update_matrix(index)
 
     def update(self, dt):
         """
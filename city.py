@@ -17,6 +17,9 @@ from city_map import CityMap
 from light import DirectionalLight
 from coordinate_system import CoordinateSystem
 from car import CarInstanced
+from model_loader import ModelLoader
+from occlusion import occlusion_culler
+from occlusion_query import occlusion_queries
 from imgui_windows import show_lighting_settings, show_scene_settings, show_light_settings
 
 class City(Scene):
@@ -24,6 +27,19 @@ class City(Scene):
     Represents a city scene in a computer graphics application.
     """
 
+    CAR_MODELS = [
+        'police_stealth/police_stealth.obj',
+        'taxi/taxi.obj',
+        'car_white/car_white.obj',
+        'car_red/car_red.obj',
+        'police/police.obj',
+    ]
+    ROAD_MODELS = ["road/road_horizontal_textured.obj", "road/road_textured.obj"]
+    BUILDING_PACK = "buildings_pack1"
+    # seed of the city layout, None for a new layout each run. With a fixed seed the visibility baked
+    # for the layout is loaded from the cache on the next runs
+    CITY_SEED = None
+
     def __init__(self):
         """
         Initializes the City object.
@@ -49,10 +65,16 @@ class City(Scene):
         self.directional_light = DirectionalLight()
         self.skybox = SkyBox(self, "skybox/blue_clouds", extension="jpg")
 
-        self.city_map = CityMap(5, 5)
+        self.city_map = CityMap(5, 5, seed=self.CITY_SEED)
+
+        # import every model of the scene in parallel, the models below then load from the mesh cache
+        ModelLoader().preload(
+            self.city_map.get_building_files(self.BUILDING_PACK) + self.ROAD_MODELS + self.CAR_MODELS +
+            ['tank/tank.obj', 'dyno/dyno.obj', 'traffic_light/tf.obj']
+        )
 
         self.add_floor(200, 200)
-        self.add_buildings("buildings_pack1")
+        self.add_buildings(self.BUILDING_PACK)
 
         self.add_cars(25)
         self.add_police_cars()
@@ -68,13 +90,7 @@ class City(Scene):
             n (int): The number of cars to add.
         """
         self.cars = {}
-        self.car_models = [
-            'police_stealth/police_stealth.obj',
-            'taxi/taxi.obj',
-            'car_white/car_white.obj',
-            'car_red/car_red.obj',
-            'police/police.obj',
-        ]
+        self.car_models = list(self.CAR_MODELS)
 
         for i in range(n):
             self.add_car(self.car_models[i % len(self.car_models)])
@@ -107,7 +123,8 @@ class City(Scene):
         self.floor = ModelFromMesh(self, SquareMesh(material=floor_material), shader=PhongShader('phong_normal_map'))
         self.floor.M.rotate([1, 0, 0], glm.radians(-90))
         self.floor.M.scale([w, 1, h])
-        self.floor.mesh.textureCoords *= 120
+        # the square's arrays are shared by every square mesh, so the scaled coordinates are a copy
+        self.floor.mesh.textureCoords = self.floor.mesh.textureCoords * 120
         self.floor.update()
         self.models.append(self.floor)
 
@@ -118,9 +135,13 @@ class City(Scene):
         Args:
             pack (str): The name of the building pack to use.
         """
-        towers, roads, roads_h = self.city_map.generate_city(pack, "road/road_horizontal_textured.obj", "road/road_textured.obj", self)
+        towers, roads, roads_h = self.city_map.generate_city(pack, *self.ROAD_MODELS, self)
         self.models.extend(towers)
         self.models.append(roads)
+        # the towers hide most of the city from street level
+        for tower in towers:
+            occlusion_culler.add_occluder(tower)
+            tower.enable_occlusion_queries()
         self.models.append(roads_h)
 
     def add_car(self, file):
@@ -188,6 +209,7 @@ class City(Scene):
         for light in self.police_car_lights:
             self.lights.append(light)
 
+        self.police_car.enable_occlusion_queries()
         self.models.append(self.police_car)
 
     def add_env_map(self):
@@ -199,6 +221,7 @@ class City(Scene):
         self.tank = ModelFromObj(self, 'tank/tank.obj', shader=self.tank_shader)
         self.tank.M.translate(np.array([0, CoordinateSystem.ROAD_OFFSET, 0], 'f'))
         self.tank.M.translate(CoordinateSystem.get_world_pos(-2, -4))
+        self.tank.enable_occlusion_queries()
         self.models.append(self.tank)
 
     def update_police_lights(self, dt):
@@ -223,7 +246,7 @@ class City(Scene):
             self.police_light_timer = 0
         
         for index, light in enumerate(self.police_car_lights):
-            light.position = self.police_car.shader.matricies[index].get_position() + np.array([0, 0.5, 0])
+            light.position = self.police_car.matricies[index].get_position() + np.array([0, 0.5, 0])
 
     def update_player_spotlight(self):
         """
@@ -267,7 +290,7 @@ class City(Scene):
                 dino_matrix.rotate([0, 1, 0], dyno_swarm_orientation + dino_orientation_offset)
                 dino_matrix.translate(CoordinateSystem.get_world_pos(offset[0], offset[1]))
                 dino_matrix.translate([dino_position_offset[0], 0, dino_position_offset[1]])
-                self.dyno_shader.add_matrix(dino_matrix)
+                self.dyno.add_matrix(dino_matrix)
 
     def draw(self, framebuffer=False):
         """
@@ -277,8 +300,9 @@ class City(Scene):
             framebuffer (bool): Whether to draw to a framebuffer or the screen.
         """
         if not framebuffer:
-            # update the scene
-            self.update()
+            # refresh the dynamic environment map before drawing the frame
+            if self.update_tank_env_map:
+                self.tank_env_map.update(self, self.tank)
 
             # clear the screen
             gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
@@ -286,10 +310,16 @@ class City(Scene):
             # draw the skybox
             self.skybox.draw()        
 
+            # occluders are only rasterized and occlusion queries only issued for the main view
+            occlusion_culler.begin_pass(self.camera)
+            occlusion_queries.begin_pass(self.camera)
+
         for model in self.models:
             model.draw()
 
         if not framebuffer:
+            occlusion_culler.end_pass()
+            occlusion_queries.end_pass()
             self.imgui_windows()
 
     def draw_reflections(self):
@@ -324,7 +354,7 @@ class City(Scene):
 
                 if count >= n:
                     break
-                self.traffic_light_shader.add_offset(CoordinateSystem.get_world_pos(intersection[0] + corner_offset_x, intersection[1] + corner_offset_z))
+                self.traffic_light.add_offset(CoordinateSystem.get_world_pos(intersection[0] + corner_offset_x, intersection[1] + corner_offset_z))
 
                 light = LightSource()
                 light.Ia = [0, 1, 0]
@@ -343,9 +373,6 @@ class City(Scene):
 
         self.update_police_lights(self.delta_time)
         self.update_player_spotlight()
-        
-        if self.update_tank_env_map:
-            self.tank_env_map.update(self, self.tank)
 
     def imgui_windows(self):
         """
@@ -6,16 +6,21 @@ from towers import Towers
 from model import ModelFromObjInstanced
 from shaders import PhongShaderInstanced
 from coordinate_system import CoordinateSystem
+from spatial_index import SpatialIndex
+from pvs import pvs
 
 class CityMap:
-    def __init__(self, b_n, building_type):
+    def __init__(self, b_n, building_type, seed=None):
         """
         Initialize the CityMap object.
 
         Args:
             b_n (int): Number of blocks in each dimension.
             building_type (int): Number of different building types.
+            seed (int, optional): Seed of the layout, a random one when None. Baked visibility is keyed by it.
         """
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.random = random.Random(self.seed)
         self.b_n = b_n
         self.n = (self.b_n * 3) + 1
         self.map = [[0] * self.n for _ in range(self.n)]
@@ -27,6 +32,12 @@ class CityMap:
 
         self.building_type = building_type
         self.index_to_building = {}
+
+        # hierarchy over the instances of every static model, and the model and instance of each item
+        self.spatial_index = None
+        self.static_models = []
+        self.static_model_ids = None
+        self.static_instance_ids = None
         self.fill_buildings()
 
     def fill_buildings(self):
@@ -51,7 +62,7 @@ class CityMap:
                             else:
                                 # Randomize the building type while maintaining the count
                                 while True:
-                                    random_building_type = random.randint(1, self.building_type)
+                                    random_building_type = self.random.randint(1, self.building_type)
                                     if self.building_counts[random_building_type - 1] < self.buildings_count:
                                         self.map[x][y] = random_building_type
                                         self.building_counts[random_building_type - 1] += 1
@@ -65,6 +76,15 @@ class CityMap:
                 if j == len(map_copy[i]) - 2 and map_copy[i][j] != 0:
                     self.map[i][j + 1] = -1
 
+    def get_road_cells(self):
+        """
+        Get the road cells of the map.
+
+        Returns:
+            list: (i, j) of each road cell, remapped to -n/2 to n/2.
+        """
+        return [(i - self.n // 2, j - self.n // 2) for i in range(self.n) for j in range(self.n) if self.map[i][j] <= 0]
+
     def print_map(self):
         """
         Print the city map.
@@ -129,7 +149,7 @@ class CityMap:
                         if check_intersection(i, j):
                             intersection_positions.append((i_remapped, j_remapped))
 
-                        horizontal_road_shader.add_offset(CoordinateSystem.get_world_pos(i_remapped, j_remapped))
+                        horizontal_roads.add_offset(CoordinateSystem.get_world_pos(i_remapped, j_remapped))
                     else:
                         building_positions.append((i_remapped, j_remapped))
                         towers[self.map[i][j] - 1].add_tower(i_remapped, j_remapped)
@@ -138,16 +158,69 @@ class CityMap:
                     if check_intersection(i, j):
                         intersection_positions.append((i_remapped, j_remapped))
                     
-                    vertical_road_shader.add_offset(CoordinateSystem.get_world_pos(i_remapped, j_remapped)) 
+                    vertical_roads.add_offset(CoordinateSystem.get_world_pos(i_remapped, j_remapped)) 
                 
             self.road_positions.append(road_positions)
             self.intersection_positions.append(intersection_positions)
             self.building_positions.append(building_positions)
 
+        self.build_spatial_index(towers + [vertical_roads, horizontal_roads])
+        self.bake_pvs(towers)
+
         print("========= Done =========")
 
         return towers, vertical_roads, horizontal_roads
 
+    def build_spatial_index(self, models):
+        """
+        Build the spatial indices of the static models: one per model, which culls its instances, and
+        one over the instances of every model for spatial queries across the city.
+
+        Args:
+            models (list): The instanced models that do not move.
+        """
+        boxes, model_ids, instance_ids = [], [], []
+        for index, model in enumerate(models):
+            model.build_spatial_index()
+            model_boxes = model.get_instance_bounds()[0]
+            boxes.append(model_boxes)
+            model_ids.append(np.full(len(model_boxes), index))
+            instance_ids.append(np.arange(len(model_boxes)))
+
+        self.static_models = models
+        self.static_model_ids = np.concatenate(model_ids)
+        self.static_instance_ids = np.concatenate(instance_ids)
+        self.spatial_index = SpatialIndex(np.concatenate(boxes))
+        print("Spatial index:", len(self.spatial_index), "static instances")
+
+    def bake_pvs(self, occluders):
+        """
+        Bake (or load) the potentially visible sets of the road cells, the static instances that may be
+        seen from some point of each cell past the occluders, and cull the static models against them.
+
+        Args:
+            occluders (list): The static models that hide what is behind them.
+        """
+        occluder_ids = [index for index, model in enumerate(self.static_models) if any(model is occluder for occluder in occluders)]
+        occluder_mask = np.isin(self.static_model_ids, occluder_ids)
+        cells = [cell for row in self.road_positions for cell in row]
+        # the city is drawn without the sets until they are baked, unless they are cached for this layout
+        pvs.bake(self.seed, cells, self.spatial_index.boxes, occluder_mask, background=True)
+        pvs.set_models(self.static_models, self.static_model_ids)
+
+    def get_static_instances(self, items):
+        """
+        Get the model and instance index of items returned by a query of the spatial index.
+
+        Args:
+            items (numpy.ndarray): Item ids of the spatial index, -1 entries are skipped.
+
+        Returns:
+            list: (model, instance index) of each item.
+        """
+        return [(self.static_models[self.static_model_ids[item]], int(self.static_instance_ids[item]))
+                for item in np.asarray(items).reshape(-1) if item >= 0]
+
     def get_random_intersection(self, blacklist=[], depth=0):
         """
         Get a random intersection position.
@@ -188,16 +261,15 @@ class CityMap:
 
         return self.intersection_positions[random_x][random_y]
 
-    def _get_buildings(self, building_pack, scene):
+    def get_building_files(self, building_pack):
         """
-        Get the building models.
+        Get the model files of the building types used by the city.
 
         Args:
             building_pack (str): Name of the building pack.
-            scene (Scene): The scene object.
 
         Returns:
-            list: List of building models.
+            list: List of model paths relative to the models directory.
         """
         objs = []
         for file in os.listdir(f"models/{building_pack}/"):
@@ -206,6 +278,21 @@ class CityMap:
                 if len(objs) == self.building_type:
                     break
 
+        return objs
+
+    def _get_buildings(self, building_pack, scene):
+        """
+        Get the building models.
+
+        Args:
+            building_pack (str): Name of the building pack.
+            scene (Scene): The scene object.
+
+        Returns:
+            list: List of building models.
+        """
+        objs = self.get_building_files(building_pack)
+
         towers = []
 
         for index, obj in enumerate(objs):
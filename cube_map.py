@@ -1,5 +1,5 @@
 import OpenGL.GL as gl
-from texture import Texture, ImageWrapper
+from texture import Texture, image_decoder
 
 class CubeMap(Texture):
     """
@@ -37,6 +37,8 @@ class CubeMap(Texture):
         self.sample = sample
         self.target = gl.GL_TEXTURE_CUBE_MAP # we set the texture target as a cube map
         self.uniform = uniform
+        self.width = 0
+        self.height = 0
 
         # generate the texture.
         self.textureid = gl.glGenTextures(1)
@@ -83,12 +85,16 @@ class CubeMap(Texture):
         
         self._bind()
         
-        for (key, value) in self.files.items():
-            print('Loading texture: texture/{}/{}'.format(name, value))
-            img = ImageWrapper('{}/{}'.format(name, value))
+        # the six faces are decoded in parallel
+        paths = {key: '{}/{}'.format(name, value) for (key, value) in self.files.items()}
+        image_decoder.prefetch(paths.values(), self.format)
 
-            # convert the python image object to a plain byte array for passsing to OpenGL
-            gl.glTexImage2D(key, 0, self.format, img.width(), img.height(), 0, self.format, self.type, img.data(self.format))
+        for (key, path) in paths.items():
+            print('Loading texture: texture/{}'.format(path))
+            data = image_decoder.get(path, self.format)
+            self.height, self.width = data.shape[:2]
+
+            gl.glTexImage2D(key, 0, self.format, self.width, self.height, 0, self.format, self.type, data)
 
     def update(self, scene):
         """
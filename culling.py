@@ -0,0 +1,85 @@
+import numpy as np
+
+# Frustum culling: bounding spheres are tested against the six planes of the camera frustum, all the
+# instances of a model in one vectorised pass.
+
+
+def frustum_planes(projection_view):
+    '''
+    Returns the (6, 4) planes of the frustum of a projection @ view matrix, normals pointing inwards and
+    normalised so that plane @ (x, y, z, 1) is the signed distance of a point to the plane.
+    '''
+    m = np.asarray(projection_view, dtype=np.float64)
+    planes = np.stack([
+        m[3] + m[0],    # left
+        m[3] - m[0],    # right
+        m[3] + m[1],    # bottom
+        m[3] - m[1],    # top
+        m[3] + m[2],    # near
+        m[3] - m[2],    # far
+    ])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def spheres_in_frustum(planes, centers, radii):
+    '''
+    Returns the (K,) mask of the spheres that are not fully outside any plane of the frustum.
+    '''
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    distances = centers @ planes[:, :3].T + planes[:, 3]
+    return (distances > -np.asarray(radii, dtype=np.float64).reshape(-1, 1)).all(axis=1)
+
+
+class FrustumCuller:
+    '''
+    Culls models and instances outside the view frustum of the camera, and counts the instances
+    drawn and culled by each type of model.
+    '''
+
+    def __init__(self):
+        self.enabled = True
+        # the planes are derived again only when the camera matrices change
+        self._planes = None
+        self._planes_key = None
+        # model type -> [drawn, culled] during the current frame
+        self._counters = {}
+        # set while the faces of an environment map are drawn, instanced models then draw all their
+        # instances from an upload kept for these passes instead of culling them again for each face
+        self.reflection_pass = False
+
+    def get_planes(self, camera):
+        """ Return the frustum planes of the camera's current view and projection """
+        projection_view = np.array(camera.projection()) @ np.array(camera.view())
+        key = projection_view.tobytes()
+        if key != self._planes_key:
+            self._planes = frustum_planes(projection_view)
+            self._planes_key = key
+        return self._planes
+
+    def visible(self, camera, centers, radii):
+        """ Return the mask of the spheres that may be seen by the camera """
+        return spheres_in_frustum(self.get_planes(camera), centers, radii)
+
+    def begin_reflections(self):
+        """ Start drawing the faces of an environment map """
+        self.reflection_pass = True
+
+    def end_reflections(self):
+        """ Back to drawing from the camera of the scene """
+        self.reflection_pass = False
+
+    def count(self, name, drawn, culled):
+        """ Record the instances of one model drawn and culled """
+        counters = self._counters.setdefault(name, [0, 0])
+        counters[0] += drawn
+        counters[1] += culled
+
+    def reset_counters(self):
+        """ Return the model type -> (drawn, culled) counters of the last frame, then reset them """
+        counters = {name: tuple(values) for name, values in self._counters.items()}
+        self._counters = {}
+        return counters
+
+
+# every model is culled against the same camera
+frustum_culler = FrustumCuller()
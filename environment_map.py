@@ -5,6 +5,7 @@ import glm
 from cube_map import CubeMap
 from fbo import Framebuffer
 from shaders import BaseShaderProgram
+from culling import frustum_culler
 import matutils as mu
 
 class EnvironmentShader(BaseShaderProgram):
@@ -13,17 +14,12 @@ class EnvironmentShader(BaseShaderProgram):
         BaseShaderProgram.__init__(self, name=name)
 
         self.add_uniform('env_map')
-        self.add_uniform('M')
-        self.add_uniform('viewPos')
 
         self.map = map
 
     def bind(self, model, M):
         BaseShaderProgram.bind(self, model, M)
 
-        self.uniforms['M'].bind_matrix(np.array(M, dtype=np.float32))
-        self.uniforms['viewPos'].bind_vector(np.array(model.scene.camera.position(), dtype=np.float32))
-
         num_textures = self.bind_textures(model)
         if self.map is not None:
             self.map.bind(num_textures)
@@ -119,6 +115,9 @@ class EnvironmentMap(CubeMap):
         # reset the scenes projection matrix to the environment maps frustum projection
         scene.camera._projection = self.P
 
+        # instanced models draw every instance from one upload for all the faces
+        frustum_culler.begin_reflections()
+
         # loop though each face of the cube map
         for (face, fbo) in self.fbos.items():
             # bind the fbo for the current face (sets the viewport)
@@ -129,6 +128,7 @@ class EnvironmentMap(CubeMap):
             # set the camera view to the current face
             scene.camera._view = self._views[face]
             scene.camera._camera_dirty = False
+            scene.update_frame_uniforms()
 
             # draw the reflections of the scene
             scene.draw_reflections()
@@ -136,12 +136,15 @@ class EnvironmentMap(CubeMap):
             # unbind the fbo (restores the viewport)
             fbo.unbind()
 
+        frustum_culler.end_reflections()
+
         # restore the scenes projection matrix
         scene.camera._projection = Pscene
         
         # reset the camera view to the original view
         scene.camera._camera_dirty = True
         scene.camera._update_vectors()
+        scene.update_frame_uniforms()
 
     def calculate_camera_views(self, object_position):
         """
@@ -1,6 +1,7 @@
 import OpenGL.GL as gl
 
 from texture import Texture
+from gl_state import state_cache
 
 class Framebuffer():
     """
@@ -20,7 +21,7 @@ class Framebuffer():
         depthbuffer (int, optional): The depth buffer ID. Defaults to None.
         stencilbuffer (int, optional): The stencil buffer ID. Defaults to None.
         depthstencilbuffer (int, optional): The depth-stencil buffer ID. Defaults to None.
-        prev_viewport (list): The previous viewport size.
+        pushed (list): Whether each bind not yet unbound pushed the framebuffer, binds of the framebuffer already bound do not.
 
     """
 
@@ -43,6 +44,7 @@ class Framebuffer():
         self.depthbuffer = None
         self.stencilbuffer = None
         self.depthstencilbuffer = None
+        self.pushed = []
 
         if textures is not None:
             self.prepare(textures)
@@ -52,6 +54,7 @@ class Framebuffer():
         Deletes the Framebuffer object and its associated resources.
         """
 
+        state_cache.forget_framebuffer(self.fbo)
         gl.glDeleteFramebuffers(1, [self.fbo])
         if self.depthbuffer is not None:
             gl.glDeleteRenderbuffers(1, [self.depthbuffer])
@@ -62,29 +65,26 @@ class Framebuffer():
 
     def bind(self):
         """
-        Binds the framebuffer object.
+        Binds the framebuffer object and sets the viewport to its size.
         """
 
-        # deal with double binding
-        if gl.glGetIntegerv(gl.GL_FRAMEBUFFER_BINDING) == self.fbo:
+        # deal with double binding, the matching unbind then leaves the framebuffer bound
+        if state_cache.framebuffer == self.fbo:
+            self.pushed.append(False)
             return
 
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.fbo)
-        # store prev framebuffer size to reset when unbind
-        self.prev_viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
-        if list(self.prev_viewport) != [0, 0, int(self.width), int(self.height)]:
-            gl.glViewport(0, 0, int(self.width), int(self.height))
+        # the previous framebuffer and viewport are kept by the state cache, no driver queries needed
+        state_cache.push_framebuffer(self.fbo, (0, 0, self.width, self.height))
+        self.pushed.append(True)
 
     def unbind(self):
         """
-        Unbinds the framebuffer object.
+        Unbinds the framebuffer object, restoring the framebuffer and viewport bound before it.
         """
 
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
-
-        # reset old framebuffer viewport
-        if list(gl.glGetIntegerv(gl.GL_VIEWPORT)) != list(self.prev_viewport):
-            gl.glViewport(self.prev_viewport[0], self.prev_viewport[1], self.prev_viewport[2], self.prev_viewport[3])
+        # an unbind without a bind still pops, the state cache falls back to the default framebuffer
+        if not self.pushed or self.pushed.pop():
+            state_cache.pop_framebuffer()
 
     def status(self):
         """
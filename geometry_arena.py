@@ -0,0 +1,312 @@
+import bisect
+import ctypes
+
+import OpenGL.GL as gl
+import numpy as np
+
+from vao import VertexArray
+from vbo import VertexBuffer, BufferLayout, attribute_bytes
+from ibo import IndexBuffer
+from gl_state import state_cache
+
+# Geometry arenas: the static meshes sharing a vertex format are sub-allocated in one large vertex
+# buffer and one large index buffer behind one vertex array. Indices stay local to their mesh and are
+# offset by the base vertex of the allocation when drawn, so compatible draws of several meshes go out
+# as one glMultiDrawElementsBaseVertex.
+
+# capacity of a new arena, in vertices and indices. Arenas double when full
+INITIAL_VERTICES = 1 << 16
+INITIAL_INDICES = 1 << 18
+
+
+class FreeList:
+    '''
+    First fit allocator over a range of units. Freed blocks are merged with their free neighbours.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # sorted, disjoint (start, size) free blocks
+        self._starts = [0]
+        self._sizes = [capacity]
+        self.used = 0
+        # end of the highest block ever allocated, and the allocations placed below it in freed space
+        self.end = 0
+        self.reused = 0
+
+    def allocate(self, size):
+        """ Return the start of a block of the given size, or None when no free block is large enough """
+        for index, free in enumerate(self._sizes):
+            if free >= size:
+                start = self._starts[index]
+                if free == size:
+                    del self._starts[index]
+                    del self._sizes[index]
+                else:
+                    self._starts[index] += size
+                    self._sizes[index] -= size
+                self.used += size
+                if start < self.end:
+                    self.reused += 1
+                self.end = max(self.end, start + size)
+                return start
+        return None
+
+    def free(self, start, size):
+        """ Return a block to the free list """
+        index = bisect.bisect_left(self._starts, start)
+        self._starts.insert(index, start)
+        self._sizes.insert(index, size)
+        self.used -= size
+
+        # merge with the next block, then with the previous one
+        if index + 1 < len(self._starts) and start + size == self._starts[index + 1]:
+            self._sizes[index] += self._sizes.pop(index + 1)
+            del self._starts[index + 1]
+        if index > 0 and self._starts[index - 1] + self._sizes[index - 1] == start:
+            self._sizes[index - 1] += self._sizes.pop(index)
+            del self._starts[index]
+
+    def grow(self, capacity):
+        """ Extend the range to the given capacity, the new units are free """
+        if self._starts and self._starts[-1] + self._sizes[-1] == self.capacity:
+            self._sizes[-1] += capacity - self.capacity
+        else:
+            self._starts.append(self.capacity)
+            self._sizes.append(capacity - self.capacity)
+        self.capacity = capacity
+
+    def get_free(self):
+        """ Return the number of free units """
+        return self.capacity - self.used
+
+    def get_largest_free(self):
+        """ Return the size of the largest free block """
+        return max(self._sizes, default=0)
+
+    def get_fragmentation(self):
+        """ Return the part of the free units outside the largest free block, 0 when the free space is in one piece """
+        free = self.get_free()
+        return 1.0 - self.get_largest_free() / free if free > 0 else 0.0
+
+
+class ArenaAllocation:
+    '''
+    The vertices and indices of one mesh in an arena.
+    '''
+
+    def __init__(self, arena, base_vertex, vertex_count, first_index, level_counts):
+        self.arena = arena
+        self.base_vertex = base_vertex
+        self.vertex_count = vertex_count
+        self.first_index = first_index
+        self.index_count = sum(level_counts)
+        # (byte offset into the arena index buffer, index count) of each level of detail
+        self.lod_ranges = []
+        offset = first_index
+        for count in level_counts:
+            self.lod_ranges.append((offset * arena.index_dtype.itemsize, count))
+            offset += count
+
+
+class GeometryArena:
+    '''
+    One vertex buffer, index buffer and vertex array holding the meshes of one vertex format.
+    '''
+
+    def __init__(self, elements, index_dtype, vertices=INITIAL_VERTICES, indices=INITIAL_INDICES):
+        """
+        Create an empty arena.
+        :param elements: the (name, BufferElement) of each vertex attribute, in layout order
+        :param index_dtype: the numpy type of the indices, local to each mesh
+        """
+        self.names = [name for name, _ in elements]
+        self.layout = BufferLayout([element for _, element in elements])
+        self.stride = self.layout.get_stride()
+        self.index_dtype = np.dtype(index_dtype)
+
+        self.vertices = FreeList(vertices)
+        self.indices = FreeList(indices)
+        self.allocations = 0
+        # allocations returned to the arena so far
+        self.frees = 0
+
+        # buffers are created with no vertex array bound, so that no vertex array captures the index buffer
+        state_cache.bind_vertex_array(0)
+        self.vbo = VertexBuffer(buffer_size=vertices * self.stride)
+        self.vbo.set_layout(self.layout)
+        self.ibo = IndexBuffer(buffer_size=indices * self.index_dtype.itemsize, dtype=self.index_dtype)
+
+        self.vao = VertexArray()
+        self.vao.add_vertex_buffer(self.vbo)
+        self.vao.set_index_buffer(self.ibo)
+        self.vao.unbind()
+
+    def get_attribute_locations(self):
+        """ Return the attribute name -> location map shaders drawing from the arena are linked with """
+        return {name: location for location, name in enumerate(self.names)}
+
+    def allocate(self, streams, levels):
+        """
+        Copy a mesh into the arena.
+        :param streams: a dict of attribute name -> per-vertex data, one entry per attribute of the arena
+        :param levels: the face arrays of the mesh, full mesh first then each level of detail
+        :return: the ArenaAllocation of the mesh
+        """
+        vertex_count = len(next(iter(streams.values())))
+        level_counts = [level.size for level in levels]
+        index_count = sum(level_counts)
+
+        base_vertex = self.vertices.allocate(vertex_count)
+        while base_vertex is None:
+            self._grow_vertices(max(self.vertices.capacity * 2, self.vertices.used + vertex_count))
+            base_vertex = self.vertices.allocate(vertex_count)
+
+        first_index = self.indices.allocate(index_count)
+        while first_index is None:
+            self._grow_indices(max(self.indices.capacity * 2, self.indices.used + index_count))
+            first_index = self.indices.allocate(index_count)
+
+        allocation = ArenaAllocation(self, base_vertex, vertex_count, first_index, level_counts)
+        self.write_vertices(allocation, streams)
+        self.ibo.write(first_index, np.concatenate([level.reshape(-1) for level in levels]))
+        self.allocations += 1
+        return allocation
+
+    def write_vertices(self, allocation, streams):
+        """ Rewrite the vertices of an allocation """
+        data = np.zeros((allocation.vertex_count, self.stride), dtype=np.uint8)
+        for name, element in zip(self.names, self.layout.get_elements()):
+            columns = slice(element.get_offset(), element.get_offset() + element.get_size())
+            data[:, columns] = attribute_bytes(streams[name], element, allocation.vertex_count)
+        self.vbo.write(allocation.base_vertex * self.stride, data)
+
+    def free(self, allocation):
+        """ Return the vertices and indices of an allocation to the arena """
+        self.vertices.free(allocation.base_vertex, allocation.vertex_count)
+        self.indices.free(allocation.first_index, allocation.index_count)
+        self.allocations -= 1
+        self.frees += 1
+        allocation.arena = None
+
+    def _copy(self, old, new, size):
+        # copy the contents of the old buffer at the start of the new one, on the GPU
+        gl.glBindBuffer(gl.GL_COPY_READ_BUFFER, old)
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, new)
+        gl.glCopyBufferSubData(gl.GL_COPY_READ_BUFFER, gl.GL_COPY_WRITE_BUFFER, 0, 0, size)
+        gl.glBindBuffer(gl.GL_COPY_READ_BUFFER, 0)
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, 0)
+
+    def _grow_vertices(self, capacity):
+        print('Growing geometry arena to {} vertices'.format(capacity))
+        state_cache.bind_vertex_array(0)
+        vbo = VertexBuffer(buffer_size=capacity * self.stride)
+        vbo.set_layout(self.layout)
+        self._copy(self.vbo._VBO, vbo._VBO, self.vertices.capacity * self.stride)
+        self.vao.replace_vertex_buffer(self.vbo, vbo, 0)
+        self.vao.unbind()
+        self.vbo = vbo
+        self.vertices.grow(capacity)
+
+    def _grow_indices(self, capacity):
+        print('Growing geometry arena to {} indices'.format(capacity))
+        state_cache.bind_vertex_array(0)
+        ibo = IndexBuffer(buffer_size=capacity * self.index_dtype.itemsize, dtype=self.index_dtype)
+        self._copy(self.ibo._buffer, ibo._buffer, self.indices.capacity * self.index_dtype.itemsize)
+        self.vao.set_index_buffer(ibo)
+        self.vao.unbind()
+        self.ibo = ibo
+        self.indices.grow(capacity)
+
+    def draw(self, primitive, allocation, level=0):
+        """ Draw one level of detail of an allocation, the arena's vertex array must be bound """
+        offset, count = allocation.lod_ranges[min(level, len(allocation.lod_ranges) - 1)]
+        gl.glDrawElementsBaseVertex(primitive, count, self.ibo.get_type(), ctypes.c_void_p(offset), allocation.base_vertex)
+        return count
+
+    def multi_draw(self, primitive, allocations, levels):
+        """
+        Draw one level of detail of several allocations in one call, the arena's vertex array must be bound.
+        :return: the number of indices drawn
+        """
+        ranges = [allocation.lod_ranges[min(level, len(allocation.lod_ranges) - 1)] for allocation, level in zip(allocations, levels)]
+        counts = np.array([count for _, count in ranges], dtype=np.int32)
+        offsets = (ctypes.c_void_p * len(ranges))(*[offset for offset, _ in ranges])
+        base_vertices = np.array([allocation.base_vertex for allocation in allocations], dtype=np.int32)
+        gl.glMultiDrawElementsBaseVertex(primitive, counts, self.ibo.get_type(), offsets, len(ranges), base_vertices)
+        return int(counts.sum())
+
+    def get_stats(self):
+        """ Return the allocations, memory used, fragmentation and reuse of freed space of the arena """
+        return {
+            'allocations': self.allocations,
+            'frees': self.frees,
+            'reused': self.vertices.reused,
+            'vertices': (self.vertices.used, self.vertices.capacity),
+            'indices': (self.indices.used, self.indices.capacity),
+            'bytes': self.vertices.capacity * self.stride + self.indices.capacity * self.index_dtype.itemsize,
+            'fragmentation': max(self.vertices.get_fragmentation(), self.indices.get_fragmentation()),
+        }
+
+
+class GeometryArenas:
+    '''
+    The arenas of the application, one per vertex format and index type.
+    '''
+
+    def __init__(self):
+        self._arenas = {}
+        # draw calls issued and draws they replaced in the last frame
+        self.draw_calls = 0
+        self.draws = 0
+
+    def arena(self, elements, index_dtype):
+        """ Return the arena of a vertex format, created on first use """
+        key = (tuple((name, element.get_type(), element.get_normalized()) for name, element in elements), np.dtype(index_dtype).str)
+        if key not in self._arenas:
+            self._arenas[key] = GeometryArena(elements, index_dtype)
+        return self._arenas[key]
+
+    def get_arenas(self):
+        """ Return every arena """
+        return list(self._arenas.values())
+
+    def count(self, draws):
+        """ Record one draw call standing for the given number of draws """
+        self.draw_calls += 1
+        self.draws += draws
+
+    def reset_counters(self):
+        """ Return the draw counters of the last frame, then reset them """
+        counters = (self.draw_calls, self.draws)
+        self.draw_calls = 0
+        self.draws = 0
+        return counters
+
+
+# static meshes of every model share the arenas
+geometry_arenas = GeometryArenas()
+
+
+if __name__ == "__main__":
+    # Exercise the allocator with models loaded and unloaded at random, and report the fragmentation
+    rng = np.random.default_rng(0)
+    free_list = FreeList(1 << 20)
+    blocks = []
+    for step in range(10000):
+        if blocks and rng.random() < 0.45:
+            free_list.free(*blocks.pop(rng.integers(len(blocks))))
+        else:
+            size = int(rng.integers(100, 20000))
+            start = free_list.allocate(size)
+            if start is not None:
+                blocks.append((start, size))
+        if step % 2000 == 1999:
+            print(f'step {step + 1}: {len(blocks)} blocks, {free_list.used / free_list.capacity:.1%} used, '
+                  f'fragmentation {free_list.get_fragmentation():.1%}')
+
+    for block in blocks:
+        free_list.free(*block)
+    assert free_list.used == 0 and free_list.get_largest_free() == free_list.capacity
+    assert free_list.reused > 0
+    print(f'every block freed, free space back in one piece, {free_list.reused} allocations reused freed space')
@@ -0,0 +1,173 @@
+import OpenGL.GL as gl
+
+class GLStateCache:
+    '''
+    Shadow copy of the OpenGL state touched by the renderer. Every bind goes through here so that
+    calls which would not change the current state are filtered out. The state is never read back
+    from the driver: a value of None means unknown, and the next change is always issued.
+    '''
+
+    def __init__(self):
+        """ Create the cache with the default state of a freshly created context """
+        # redundant calls skipped / calls issued since the last reset
+        self.hits = 0
+        self.misses = 0
+
+        self.program = 0
+        self.vertex_array = 0
+        self.active_unit = 0
+        # texture bound to each (unit, target)
+        self.textures = {}
+        self.framebuffer = 0
+        # (framebuffer, viewport) pairs pushed by push_framebuffer
+        self.framebuffer_stack = []
+        self.viewport = None
+        self.depth_mask = True
+        self.front_face = gl.GL_CCW
+        self.cull_face = gl.GL_BACK
+        # enabled flags of glEnable/glDisable capabilities, everything starts disabled
+        self.capabilities = {}
+
+    def _changed(self, current, value):
+        if current is not None and current == value:
+            self.hits += 1
+            return False
+        self.misses += 1
+        return True
+
+    def invalidate_bindings(self):
+        """
+        Forget the object bindings, call after code outside the renderer (e.g. imgui) has used the
+        context. Capabilities, viewport and depth mask are restored by such code and are kept.
+        """
+        self.program = None
+        self.vertex_array = None
+        self.active_unit = None
+        self.textures = {}
+
+    def reset_counters(self):
+        """ Reset the hit/miss counters and return their values before the reset """
+        counters = (self.hits, self.misses)
+        self.hits = 0
+        self.misses = 0
+        return counters
+
+    # --- programs and vertex arrays
+
+    def use_program(self, program):
+        if self._changed(self.program, program):
+            gl.glUseProgram(program)
+            self.program = program
+
+    def bind_vertex_array(self, vertex_array):
+        if self._changed(self.vertex_array, vertex_array):
+            gl.glBindVertexArray(vertex_array)
+            self.vertex_array = vertex_array
+
+    def forget_vertex_array(self, vertex_array):
+        """ Called before a vertex array is deleted, deleting the bound array reverts to 0 """
+        if self.vertex_array == vertex_array:
+            self.vertex_array = 0
+
+    # --- textures
+
+    def active_texture(self, unit):
+        if self._changed(self.active_unit, unit):
+            gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+            self.active_unit = unit
+
+    def bind_texture(self, target, texture, unit=None):
+        """
+        Bind a texture to a texture unit.
+        :param target: the texture target, e.g. GL_TEXTURE_2D
+        :param texture: the texture name
+        :param unit: the texture unit, the active unit is used if None
+        """
+        if unit is not None:
+            self.active_texture(unit)
+
+        key = (self.active_unit, target)
+        if self.active_unit is None or self._changed(self.textures.get(key), texture):
+            gl.glBindTexture(target, texture)
+            if self.active_unit is not None:
+                self.textures[key] = texture
+
+    def forget_texture(self, texture):
+        """ Called before a texture is deleted, deleting a bound texture reverts its units to 0 """
+        for key, bound in self.textures.items():
+            if bound == texture:
+                self.textures[key] = 0
+
+    # --- framebuffers and viewport
+
+    def bind_framebuffer(self, framebuffer):
+        if self._changed(self.framebuffer, framebuffer):
+            gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, framebuffer)
+            self.framebuffer = framebuffer
+
+    def set_viewport(self, x, y, width, height):
+        viewport = (int(x), int(y), int(width), int(height))
+        if self._changed(self.viewport, viewport):
+            gl.glViewport(*viewport)
+            self.viewport = viewport
+
+    def push_framebuffer(self, framebuffer, viewport):
+        """
+        Bind a framebuffer and its viewport, remembering the previous ones for pop_framebuffer.
+        :param framebuffer: the framebuffer name
+        :param viewport: the (x, y, width, height) viewport to render to the framebuffer
+        """
+        self.framebuffer_stack.append((self.framebuffer, self.viewport))
+        self.bind_framebuffer(framebuffer)
+        self.set_viewport(*viewport)
+
+    def pop_framebuffer(self):
+        """ Restore the framebuffer and viewport bound before the last push_framebuffer """
+        if not self.framebuffer_stack:
+            print('(W) Warning: framebuffer stack is empty, binding the default framebuffer')
+            self.bind_framebuffer(0)
+            return
+
+        framebuffer, viewport = self.framebuffer_stack.pop()
+        self.bind_framebuffer(0 if framebuffer is None else framebuffer)
+        if viewport is not None:
+            self.set_viewport(*viewport)
+
+    def forget_framebuffer(self, framebuffer):
+        """ Called before a framebuffer is deleted, deleting the bound framebuffer reverts to 0 """
+        if self.framebuffer == framebuffer:
+            self.framebuffer = 0
+
+    # --- fixed function state
+
+    def set_depth_mask(self, flag):
+        flag = bool(flag)
+        if self._changed(self.depth_mask, flag):
+            gl.glDepthMask(gl.GL_TRUE if flag else gl.GL_FALSE)
+            self.depth_mask = flag
+
+    def enable(self, capability):
+        if self._changed(self.capabilities.get(capability, False), True):
+            gl.glEnable(capability)
+            self.capabilities[capability] = True
+
+    def disable(self, capability):
+        if self._changed(self.capabilities.get(capability, False), False):
+            gl.glDisable(capability)
+            self.capabilities[capability] = False
+
+    def is_enabled(self, capability):
+        """ Return the cached enabled flag of a capability, never queries the driver """
+        return self.capabilities.get(capability, False)
+
+    def set_cull_face(self, cull_face=gl.GL_BACK, front_face=gl.GL_CCW):
+        if self._changed(self.cull_face, cull_face):
+            gl.glCullFace(cull_face)
+            self.cull_face = cull_face
+        if self._changed(self.front_face, front_face):
+            gl.glFrontFace(front_face)
+            self.front_face = front_face
+
+
+# the renderer uses a single context, so the cache is shared by the whole program
+state_cache = GLStateCache()
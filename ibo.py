@@ -1,11 +1,15 @@
 import OpenGL.GL as gl
+import numpy as np
 
 class IndexBuffer:
 
-    def __init__(self, data=None, buffer_size=None):
-        """ Create an index buffer with the given data """
-        self._count = len(data)
+    def __init__(self, data=None, buffer_size=None, dtype=None):
+        """ Create an index buffer with the given data, 8, 16 or 32 bit wide depending on its dtype (or the given dtype for an empty buffer of buffer_size bytes) """
+        self._count = len(data) if data is not None else 0
         self._buffer = gl.glGenBuffers(1)
+        if data is not None:
+            dtype = data.dtype
+        self._dtype = np.dtype(dtype) if dtype is not None and np.dtype(dtype).itemsize in (1, 2) else np.dtype(np.uint32)
 
         if data is not None:
             buffer_size = len(data) * 4
@@ -19,7 +23,7 @@ class IndexBuffer:
             gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, buffer_size,
                         None, gl.GL_DYNAMIC_DRAW)
         else:
-            gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, data.flatten(), gl.GL_STATIC_DRAW)
+            gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, np.asarray(data, dtype=self._dtype).flatten(), gl.GL_STATIC_DRAW)
 
     def __del__(self):
         """ Delete the index buffer """
@@ -41,10 +45,32 @@ class IndexBuffer:
             return
 
         self._count = len(data)
+        data = np.asarray(data, dtype=self._dtype)
 
-        self.bind()
-        gl.glBufferSubData(gl.GL_ELEMENT_ARRAY_BUFFER, 0, data.nbytes, data.flatten())
-        self.unbind()
+        # the element array binding belongs to the bound vertex array, which may be left bound
+        # between draws, so the copy target is used to avoid detaching the index buffer
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, self._buffer)
+        gl.glBufferSubData(gl.GL_COPY_WRITE_BUFFER, 0, data.nbytes, data.flatten())
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, 0)
+
+    def write(self, offset, data):
+        """ Write indices at an index offset into the buffer, leaving the rest untouched """
+        data = np.asarray(data, dtype=self._dtype)
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, self._buffer)
+        gl.glBufferSubData(gl.GL_COPY_WRITE_BUFFER, offset * self._dtype.itemsize, data.nbytes, data.flatten())
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, 0)
+
+    def get_dtype(self):
+        """ Return the numpy type of the indices """
+        return self._dtype
+
+    def get_type(self):
+        """ Return the OpenGL type of the indices """
+        if self._dtype.itemsize == 1:
+            return gl.GL_UNSIGNED_BYTE
+        if self._dtype.itemsize == 2:
+            return gl.GL_UNSIGNED_SHORT
+        return gl.GL_UNSIGNED_INT
 
     def get_count(self):
         """ Return the count of the index buffer """
@@ -12,6 +12,15 @@ from light import DirectionalLight
 from model import CompModel
 from model import ModelFromObj, ModelFromMesh
 from mesh import SphereMesh, CubeMesh
+from gl_state import state_cache
+from texture_cache import texture_cache
+from asset_registry import asset_registry
+from lod import lod_selector
+from geometry_arena import geometry_arenas
+from culling import frustum_culler
+from occlusion import occlusion_culler
+from occlusion_query import occlusion_queries
+from pvs import pvs
 
 # global variables for the model settings
 trans = [0, 0, 0]
@@ -195,23 +204,23 @@ def show_lighting_settings(scene):
     
     if skybox_settings_open:
         if imgui.button("Blue clouds"):
-            scene.skybox = SkyBox(scene, "skybox/blue_clouds", extension="jpg")
+            _set_skybox(scene, "skybox/blue_clouds", extension="jpg")
         imgui.same_line()
         
         if imgui.button("Yellow clouds"):
-            scene.skybox = SkyBox(scene, "skybox/yellow_clouds", extension="jpg")
+            _set_skybox(scene, "skybox/yellow_clouds", extension="jpg")
         imgui.same_line()
 
         if imgui.button("Mountains"):
-            scene.skybox = SkyBox(scene, "skybox/ame_ash", extension="bmp")
+            _set_skybox(scene, "skybox/ame_ash", extension="bmp")
 
         if imgui.button("Frozen Dusk"):
-            scene.skybox = SkyBox(scene, "skybox/sb_frozendusk", extension="jpg")
+            _set_skybox(scene, "skybox/sb_frozendusk", extension="jpg")
 
         imgui.same_line()
 
         if imgui.button("Night Sky"):
-            scene.skybox = SkyBox(scene, "skybox/night_sky", extension="png")
+            _set_skybox(scene, "skybox/night_sky", extension="png")
 
     global player_spotlight_settings_open
     player_spotlight_settings_open, _ = imgui.collapsing_header("Player Spotlight")
@@ -340,29 +349,17 @@ def show_scene_settings(scene):
 
         if changed:
             if selected_model_option == 0:
-                scene.models.remove(scene.tank)
-                scene.tank = ModelFromObj(scene, 'tank/tank.obj', shader=scene.tank_shader)
-                scene.models.append(scene.tank)
+                _swap_tank(scene, lambda: ModelFromObj(scene, 'tank/tank.obj', shader=scene.tank_shader))
             if selected_model_option == 1:
-                scene.models.remove(scene.tank)
-                scene.tank = ModelFromObj(scene, 'taxi/taxi.obj', shader=scene.tank_shader)
-                scene.models.append(scene.tank)
+                _swap_tank(scene, lambda: ModelFromObj(scene, 'taxi/taxi.obj', shader=scene.tank_shader))
             if selected_model_option == 2:
-                scene.models.remove(scene.tank)
-                scene.tank = ModelFromObj(scene, 'car_red/car_red.obj', shader=scene.tank_shader)
-                scene.models.append(scene.tank)
+                _swap_tank(scene, lambda: ModelFromObj(scene, 'car_red/car_red.obj', shader=scene.tank_shader))
             if selected_model_option == 3:
-                scene.models.remove(scene.tank)
-                scene.tank = ModelFromObj(scene, 'dyno/dyno.obj', shader=scene.tank_shader)
-                scene.models.append(scene.tank)
+                _swap_tank(scene, lambda: ModelFromObj(scene, 'dyno/dyno.obj', shader=scene.tank_shader))
             if selected_model_option == 4:
-                scene.models.remove(scene.tank)
-                scene.tank = ModelFromMesh(scene, SphereMesh(), shader=scene.tank_shader)
-                scene.models.append(scene.tank)
+                _swap_tank(scene, lambda: ModelFromMesh(scene, SphereMesh(), shader=scene.tank_shader))
             if selected_model_option == 5:
-                scene.models.remove(scene.tank)
-                scene.tank = ModelFromMesh(scene, CubeMesh(), shader=scene.tank_shader)
-                scene.models.append(scene.tank)
+                _swap_tank(scene, lambda: ModelFromMesh(scene, CubeMesh(), shader=scene.tank_shader))
 
             move_model(scene.tank)
 
@@ -378,7 +375,7 @@ def show_scene_settings(scene):
             scene.camera._update_vectors()
 
         if imgui.button("Goto police car"):
-            pos = scene.police_car.shader.matricies[np.random.randint(0, len(scene.police_car.shader.matricies))].get_position()
+            pos = scene.police_car.matricies[np.random.randint(0, len(scene.police_car.matricies))].get_position()
             scene.camera._pos = glm.vec3(pos + [-0.5, 2, 0])
             scene.camera._update_vectors()
 
@@ -433,23 +430,23 @@ def show_scene_settings(scene):
 
         # enable/disable depth testing
         if imgui.button("Enable depth testing"):
-            gl.glEnable(gl.GL_DEPTH_TEST)
+            state_cache.enable(gl.GL_DEPTH_TEST)
 
         imgui.same_line()
 
         if imgui.button("Disable depth testing"):
-            gl.glDisable(gl.GL_DEPTH_TEST)
+            state_cache.disable(gl.GL_DEPTH_TEST)
 
         imgui.separator()
 
         # enable/disable blending
         if imgui.button("Enable blending"):
-            gl.glEnable(gl.GL_BLEND)
+            state_cache.enable(gl.GL_BLEND)
 
         imgui.same_line()
 
         if imgui.button("Disable blending"):
-            gl.glDisable(gl.GL_BLEND)
+            state_cache.disable(gl.GL_BLEND)
 
         imgui.separator()
 
@@ -473,6 +470,45 @@ def show_scene_settings(scene):
         imgui.label_text("models", f"{len(scene.models)}")
         imgui.label_text("point lights", f"{len(scene.lights)}")
         imgui.label_text("spot lights", f"{len(scene.spot_lights)}")
+        imgui.label_text("uniforms skipped", f"{scene.uniform_hits}")
+        imgui.label_text("uniforms uploaded", f"{scene.uniform_misses}")
+        imgui.label_text("state changes skipped", f"{scene.state_hits}")
+        imgui.label_text("state changes issued", f"{scene.state_misses}")
+        imgui.label_text("textures", f"{texture_cache.get_texture_count()} ({texture_cache.get_gpu_bytes() / 2**20:.1f} MB)")
+        imgui.label_text("textures decoded", f"{texture_cache.decoded_bytes / 2**20:.1f} MB")
+        imgui.label_text("textures shared", f"{texture_cache.hits} ({texture_cache.bytes_saved / 2**20:.1f} MB saved)")
+        imgui.label_text("triangles", f"{scene.lod_triangles} of {scene.full_triangles}")
+        _, lod_selector.enabled = imgui.checkbox("level of detail", lod_selector.enabled)
+        _, lod_selector.bias = imgui.slider_float("detail bias", lod_selector.bias, 0.25, 4.0)
+
+        _, frustum_culler.enabled = imgui.checkbox("frustum culling", frustum_culler.enabled)
+        imgui.text("drawn / culled")
+        for name, (drawn, culled) in sorted(scene.cull_counters.items()):
+            imgui.label_text(name, f"{drawn} / {culled}")
+
+        _, occlusion_culler.enabled = imgui.checkbox("occlusion culling", occlusion_culler.enabled)
+        occlusion_rate = scene.occlusion_occluded / scene.occlusion_tested if scene.occlusion_tested else 0.
+        imgui.label_text("occluded", f"{scene.occlusion_occluded} of {scene.occlusion_tested} ({occlusion_rate:.1%})")
+        imgui.label_text("occluder raster", f"{scene.occlusion_time * 1000:.2f} ms")
+
+        _, occlusion_queries.enabled = imgui.checkbox("occlusion queries", occlusion_queries.enabled)
+        _, occlusion_queries.max_queries = imgui.slider_int("queries per frame", occlusion_queries.max_queries, 16, 512)
+        imgui.label_text("queries issued", f"{scene.queries_issued}")
+        imgui.label_text("objects skipped", f"{scene.queries_hidden} ({scene.queries_conditional} conditional draws)")
+
+        _, pvs.enabled = imgui.checkbox("potentially visible sets", pvs.enabled)
+        imgui.label_text("outside the set", f"{scene.pvs_culled} of {scene.pvs_tested}" if pvs.bits is not None else "baking")
+
+        imgui.label_text("arena draw calls", f"{scene.arena_draw_calls} for {scene.arena_draws} meshes")
+        for index, arena in enumerate(geometry_arenas.get_arenas()):
+            stats = arena.get_stats()
+            imgui.label_text(f"arena {index}", f"{stats['allocations']} meshes  {stats['vertices'][0]}/{stats['vertices'][1]} vertices  "
+                             f"{stats['bytes'] / 2**20:.1f} MB  fragmentation {stats['fragmentation']:.0%}  "
+                             f"{stats['frees']} freed, {stats['reused']} reused")
+
+        imgui.text(f"Assets ({asset_registry.hits} shared loads)")
+        for asset in asset_registry.get_assets():
+            imgui.label_text(asset.path, f"refs {asset.refcount}  CPU {asset.get_cpu_bytes() / 2**20:.1f} MB  GPU {asset.get_gpu_bytes() / 2**20:.1f} MB")
 
     global traffic_lights_settings_open
     traffic_lights_settings_open, _ = imgui.collapsing_header("Traffic Lights")
@@ -517,7 +553,7 @@ def show_scene_settings(scene):
                         light.Ia = (0, 1, 0)
 
                 for index, light in enumerate(scene.traffic_light_lights):
-                    tf_pos = scene.traffic_light_shader.offsets[index]
+                    tf_pos = scene.traffic_light.offsets[index]
                     light.position = glm.vec3(tf_pos[0], tf_pos[1], tf_pos[2]) + traffic_light_offset
 
                 changed, traffic_light_offset = imgui.drag_float3("offset", *traffic_light_offset)
@@ -552,6 +588,25 @@ def _light_settings(light):
         changed, light.cutoff = imgui.drag_float("inner cutoff", light.cutoff, 0.01)
         changed, light.outer_cutoff = imgui.drag_float("outer cutoff", light.outer_cutoff, 0.01)
 
+def _swap_tank(scene, create):
+    # the old model gives its asset and textures back, those no longer used beyond the last few are freed
+    queried = getattr(scene.tank, 'query_set', None) is not None
+    scene.models.remove(scene.tank)
+    scene.tank.release()
+    scene.tank = create()
+    scene.models.append(scene.tank)
+    # the new model opts in to occlusion queries when the one it replaces did
+    if queried and isinstance(scene.tank, CompModel):
+        scene.tank.enable_occlusion_queries()
+    asset_registry.swap_done()
+    texture_cache.swap_done()
+
+def _set_skybox(scene, name, extension):
+    # the old skybox gives its cube map back to the texture cache, which keeps the last ones released for a later switch
+    scene.skybox.release()
+    scene.skybox = SkyBox(scene, name, extension=extension)
+    texture_cache.swap_done()
+
 def imgui_model_settings(model, name):
     imgui.begin(f"Model {name}")
     imgui.push_id(str(name))
@@ -0,0 +1,269 @@
+import numpy as np
+
+# Index buffer optimisation: triangles are reordered for the post-transform vertex cache (Forsyth's
+# linear speed algorithm), clusters of triangles are then sorted to draw the outward facing ones first
+# and reduce overdraw, and vertices are renumbered in the order they are first used.
+
+# number of vertices the cache is modelled with when optimising
+CACHE_SIZE = 32
+# number of entries of the FIFO cache ACMR is measured with, close to the caches of current GPUs
+ACMR_CACHE_SIZE = 16
+# how much worse than the cache optimised order (in ACMR) a cluster may get when split for overdraw
+OVERDRAW_THRESHOLD = 1.05
+
+# scoring constants of Forsyth's algorithm
+CACHE_DECAY_POWER = 1.5
+LAST_TRIANGLE_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+
+def acmr(faces, cache_size=ACMR_CACHE_SIZE):
+    '''
+    Returns the average cache miss ratio of a triangle list: the number of vertex shader invocations
+    per triangle with a FIFO post-transform cache. 3 is the worst, 0.5 the limit for large regular meshes.
+    '''
+    faces = np.asarray(faces).reshape(-1)
+    if len(faces) == 0:
+        return 0.0
+
+    cached = {}
+    time = 0
+    for index in faces.tolist():
+        # a vertex is in the cache while fewer than cache_size misses happened since it was loaded
+        loaded = cached.get(index)
+        if loaded is None or time - loaded >= cache_size:
+            cached[index] = time
+            time += 1
+    return time / (len(faces) / 3)
+
+
+def _cache_misses(faces, cache_size):
+    # (F,) number of FIFO cache misses of each triangle
+    cached = {}
+    time = 0
+    misses = []
+    for triangle in faces.tolist():
+        before = time
+        for index in triangle:
+            loaded = cached.get(index)
+            if loaded is None or time - loaded >= cache_size:
+                cached[index] = time
+                time += 1
+        misses.append(time - before)
+    return np.array(misses, dtype=np.int64)
+
+
+def optimize_vertex_cache(faces, vertex_count, cache_size=CACHE_SIZE):
+    '''
+    Reorders triangles for the vertex cache with Tom Forsyth's algorithm: triangles are emitted
+    greedily by the score of their vertices, which favours vertices recently used (still in the
+    cache) and vertices with few triangles left (so that they can leave the cache for good).
+    :param faces: (F, 3) triangle indices
+    :param vertex_count: the number of vertices
+    :return: (F,) the order of the triangles
+    '''
+    faces = np.asarray(faces).reshape(-1, 3)
+    count = len(faces)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # triangles of each vertex
+    flat = faces.reshape(-1)
+    valence = np.bincount(flat, minlength=vertex_count)
+    by_vertex = (np.argsort(flat, kind='stable') // 3).tolist()
+    starts = np.concatenate([[0], np.cumsum(valence)]).tolist()
+    adjacency = [by_vertex[starts[v]:starts[v + 1]] for v in range(vertex_count)]
+
+    max_valence = int(valence.max())
+    position_scores = [LAST_TRIANGLE_SCORE] * 3 + [
+        (1.0 - (p - 3) / (cache_size - 3)) ** CACHE_DECAY_POWER for p in range(3, cache_size)]
+    valence_scores = [0.0] + [VALENCE_BOOST_SCALE * n ** -VALENCE_BOOST_POWER for n in range(1, max_valence + 1)]
+
+    triangles = faces.tolist()
+    remaining = valence.tolist()
+    position = [-1] * vertex_count
+
+    def score(v):
+        if remaining[v] == 0:
+            return -1.0
+        p = position[v]
+        return (position_scores[p] if p >= 0 else 0.0) + valence_scores[remaining[v]]
+
+    vertex_score = [score(v) for v in range(vertex_count)]
+    triangle_score = [vertex_score[a] + vertex_score[b] + vertex_score[c] for a, b, c in triangles]
+    emitted = [False] * count
+
+    order = []
+    cache = []
+    cursor = 0
+    best = max(range(count), key=triangle_score.__getitem__)
+
+    while best >= 0:
+        order.append(best)
+        emitted[best] = True
+        triangle = triangles[best]
+
+        for v in triangle:
+            remaining[v] -= 1
+            adjacency[v].remove(best)
+
+        # the triangle's vertices move to the front of the cache, pushing the oldest out
+        cache = triangle + [v for v in cache if v not in triangle]
+        evicted = cache[cache_size:]
+        cache = cache[:cache_size]
+        for v in evicted:
+            position[v] = -1
+        for p, v in enumerate(cache):
+            position[v] = p
+
+        # only the vertices that moved in the cache change score, and only their triangles with them
+        for v in cache + evicted:
+            vertex_score[v] = score(v)
+
+        best = -1
+        best_score = -1.0
+        for v in cache + evicted:
+            for t in adjacency[v]:
+                a, b, c = triangles[t]
+                s = vertex_score[a] + vertex_score[b] + vertex_score[c]
+                triangle_score[t] = s
+                if s > best_score:
+                    best, best_score = t, s
+
+        if best < 0:
+            # dead end: restart from the next triangle in input order
+            while cursor < count and emitted[cursor]:
+                cursor += 1
+            best = cursor if cursor < count else -1
+
+    return np.array(order, dtype=np.int64)
+
+
+def _clusters(faces, cache_size, threshold):
+    '''
+    Splits a cache optimised triangle order into clusters that can be reordered without costing more
+    than the threshold in ACMR. A cluster ends where the cache was flushed (a triangle with three
+    misses), and is split further wherever the ACMR of the part so far is within the threshold of
+    the ACMR of the whole cluster.
+    :return: (C + 1,) the first triangle of each cluster, then the number of triangles
+    '''
+    misses = _cache_misses(faces, cache_size)
+    triangles = faces.tolist()
+    hard = np.flatnonzero(misses == 3).tolist()
+    if not hard or hard[0] != 0:
+        hard = [0] + hard
+    hard.append(len(faces))
+
+    boundaries = []
+    for start, end in zip(hard[:-1], hard[1:]):
+        if end <= start:
+            continue
+        cluster_threshold = threshold * misses[start:end].sum() / (end - start)
+
+        boundaries.append(start)
+        # the misses of each sub cluster are counted from an empty cache
+        sub_start = start
+        cached = {}
+        time = 0
+        total = 0
+        for i in range(start, end):
+            for index in triangles[i]:
+                loaded = cached.get(index)
+                if loaded is None or time - loaded >= cache_size:
+                    cached[index] = time
+                    time += 1
+                    total += 1
+
+            if i + 1 < end and total / (i + 1 - sub_start) <= cluster_threshold:
+                boundaries.append(i + 1)
+                sub_start = i + 1
+                cached = {}
+                total = 0
+
+    return np.array(boundaries + [len(faces)], dtype=np.int64)
+
+
+def optimize_overdraw(vertices, faces, cache_size=CACHE_SIZE, threshold=OVERDRAW_THRESHOLD):
+    '''
+    Sorts clusters of a cache optimised triangle order so that the clusters facing away from the
+    centre of the mesh are drawn first: they are the most likely to occlude the others, so fewer
+    hidden fragments are shaded.
+    :param vertices: (N, 3) vertex positions
+    :param faces: (F, 3) triangle indices, in cache optimised order
+    :return: (F,) the order of the triangles
+    '''
+    faces = np.asarray(faces).reshape(-1, 3)
+    if len(faces) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    vertices = np.asarray(vertices, dtype=np.float64)
+    corners = vertices[faces]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1)
+    centroids = corners.mean(axis=1)
+    mesh_centroid = (centroids * areas[:, np.newaxis]).sum(axis=0) / max(areas.sum(), 1e-12)
+
+    boundaries = _clusters(faces, cache_size, threshold)
+    cluster = np.repeat(np.arange(len(boundaries) - 1), np.diff(boundaries))
+    count = len(boundaries) - 1
+
+    # area weighted centroid and normal of each cluster
+    weight = np.bincount(cluster, weights=areas, minlength=count)
+    center = np.stack([np.bincount(cluster, weights=centroids[:, i] * areas, minlength=count) for i in range(3)], axis=1)
+    center /= np.maximum(weight, 1e-12)[:, np.newaxis]
+    normal = np.stack([np.bincount(cluster, weights=normals[:, i], minlength=count) for i in range(3)], axis=1)
+    normal /= np.maximum(np.linalg.norm(normal, axis=1), 1e-12)[:, np.newaxis]
+
+    facing = np.einsum('ij,ij->i', center - mesh_centroid, normal)
+    clusters = np.argsort(-facing, kind='stable')
+
+    return np.concatenate([np.arange(boundaries[c], boundaries[c + 1]) for c in clusters])
+
+
+def optimize_vertex_fetch(faces, vertex_count):
+    '''
+    Renumbers the vertices in the order the triangles first use them, so that vertex fetches walk
+    the vertex buffers forward. Vertices used by no triangle are dropped.
+    :return: the renumbered faces, and the (M,) order of the vertices: new vertex i is old vertex order[i]
+    '''
+    faces = np.asarray(faces)
+    used, first = np.unique(faces.reshape(-1), return_index=True)
+    order = used[np.argsort(first, kind='stable')]
+
+    remap = np.full(vertex_count, -1, dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return remap[faces].astype(faces.dtype), order
+
+
+def optimize(vertices, faces, cache_size=CACHE_SIZE, threshold=OVERDRAW_THRESHOLD):
+    '''
+    Runs the vertex cache, overdraw and vertex fetch optimisations on a triangle mesh.
+    :param vertices: (N, 3) vertex positions
+    :param faces: (F, 3) triangle indices
+    :return: the optimised faces, the (M,) order of the vertices (every per-vertex array must be
+             indexed with it), and the ACMR before and after
+    '''
+    faces = np.asarray(faces).reshape(-1, 3)
+    before = acmr(faces)
+
+    faces = faces[optimize_vertex_cache(faces, len(vertices), cache_size)]
+    faces = faces[optimize_overdraw(vertices, faces, cache_size, threshold)]
+    faces, order = optimize_vertex_fetch(faces, len(vertices))
+
+    return faces, order, before, acmr(faces)
+
+
+if __name__ == "__main__":
+    # Report the ACMR of the city models before and after optimisation, and the time taken
+    import sys
+    import time
+    from model_loader import ModelLoader
+
+    paths = sys.argv[1:] or ['tank/tank.obj', 'dyno/dyno.obj', 'car_red/car_red.obj', 'traffic_light/tf.obj', 'buildings_pack1/Building_01.obj']
+    for path in paths:
+        for mesh in ModelLoader().load_model(path, optimize_indices=False, lod_ratios=()):
+            start = time.perf_counter()
+            _, _, before, after = optimize(mesh.vertices, mesh.faces)
+            elapsed = time.perf_counter() - start
+            print(f'{path}: {len(mesh.faces)} triangles, ACMR {before:.3f} -> {after:.3f} in {elapsed * 1000:.1f} ms')
@@ -0,0 +1,314 @@
+import numpy as np
+
+import mesh_kernels
+
+# Level of detail: quadric error metric simplification of meshes into a chain of index buffers over
+# the same vertices, and the selection of a level from the projected size of a model on screen.
+
+# fraction of the triangles of the full mesh kept by each level past the first
+LOD_RATIOS = (0.5, 0.25, 0.1)
+
+# fewest triangles a level past the first may keep, so that small meshes are drawn coarser instead of not at all
+LOD_MIN_TRIANGLES = 4
+
+# projected radius, as a fraction of half the viewport height, below which each level past the first is used
+LOD_SCREEN_SIZES = (0.2, 0.08, 0.03)
+
+# weight of the planes that hold boundaries and attribute seams in place, relative to the surface
+SEAM_WEIGHT = 100.0
+
+
+def weld(vertices):
+    '''
+    Groups vertices sharing a position, as imported meshes split vertices along normal and texture seams.
+    :return: (N,) welded index of each vertex and the number of welded vertices
+    '''
+    _, welded = np.unique(np.asarray(vertices, dtype=np.float32), axis=0, return_inverse=True)
+    welded = welded.reshape(-1)
+    return welded, welded.max() + 1 if len(welded) else 0
+
+
+def plane_quadrics(points, normals, weights):
+    '''
+    Returns the (K, 4, 4) error quadrics of planes through the points with the given unit normals:
+    the squared distance of a homogeneous point p to the plane is p^T Q p.
+    '''
+    planes = np.concatenate([normals, -np.einsum('ij,ij->i', normals, points)[:, np.newaxis]], axis=1).astype(np.float64)
+    return planes[:, :, np.newaxis] * planes[:, np.newaxis, :] * weights[:, np.newaxis, np.newaxis]
+
+
+def _edges(faces):
+    # (3F, 2) directed edges of the faces, and the face each belongs to
+    edges = np.stack([faces, np.roll(faces, -1, axis=1)], axis=2).reshape(-1, 2)
+    return edges, np.repeat(np.arange(len(faces)), 3)
+
+
+def _quadrics(positions, welded_faces, original_faces):
+    '''
+    Accumulates the quadric of each welded vertex: the planes of its faces, weighted by area, plus
+    planes perpendicular to the faces along boundary and seam edges so that they do not move inward.
+    '''
+    count = len(positions)
+    normals = mesh_kernels.face_normals(positions, welded_faces).astype(np.float64)
+    areas = np.linalg.norm(normals, axis=1) / 2
+    normals = mesh_kernels.normalize(normals)
+
+    face_quadrics = plane_quadrics(positions[welded_faces[:, 0]], normals, areas)
+    Q = mesh_kernels.scatter_add(welded_faces.reshape(-1), np.repeat(face_quadrics.reshape(-1, 16), 3, axis=0), count).astype(np.float64)
+
+    # an edge is a seam when it has a single face, or when its faces use different original vertices
+    # along it (split normals or texture coordinates)
+    welded_edges, edge_faces = _edges(welded_faces)
+    original_edges, _ = _edges(original_faces)
+    key = np.sort(welded_edges, axis=1)
+    _, edge_id, uses = np.unique(key, axis=0, return_inverse=True, return_counts=True)
+    edge_id = edge_id.reshape(-1)
+
+    original_key = np.sort(original_edges, axis=1)
+    _, original_id = np.unique(original_key, axis=0, return_inverse=True)
+    original_id = original_id.reshape(-1)
+    # number of distinct original edges per welded edge
+    pairs = np.unique(np.stack([edge_id, original_id], axis=1), axis=0)
+    variants = np.bincount(pairs[:, 0], minlength=len(uses))
+
+    seam = (uses[edge_id] == 1) | (variants[edge_id] > 1)
+    if seam.any():
+        a = positions[welded_edges[seam, 0]]
+        b = positions[welded_edges[seam, 1]]
+        direction = b - a
+        length = np.linalg.norm(direction, axis=1)
+        seam_normals = mesh_kernels.normalize(np.cross(direction, normals[edge_faces[seam]]))
+        seam_quadrics = plane_quadrics(a, seam_normals, SEAM_WEIGHT * length ** 2).reshape(-1, 16)
+        Q += mesh_kernels.scatter_add(welded_edges[seam].reshape(-1), np.repeat(seam_quadrics, 2, axis=0), count)
+
+    return Q.reshape(count, 4, 4)
+
+
+def _collapse_pass(positions, Q, faces, needed, rejected):
+    '''
+    Picks a set of independent edge collapses, each welded vertex takes part in at most one, in
+    order of increasing error, and rejects those that would flip a face.
+    :param rejected: keys (u * W + v) of the edges rejected by earlier passes, which are skipped
+    :return: the (W,) map of each welded vertex to the vertex it collapses onto, and the keys of
+             the edges rejected by this pass
+    '''
+    count = len(positions)
+    edges = np.unique(np.sort(_edges(faces)[0], axis=1), axis=0)
+    mapping = np.arange(count)
+    edges = edges[~np.isin(edges[:, 0] * count + edges[:, 1], rejected)]
+    if len(edges) == 0:
+        return mapping, rejected
+
+    # vertices are kept where they are, so the error of collapsing u onto v is v^T (Qu + Qv) v
+    homogeneous = np.concatenate([positions, np.ones((count, 1))], axis=1)
+    combined = Q[edges[:, 0]] + Q[edges[:, 1]]
+    to_second = np.einsum('ei,eij,ej->e', homogeneous[edges[:, 1]], combined, homogeneous[edges[:, 1]])
+    to_first = np.einsum('ei,eij,ej->e', homogeneous[edges[:, 0]], combined, homogeneous[edges[:, 0]])
+    cost = np.minimum(to_first, to_second)
+    source = np.where(to_second <= to_first, edges[:, 0], edges[:, 1])
+    target = np.where(to_second <= to_first, edges[:, 1], edges[:, 0])
+
+    # an edge is chosen when it is the cheapest edge of both of its vertices
+    rank = np.empty(len(edges), dtype=np.int64)
+    rank[np.argsort(cost, kind='stable')] = np.arange(len(edges))
+    best = np.full(count, len(edges), dtype=np.int64)
+    np.minimum.at(best, edges[:, 0], rank)
+    np.minimum.at(best, edges[:, 1], rank)
+    chosen = np.flatnonzero((best[edges[:, 0]] == rank) & (best[edges[:, 1]] == rank))
+    chosen = chosen[np.argsort(rank[chosen])][:max(needed, 1)]
+
+    mapping[source[chosen]] = target[chosen]
+
+    # reject collapses that turn a remaining face over
+    moved = mapping[faces]
+    changed = (moved != faces).any(axis=1)
+    alive = (moved[:, 0] != moved[:, 1]) & (moved[:, 1] != moved[:, 2]) & (moved[:, 0] != moved[:, 2])
+    check = changed & alive
+    if check.any():
+        before = mesh_kernels.face_normals(positions, faces[check])
+        after = mesh_kernels.face_normals(positions, moved[check])
+        flipped = np.einsum('ij,ij->i', before, after) <= 0.0
+        if flipped.any():
+            vertices = np.unique(faces[check][flipped])
+            undone = chosen[np.isin(source[chosen], vertices)]
+            rejected = np.concatenate([rejected, edges[undone, 0] * count + edges[undone, 1]])
+            mapping[source[undone]] = source[undone]
+
+    return mapping, rejected
+
+
+def _reattach(faces, original_faces, welded, groups, attributes):
+    '''
+    Maps simplified welded faces back to original vertices. Corners whose position did not change
+    keep their vertex, the others take the vertex at their new position with the closest attributes.
+    '''
+    result = original_faces.copy()
+    moved = faces != welded[original_faces]
+    if not moved.any():
+        return result
+
+    order, starts, sizes = groups
+    corners = original_faces[moved]
+    destinations = faces[moved]
+
+    # candidate vertices at each destination position, padded to the largest group
+    width = sizes[destinations].max()
+    offsets = np.arange(width)
+    valid = offsets[np.newaxis, :] < sizes[destinations][:, np.newaxis]
+    candidates = order[np.minimum(starts[destinations][:, np.newaxis] + offsets, len(order) - 1)]
+
+    distance = np.zeros(candidates.shape)
+    for attribute in attributes:
+        distance += ((attribute[candidates] - attribute[corners][:, np.newaxis, :]) ** 2).sum(axis=2)
+    distance[~valid] = np.inf
+
+    result[moved] = candidates[np.arange(len(candidates)), distance.argmin(axis=1)]
+    return result
+
+
+def simplify_chain(vertices, faces, ratios=LOD_RATIOS, normals=None, uvs=None, min_triangles=LOD_MIN_TRIANGLES):
+    '''
+    Simplifies a triangle mesh into a chain of levels of detail by quadric error metric edge
+    collapses. Vertices are never moved or created, every level indexes the vertices of the full
+    mesh so that all levels share its vertex buffers.
+    :param vertices: (N, 3) vertex positions
+    :param faces: (F, 3) triangle indices
+    :param ratios: the fraction of the triangles kept by each level, decreasing
+    :param normals: (optional) (N, 3) normals, used to pick vertices along normal seams
+    :param uvs: (optional) (N, 2) texture coordinates, used to pick vertices along texture seams
+    :param min_triangles: the fewest triangles a level may keep, the chain stops before a level with fewer
+    :return: a list of (F_i, 3) face arrays, one per ratio. Levels that could not be simplified
+             further than the previous one, or only below min_triangles, are left out.
+    '''
+    vertices = np.asarray(vertices, dtype=np.float32)
+    original_faces = np.asarray(faces).reshape(-1, 3).astype(np.int64)
+    attributes = [np.asarray(a, dtype=np.float32) for a in (normals, uvs) if a is not None]
+
+    welded, count = weld(vertices)
+    positions = np.zeros((count, 3), dtype=np.float64)
+    positions[welded] = vertices
+
+    order = np.argsort(welded, kind='stable')
+    sizes = np.bincount(welded, minlength=count)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    current = welded[original_faces]
+    keep = (current[:, 0] != current[:, 1]) & (current[:, 1] != current[:, 2]) & (current[:, 0] != current[:, 2])
+    current, source_faces = current[keep], original_faces[keep]
+    if len(current) == 0:
+        return []
+
+    Q = _quadrics(positions, current, source_faces)
+
+    levels = []
+    rejected = np.zeros(0, dtype=np.int64)
+    for ratio in ratios:
+        target = int(len(original_faces) * ratio)
+        if target < min_triangles:
+            break
+
+        while len(current) > target:
+            previous = len(rejected)
+            mapping, rejected = _collapse_pass(positions, Q, current, (len(current) - target) // 2, rejected)
+            collapsed = mapping != np.arange(count)
+            if not collapsed.any():
+                # retry without the rejected edges while there are new ones
+                if len(rejected) == previous:
+                    break
+                continue
+
+            # the quadric of a collapsed vertex carries over to the vertex it was merged into
+            np.add.at(Q, mapping[collapsed], Q[collapsed])
+
+            current = mapping[current]
+            keep = (current[:, 0] != current[:, 1]) & (current[:, 1] != current[:, 2]) & (current[:, 0] != current[:, 2])
+            current, source_faces = current[keep], source_faces[keep]
+
+        if len(current) < min_triangles or (levels and len(current) >= 0.9 * len(levels[-1])):
+            break
+        if len(current) >= 0.9 * len(original_faces):
+            continue
+
+        levels.append(_reattach(current, source_faces, welded, (order, starts, sizes), attributes).astype(np.uint32))
+
+    return levels
+
+
+class LodSelector:
+    '''
+    Picks the level of detail of models and instances from their projected size on screen, and
+    counts the triangles drawn against the triangles the full meshes would have drawn.
+    '''
+
+    def __init__(self, screen_sizes=LOD_SCREEN_SIZES):
+        """
+        Create the selector.
+        :param screen_sizes: the projected size below which each level past the first is used
+        """
+        self.screen_sizes = np.asarray(screen_sizes, dtype=np.float32)
+        self.enabled = True
+        # multiplies the projected sizes, above 1 keeps the detailed levels further away
+        self.bias = 1.0
+
+        self.triangles_drawn = 0
+        self.triangles_full = 0
+
+    def screen_size(self, camera, centers, radii):
+        """
+        Return the radius of each sphere projected on screen, as a fraction of half the viewport height.
+        The distance to the camera is used rather than the depth so that turning does not change levels.
+        """
+        distance = np.linalg.norm(np.asarray(centers, dtype=np.float32) - np.array(camera.position(), dtype=np.float32), axis=-1)
+        return np.asarray(radii) * camera.projection()[1][1] / np.maximum(distance, 1e-6)
+
+    def select(self, camera, centers, radii):
+        """
+        Return the level of detail of each sphere, 0 being the full mesh.
+        """
+        size = self.screen_size(camera, centers, radii) * self.bias
+        if not self.enabled:
+            return np.zeros(np.shape(size), dtype=np.int64)
+        return (np.asarray(size)[..., np.newaxis] < self.screen_sizes).sum(axis=-1)
+
+    def count(self, drawn, full):
+        """ Record the triangles of one draw call """
+        self.triangles_drawn += drawn
+        self.triangles_full += full
+
+    def reset_counters(self):
+        """ Return the triangle counters of the last frame, then reset them """
+        counters = (self.triangles_drawn, self.triangles_full)
+        self.triangles_drawn = 0
+        self.triangles_full = 0
+        return counters
+
+
+# levels of detail are selected against the same thresholds for every model
+lod_selector = LodSelector()
+
+
+if __name__ == "__main__":
+    # Simplify the models of the city and report the triangles kept and the time taken
+    import sys
+    import time
+
+    # small meshes keep no level with fewer than LOD_MIN_TRIANGLES triangles, rather than an empty one
+    quad = np.array([[0, 0, 0], [1, 0, 0], [1, 0, 1], [0, 0, 1]], dtype=np.float32)
+    grid = np.array([[x, 0, z] for z in range(3) for x in range(3)], dtype=np.float32)
+    grid_faces = np.array([[z * 3 + x, z * 3 + x + 3, z * 3 + x + 1] for z in range(2) for x in range(2)] +
+                          [[z * 3 + x + 1, z * 3 + x + 3, z * 3 + x + 4] for z in range(2) for x in range(2)])
+    for vertices, faces in [(quad, np.array([[0, 2, 1], [0, 3, 2]])), (grid, grid_faces)]:
+        chain = simplify_chain(vertices, faces)
+        assert all(len(level) >= LOD_MIN_TRIANGLES for level in chain), [len(level) for level in chain]
+        print(f'{len(faces)} triangle mesh: ' + ' -> '.join(str(len(level)) for level in [faces] + chain) + ' triangles')
+
+    from model_loader import ModelLoader
+
+    paths = sys.argv[1:] or ['tank/tank.obj', 'dyno/dyno.obj', 'car_red/car_red.obj', 'buildings_pack1/Building_01.obj']
+    for path in paths:
+        for mesh in ModelLoader().load_model(path, lod_ratios=()):
+            start = time.perf_counter()
+            chain = simplify_chain(mesh.vertices, mesh.faces, normals=mesh.normals, uvs=mesh.textureCoords)
+            elapsed = time.perf_counter() - start
+            counts = ' -> '.join(str(len(level)) for level in [mesh.faces] + chain)
+            print(f'{path}: {counts} triangles in {elapsed * 1000:.1f} ms')
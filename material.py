@@ -1,3 +1,5 @@
+import numpy as np
+
 class Material:
     """
     Represents a material used in computer graphics.
@@ -25,4 +27,14 @@ class Material:
         self.map_Ks = map_Ks
         self.map_bump = map_bump
         self.map_Ns = map_Ns
-        self.alpha = 1.0
\ No newline at end of file
+        self.alpha = 1.0
+
+    def get_key(self):
+        """
+        Returns a key equal for materials that bind the same uniforms and textures, so that their
+        draws can be batched together.
+        """
+        # loaded materials hold the shininess as an array, which is neither hashable nor comparable with ==
+        return (tuple(np.ravel(self.Ka).tolist()), tuple(np.ravel(self.Kd).tolist()), tuple(np.ravel(self.Ks).tolist()),
+                tuple(np.ravel(self.Ns).tolist()), float(self.alpha),
+                id(self.map_Kd), id(self.map_Ks), id(self.map_bump), id(self.map_Ns))
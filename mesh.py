@@ -1,11 +1,15 @@
 from material import Material
 import numpy as np
 
+import mesh_kernels
+import primitives
+import bounds
+
 class Mesh:
     '''
     Hold mesh data: vertices, faces, normals, bitangents, tangnets, texture coordinates, and material.
     '''
-    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=None, tangents=None, bitangents=None):
+    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=None, tangents=None, bitangents=None, normal_weighting='area', lods=None, bounding_box=None, bounding_sphere=None):
         '''
         Initialises a mesh object.
         :param vertices: A numpy array of shape (N, 3) containing the vertices of the mesh.
@@ -15,6 +19,10 @@ class Mesh:
         :param material: A material object containing the material properties of the mesh.
         :param tangents (optional): A numpy array of shape (N, 3) containing the tangents of the mesh.
         :param bitangents (optional): A numpy array of shape (N, 3) containing the bitangents of the mesh.
+        :param normal_weighting (optional): 'area' or 'angle', how face normals are weighted when the normals are calculated.
+        :param lods (optional): A list of simplified face arrays indexing the same vertices, one per level of detail past the full mesh.
+        :param bounding_box (optional): The (2, 3) corners of the box around the vertices, computed on first use when not given.
+        :param bounding_sphere (optional): The centre and radius of a sphere around the vertices, computed on first use when not given.
         '''
         self.name = 'Unknown'
         self.vertices = vertices
@@ -25,6 +33,9 @@ class Mesh:
         self.textures = []
         self.tangents = tangents
         self.bitangents = bitangents
+        self.lods = list(lods) if lods is not None else []
+        self._bounding_box = bounding_box
+        self._bounding_sphere = bounding_sphere
 
         if vertices is not None:
             print('Creating mesh')
@@ -39,227 +50,90 @@ class Mesh:
             if faces is None:
                 print('(W) Warning: the current code only calculates normals using the face vector of indices, which was not provided here.')
             else:
-                self.calculate_normals()
+                self.calculate_normals(normal_weighting)
         else:
             self.normals = normals
 
-    def calculate_normals(self):
+    def calculate_normals(self, weighting='area'):
         '''
-        method to calculate normals from the mesh faces.
+        method to calculate normals, and tangents when the mesh has texture coordinates, from the mesh faces.
+        :param weighting: 'area' or 'angle', how the face normals are weighted at each vertex
         '''
+        self.normals = mesh_kernels.vertex_normals(self.vertices, self.faces, weighting)
 
-        # Calculate triangle edges and deltas for vertices and texture coordinates
-        delta_pos1 = self.vertices[self.faces[:, 1]] - self.vertices[self.faces[:, 0]]
-        delta_pos2 = self.vertices[self.faces[:, 2]] - self.vertices[self.faces[:, 0]]
-        delta_uv1 = self.textureCoords[self.faces[:, 1]] - self.textureCoords[self.faces[:, 0]]
-        delta_uv2 = self.textureCoords[self.faces[:, 2]] - self.textureCoords[self.faces[:, 0]]
-
-        # Calculate tangent and bitangent vectors
-        self.face_tangents = np.zeros((len(self.faces), 3))
-        self.face_bitangents = np.zeros((len(self.faces), 3))
-
-        r = 1.0 / (delta_uv1[:, 0] * delta_uv2[:, 1] - delta_uv1[:, 1] * delta_uv2[:, 0])
-
-        self.face_tangents[:, 0] = (delta_pos1[:, 0] * delta_uv2[:, 1] - delta_pos2[:, 0] * delta_uv1[:, 1]) * r
-        self.face_tangents[:, 1] = (delta_pos1[:, 1] * delta_uv2[:, 1] - delta_pos2[:, 1] * delta_uv1[:, 1]) * r
-        self.face_tangents[:, 2] = (delta_pos1[:, 2] * delta_uv2[:, 1] - delta_pos2[:, 2] * delta_uv1[:, 1]) * r
-
-        self.face_bitangents[:, 0] = (delta_pos2[:, 0] * delta_uv1[:, 0] + delta_pos1[:, 0] * -delta_uv2[:, 0]) * r
-        self.face_bitangents[:, 1] = (delta_pos2[:, 1] * delta_uv1[:, 0] + delta_pos1[:, 1] * -delta_uv2[:, 0]) * r
-        self.face_bitangents[:, 2] = (delta_pos2[:, 2] * delta_uv1[:, 0] + delta_pos1[:, 2] * -delta_uv2[:, 0]) * r
-
-        # Calculate normals for each face
-        self.face_normals = np.cross(delta_pos1, delta_pos2)
+        if self.textureCoords is not None:
+            self.tangents, self.bitangents, self.handedness = mesh_kernels.vertex_tangents(
+                self.vertices, self.faces, self.textureCoords, self.normals)
 
-        # Calculate normals for each vertex
-        self.normals = np.zeros((len(self.vertices), 3))
-        self.tangents = np.zeros((len(self.vertices), 3))
-        self.bitangents = np.zeros((len(self.vertices), 3))
-
-        for i in range(len(self.faces)):
-            for j in range(3):
-                self.normals[self.faces[i, j]] += self.face_normals[i]
-                self.tangents[self.faces[i, j]] += self.face_tangents[i]
-                self.bitangents[self.faces[i, j]] += self.face_bitangents[i]
-
-        self.normals /= np.linalg.norm(self.normals, axis=1)[:, np.newaxis]
-        self.tangents /= np.linalg.norm(self.tangents, axis=1)[:, np.newaxis]
-        self.bitangents /= np.linalg.norm(self.bitangents, axis=1)[:, np.newaxis] 
-
-        # convert to float32
-        self.normals= self.normals.astype('f')
-        self.tangents = self.tangents.astype('f')
-        self.bitangents = self.bitangents.astype('f')
-
-class SquareMesh(Mesh):
-
-    def __init__(self, texture=None, inside=True, material=None):
-        vertices = np.array([
-            [-1.0, -1.0, 0.0],  # 0
-            [+1.0, -1.0, 0.0],  # 1
-            [-1.0, +1.0, 0.0],  # 2
-            [+1.0, +1.0, 0.0],  # 3
-        ], dtype='f')
-
-        faces = np.array([
-            [0, 1, 2],
-            [1, 3, 2],
-        ], dtype=np.uint32)
-
-        textureCoords = np.array([
-            [0.0, 0.0],
-            [1.0, 0.0],
-            [0.0, 1.0],
-            [1.0, 1.0]
-        ], dtype='f')
-
-        if not inside:
-            # Reverse the winding order for backface culling
-            faces = faces[:, np.argsort([0, 2, 1])]
-
-        Mesh.__init__(self, vertices=vertices, faces=faces, textureCoords=textureCoords, material=material)
+    def get_bounding_box(self):
+        '''
+        Returns the (2, 3) corners of the box around the vertices, computed on first use.
+        '''
+        if self._bounding_box is None:
+            self._bounding_box = bounds.bounding_box(self.vertices)
+        return self._bounding_box
 
-        if texture is not None:
-            self.textures.append(texture)
+    def get_bounding_sphere(self):
+        '''
+        Returns the centre and radius of a sphere around the vertices, computed on first use.
+        '''
+        if self._bounding_sphere is None:
+            self._bounding_sphere = bounds.bounding_sphere(self.vertices)
+        return self._bounding_sphere
 
-class CubeMesh(Mesh):
-    def __init__(self, texture=None, inside=True, material=None):
-        
-        # vertices, normals, texture coords
-        vertices = np.array([
-            [-1.0, -1.0, -1.0,  0.0,  0.0, -1.0, 0.0, 0.0,],
-            [ 1.0,  1.0, -1.0,  0.0,  0.0, -1.0, 1.0, 1.0,],
-            [ 1.0, -1.0, -1.0,  0.0,  0.0, -1.0, 1.0, 0.0,],
-            [ 1.0,  1.0, -1.0,  0.0,  0.0, -1.0, 1.0, 1.0,],
-            [-1.0, -1.0, -1.0,  0.0,  0.0, -1.0, 0.0, 0.0,],
-            [-1.0,  1.0, -1.0,  0.0,  0.0, -1.0, 0.0, 1.0,],
-            [-1.0, -1.0,  1.0,  0.0,  0.0,  1.0, 0.0, 0.0,],
-            [ 1.0, -1.0,  1.0,  0.0,  0.0,  1.0, 1.0, 0.0,],
-            [ 1.0,  1.0,  1.0,  0.0,  0.0,  1.0, 1.0, 1.0,],
-            [ 1.0,  1.0,  1.0,  0.0,  0.0,  1.0, 1.0, 1.0,],
-            [-1.0,  1.0,  1.0,  0.0,  0.0,  1.0, 0.0, 1.0,],
-            [-1.0, -1.0,  1.0,  0.0,  0.0,  1.0, 0.0, 0.0,],
-            [-1.0,  1.0,  1.0, -1.0,  0.0,  0.0, 1.0, 0.0,],
-            [-1.0,  1.0, -1.0, -1.0,  0.0,  0.0, 1.0, 1.0,],
-            [-1.0, -1.0, -1.0, -1.0,  0.0,  0.0, 0.0, 1.0,],
-            [-1.0, -1.0, -1.0, -1.0,  0.0,  0.0, 0.0, 1.0,],
-            [-1.0, -1.0,  1.0, -1.0,  0.0,  0.0, 0.0, 0.0,],
-            [-1.0,  1.0,  1.0, -1.0,  0.0,  0.0, 1.0, 0.0,],
-            [ 1.0,  1.0,  1.0,  1.0,  0.0,  0.0, 1.0, 0.0,],
-            [ 1.0, -1.0, -1.0,  1.0,  0.0,  0.0, 0.0, 1.0,],
-            [ 1.0,  1.0, -1.0,  1.0,  0.0,  0.0, 1.0, 1.0,],
-            [ 1.0, -1.0, -1.0,  1.0,  0.0,  0.0, 0.0, 1.0,],
-            [ 1.0,  1.0,  1.0,  1.0,  0.0,  0.0, 1.0, 0.0,],
-            [ 1.0, -1.0,  1.0,  1.0,  0.0,  0.0, 0.0, 0.0,],
-            [-1.0, -1.0, -1.0,  0.0, -1.0,  0.0, 0.0, 1.0,],
-            [ 1.0, -1.0, -1.0,  0.0, -1.0,  0.0, 1.0, 1.0,],
-            [ 1.0, -1.0,  1.0,  0.0, -1.0,  0.0, 1.0, 0.0,],
-            [ 1.0, -1.0,  1.0,  0.0, -1.0,  0.0, 1.0, 0.0,],
-            [-1.0, -1.0,  1.0,  0.0, -1.0,  0.0, 0.0, 0.0,],
-            [-1.0, -1.0, -1.0,  0.0, -1.0,  0.0, 0.0, 1.0,],
-            [-1.0,  1.0, -1.0,  0.0,  1.0,  0.0, 0.0, 1.0,],
-            [ 1.0,  1.0 , 1.0,  0.0,  1.0,  0.0, 1.0, 0.0,],
-            [ 1.0,  1.0, -1.0,  0.0,  1.0,  0.0, 1.0, 1.0,],
-            [ 1.0,  1.0,  1.0,  0.0,  1.0,  0.0, 1.0, 0.0,],
-            [-1.0,  1.0, -1.0,  0.0,  1.0,  0.0, 0.0, 1.0,],
-            [-1.0,  1.0,  1.0,  0.0,  1.0,  0.0, 0.0, 0.0 ],
-        ], dtype='f')
+    def invalidate_bounds(self):
+        '''
+        Drops the bounds, call after moving the vertices so that they are computed again.
+        '''
+        self._bounding_box = None
+        self._bounding_sphere = None
 
-        pos = vertices[:, :3].reshape((36, 3))
-        normals = vertices[:, 3:6].reshape((36, 3))
-        textureCoords = vertices[:, 6:].reshape((36, 2))
+class PrimitiveMesh(Mesh):
+    '''
+    Mesh of a procedural primitive. The arrays come from the primitives cache and are shared, read
+    only, between every mesh of the same primitive and resolution.
+    '''
+    def __init__(self, primitive, *resolution, inside=True, material=None, texture=None):
+        arrays = primitives.get(primitive, *resolution, inside=inside)
 
-        Mesh.__init__(self, vertices=pos, textureCoords=textureCoords, normals=normals, material=material)
+        Mesh.__init__(self,
+                      vertices=arrays['vertices'],
+                      faces=arrays['faces'],
+                      normals=arrays['normals'],
+                      textureCoords=arrays['textureCoords'],
+                      tangents=arrays['tangents'],
+                      bitangents=arrays['bitangents'],
+                      material=material
+                      )
 
         if texture is not None:
             self.textures = [
                 texture
             ]
 
+class SquareMesh(PrimitiveMesh):
 
-class SphereMesh(Mesh):
-
-    def __init__(self, nvert=50, nhoriz=100, material=Material(Ka=[0.5,0.5,0.5], Kd=[0.6,0.6,0.9], Ks=[1.,1.,0.9], Ns=15.0), texture=None):
-        n = (nvert-1)*nhoriz+2
-        vertices = np.zeros((n, 3), 'f')
-        vertex_colors = np.zeros((n, 3), 'f')
-
-        vslice = np.pi/nvert
-        hslice = 2.*np.pi/nhoriz
-        vertices[0,:] = [0., 1., 0.]
-        vertices[-1, :] = [0., -1., 0.]
-
-        # texture coordinates
-        textureCoords = np.zeros((n, 2), 'f')
-
-        # start by creating vertices
-        for i in range(nvert-1):
-            y = np.cos((i+1) * vslice)
-            r = np.sin((i+1) * vslice)
-            for j in range(nhoriz):
-                v = 1+i*nhoriz+j
-                vertices[v, 0] = r * np.cos(j*hslice)
-                vertices[v, 1] = y
-                vertices[v, 2] = r * np.sin(j*hslice)
-                vertex_colors[v, 0] = float(i) / float(nvert)
-                vertex_colors[v, 1] = float(j) / float(nhoriz)
-                textureCoords[v, 1] = float(i) / float(nvert)
-                textureCoords[v, 0] = float(j) / float(nhoriz)
+    def __init__(self, texture=None, inside=True, material=None):
+        PrimitiveMesh.__init__(self, 'plane', inside=inside, material=material, texture=texture)
 
-        nfaces = nhoriz*2 + (nvert-2)*(nhoriz)*2
-        indices = np.zeros((nfaces, 3), dtype=np.uint32)
-        k = 0
+class CubeMesh(PrimitiveMesh):
+    def __init__(self, texture=None, inside=True, material=None):
+        PrimitiveMesh.__init__(self, 'cube', inside=inside, material=material, texture=texture)
 
-        for i in range(nhoriz-1):
 
-            # top
-            indices[k, 0] = 0
-            indices[k, 2] = i + 1
-            indices[k, 1] = i + 2
-            k+=1
+class SphereMesh(PrimitiveMesh):
 
-            # bottom
-            lastrow = n - nhoriz - 2
-            indices[k, 0] = lastrow + i + 2
-            indices[k, 2] = lastrow + i + 1
-            indices[k, 1] = n-1
-            k+=1
+    def __init__(self, nvert=50, nhoriz=100, material=Material(Ka=[0.5,0.5,0.5], Kd=[0.6,0.6,0.9], Ks=[1.,1.,0.9], Ns=15.0), texture=None):
+        PrimitiveMesh.__init__(self, 'sphere', nvert, nhoriz, material=material, texture=texture)
 
-        # last triangle at the top
-        indices[k, :] = [0, 1, nhoriz]
 
-        # last triangle at the bottom
-        indices[k + 1, :] = [lastrow + 1, n - 1, n-2]
-        k+=2
+class CylinderMesh(PrimitiveMesh):
 
-        for j in range(1, nvert-1):
-            for i in range(nhoriz-1):
-                lastrow = nhoriz*(j-1)+1
-                row = nhoriz*j+1
-                indices[k, 0] = row + i
-                indices[k, 2] = row + i + 1
-                indices[k, 1] = lastrow + i
-                k += 1
+    def __init__(self, segments=32, inside=True, material=None, texture=None):
+        PrimitiveMesh.__init__(self, 'cylinder', segments, inside=inside, material=material, texture=texture)
 
-                indices[k, 0] = row + i + 1
-                indices[k, 2] = lastrow + i + 1
-                indices[k, 1] = lastrow + i
-                k += 1
 
-            # last two triangles on this row
-            indices[k, :] = [row + nhoriz - 1, lastrow + nhoriz - 1, row]
-            k += 1
-            indices[k, :] = [row, lastrow + nhoriz - 1, lastrow]
-            k += 1
+class GridMesh(PrimitiveMesh):
 
-        Mesh.__init__(self,
-                      vertices=vertices,
-                      faces=indices,
-                      textureCoords=textureCoords,
-                      material=material
-                      )
-
-        if texture is not None:
-            self.textures = [
-                texture
-            ]
\ No newline at end of file
+    def __init__(self, nx=10, nz=10, inside=True, material=None, texture=None):
+        PrimitiveMesh.__init__(self, 'grid', nx, nz, inside=inside, material=material, texture=texture)
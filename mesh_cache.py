@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+class MeshCache:
+    '''
+    Content addressed on-disk cache of imported meshes. Each entry is a raw binary file holding
+    every array of every mesh of a model, plus a json header with their offsets, shapes, dtypes
+    and the material properties. Entries are memory mapped on load, so the arrays handed out are
+    views of the file and nothing is copied or parsed.
+    '''
+
+    # bump when the layout of the entries, or how their contents are built, changes
+    VERSION = 2
+    ALIGNMENT = 16
+
+    def __init__(self, directory='.cache/meshes'):
+        """
+        Create the cache.
+        :param directory: the directory the entries are stored in
+        """
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path, flags):
+        """
+        Return the key of a model: a hash of the obj file, the mtl files it uses and the processing flags.
+        :param path: the path of the obj file
+        :param flags: a dict of the processing options the model is imported with
+        """
+        h = hashlib.sha256()
+        h.update('v{}'.format(self.VERSION).encode())
+
+        with open(path, 'rb') as file:
+            obj = file.read()
+        h.update(obj)
+
+        # material libraries are referenced relative to the obj file
+        directory = os.path.dirname(path)
+        for mtllib in re.findall(rb'^\s*mtllib\s+(.+?)\s*$', obj, flags=re.MULTILINE):
+            mtl_path = os.path.join(directory, mtllib.decode(errors='replace'))
+            h.update(b'\0mtl\0')
+            if os.path.exists(mtl_path):
+                with open(mtl_path, 'rb') as file:
+                    h.update(file.read())
+
+        h.update(json.dumps(flags, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.bin', base + '.json'
+
+    def load(self, key):
+        """
+        Return the mesh records stored under the key, or None on a miss. A record is a dict with an
+        'arrays' dict (name -> memory mapped array or None) and a 'material' dict.
+        """
+        data_path, header_path = self._paths(key)
+        if not (os.path.exists(data_path) and os.path.exists(header_path)):
+            self.misses += 1
+            return None
+
+        with open(header_path, 'r') as file:
+            header = json.load(file)
+
+        if header.get('version') != self.VERSION:
+            self.misses += 1
+            return None
+
+        # copy on write, so a mesh modified in place never touches the file
+        data = np.memmap(data_path, dtype=np.uint8, mode='c') if os.path.getsize(data_path) > 0 else None
+
+        records = []
+        for mesh in header['meshes']:
+            arrays = {}
+            for name, entry in mesh['arrays'].items():
+                if entry is None:
+                    arrays[name] = None
+                    continue
+                dtype = np.dtype(entry['dtype'])
+                count = int(np.prod(entry['shape']))
+                arrays[name] = np.frombuffer(data, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+            records.append({'arrays': arrays, 'material': mesh['material']})
+
+        self.hits += 1
+        return records
+
+    def store(self, key, records):
+        """
+        Write the mesh records of a model under the key.
+        :param records: a list of dicts with an 'arrays' dict (name -> array or None) and a json
+                        serialisable 'material' dict
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        data_path, header_path = self._paths(key)
+
+        header = {'version': self.VERSION, 'meshes': []}
+        offset = 0
+
+        # write to temporary files first so a crash never leaves a half written entry behind
+        with open(data_path + '.tmp', 'wb') as file:
+            for record in records:
+                entries = {}
+                for name, array in record['arrays'].items():
+                    if array is None:
+                        entries[name] = None
+                        continue
+
+                    array = np.ascontiguousarray(array)
+                    padding = -offset % self.ALIGNMENT
+                    file.write(b'\0' * padding)
+                    offset += padding
+
+                    entries[name] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+                    file.write(array.tobytes())
+                    offset += array.nbytes
+
+                header['meshes'].append({'arrays': entries, 'material': record['material']})
+
+        with open(header_path + '.tmp', 'w') as file:
+            json.dump(header, file)
+
+        os.replace(data_path + '.tmp', data_path)
+        os.replace(header_path + '.tmp', header_path)
+
+
+# meshes are cached for every model loader of the application
+mesh_cache = MeshCache()
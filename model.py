@@ -1,16 +1,28 @@
 import OpenGL.GL as gl
 from transform import TransformMatrix
 from vao import VertexArray
-from vbo import VertexBuffer, BufferLayout, BufferElement, BufferType
+from vbo import VertexBuffer, InstanceBuffer, InterleavedBuffer, BufferLayout, BufferElement, BufferType
 from ibo import IndexBuffer
-from texture import Texture
+from texture_cache import texture_cache
 from shaders import PhongShader
-from model_loader import ModelLoader
+from asset_registry import asset_registry
+from lod import lod_selector
+from bounds import merge_boxes, merge_spheres, transform_boxes, transform_spheres
+from geometry_arena import geometry_arenas
+from culling import frustum_culler
+from occlusion import occlusion_culler
+from occlusion_query import occlusion_queries
+from pvs import pvs
+from spatial_index import SpatialIndex
+import vertex_format
 import numpy as np
+import ctypes
 
 class BaseModel():
+    # pack the vertex attributes of every model into one interleaved buffer unless told otherwise
+    INTERLEAVED = False
 
-    def __init__(self, scene, mesh=None, primative=gl.GL_TRIANGLES, visable=True):
+    def __init__(self, scene, mesh=None, primative=gl.GL_TRIANGLES, visable=True, geometry=None, compact=False, interleaved=None, arena=False):
         """
         Initializes a Model object.
 
@@ -19,6 +31,10 @@ class BaseModel():
             mesh (Mesh, optional): The mesh object associated with the model. Defaults to None.
             primative (int, optional): The primitive type used for rendering. Defaults to gl.GL_TRIANGLES.
             visable (bool, optional): Determines if the model is visible or not. Defaults to True.
+            geometry (Geometry, optional): Buffers shared with other models drawing the same mesh. Defaults to None.
+            compact (bool, optional): Upload the vertices in the compact quantized layout of vertex_format. Defaults to False.
+            interleaved (bool, optional): Upload the vertices as one interleaved buffer. Defaults to BaseModel.INTERLEAVED.
+            arena (bool, optional): Copy the mesh into the geometry arena of its vertex format instead of buffers of its own. Defaults to False.
         """
         self.visable = visable
         self.scene = scene
@@ -31,6 +47,22 @@ class BaseModel():
         self.ibo = None
         self.vbos = {}
         self.attributes = {}
+        self.geometry = geometry
+        # textures this model took from the texture cache
+        self.acquired_textures = []
+        # (byte offset, index count) of each level of detail in the index buffer, and the level drawn
+        self.lod_ranges = []
+        self.lod_level = 0
+        self.compact = compact
+        self.interleaved = BaseModel.INTERLEAVED if interleaved is None else interleaved
+        self.arena = arena
+        # vertices and indices of the mesh in a geometry arena, when drawn from one
+        self.allocation = None
+        # bounds in the space of the parent model, and the version of M they were computed for
+        self._bounds = None
+        self._bounds_version = None
+        # matrix decoding quantized positions, applied after the model matrix
+        self.decode_matrix = None
 
     def bind_shader(self, shader):
         if self.shader is None or self.shader.name is not shader:
@@ -51,76 +83,192 @@ class BaseModel():
         if self.mesh.vertices is None:
             print("Warning - binding mesh with no vertices")
 
-        self.init_vbo('position', self.mesh.vertices)
-        self.init_vbo('normal', self.mesh.normals)
-        self.init_vbo('color', self.mesh.colors)
-        self.init_vbo('texCoord', self.mesh.textureCoords)
-        self.init_vbo('tangent', self.mesh.tangents)
-        self.init_vbo('bitangent', self.mesh.bitangents)
-
-        if self.mesh.material.map_Kd is not None:
-            if isinstance(self.mesh.material.map_Kd, str):
-                self.mesh.material.map_Kd = Texture(self.mesh.material.map_Kd)
-        
-        if self.mesh.material.map_Ks is not None:
-            if isinstance(self.mesh.material.map_Ks, str):
-                self.mesh.material.map_Ks = Texture(self.mesh.material.map_Ks)
-
-        if self.mesh.material.map_bump is not None:
-            if isinstance(self.mesh.material.map_bump, str):
-                self.mesh.material.map_bump = Texture(self.mesh.material.map_bump)
-
-        if self.mesh.material.map_Ns is not None:
-            if isinstance(self.mesh.material.map_Ns, str):
-                self.mesh.material.map_Ns = Texture(self.mesh.material.map_Ns)
+        streams = self.get_vertex_streams()
+        if self.arena and self.mesh.faces is not None:
+            self.init_arena(streams)
+        elif self.interleaved:
+            self.init_interleaved(streams)
+        else:
+            for name, data, buffer_type, normalized in streams:
+                self.init_vbo(name, data, buffer_type, normalized)
 
-        if self.mesh.textures is not None:
-            for texture in self.mesh.textures:
-                if isinstance(texture, str):
-                    texture = Texture(texture)
+        # textures are shared with every other model using the same file
+        material = self.mesh.material
+        if material.map_Kd is not None:
+            material.map_Kd = self.acquire_texture(material.map_Kd)
 
-        if self.mesh.faces is not None:
-            self.ibo = IndexBuffer(self.mesh.faces)
+        if material.map_Ks is not None:
+            material.map_Ks = self.acquire_texture(material.map_Ks)
+
+        if material.map_bump is not None:
+            material.map_bump = self.acquire_texture(material.map_bump)
+
+        if material.map_Ns is not None:
+            material.map_Ns = self.acquire_texture(material.map_Ns)
+
+        if self.mesh.textures is not None:
+            for index, texture in enumerate(self.mesh.textures):
+                self.mesh.textures[index] = self.acquire_texture(texture)
+
+        if self.mesh.faces is not None and self.allocation is None:
+            # the levels of detail are stored one after the other in the same index buffer
+            levels = [self.mesh.faces] + self.mesh.lods
+            # 16 bit indices when the mesh has few enough vertices
+            index_type = vertex_format.index_dtype(len(self.mesh.vertices))
+            indices = np.concatenate([level.reshape(-1) for level in levels]).astype(index_type, copy=False)
+
+            offset = 0
+            self.lod_ranges = []
+            for level in levels:
+                self.lod_ranges.append((offset * indices.itemsize, level.size))
+                offset += level.size
+
+            if self.geometry is not None:
+                self.ibo = self.geometry.index_buffer(indices)
+            else:
+                self.ibo = IndexBuffer(indices)
             self.vao.set_index_buffer(self.ibo)
 
         self.vao.unbind()
 
+    def acquire_texture(self, texture):
+        # a path is loaded through the cache, a texture already taken from the cache (e.g. by another
+        # model sharing the mesh) gains a reference, other textures are left alone
+        if isinstance(texture, str):
+            texture = texture_cache.texture(texture)
+        elif not texture_cache.retain(texture):
+            return texture
+
+        self.acquired_textures.append(texture)
+        return texture
+
+    def release(self):
+        """
+        Releases the textures of the model back to the texture cache, call when the model is discarded.
+        """
+        for texture in self.acquired_textures:
+            texture_cache.release(texture)
+        self.acquired_textures = []
+
+        # allocations of shared geometry are freed with their asset
+        if self.allocation is not None and self.geometry is None:
+            self.allocation.arena.free(self.allocation)
+        self.allocation = None
+
     def update(self):
         self.vao.bind()
 
-        self.update_vbo('position', self.mesh.vertices)
-        self.update_vbo('normal', self.mesh.normals)
-        self.update_vbo('color', self.mesh.colors)
-        self.update_vbo('texCoord', self.mesh.textureCoords)
-        self.update_vbo('tangent', self.mesh.tangents)
-        self.update_vbo('bitangent', self.mesh.bitangents)
+        # the vertices may have moved
+        self.mesh.invalidate_bounds()
+        self._bounds_version = None
+
+        streams = self.get_vertex_streams()
+        if self.allocation is not None:
+            self.allocation.arena.write_vertices(self.allocation, {name: data for name, data, _ in self.get_vertex_elements(streams)})
+        elif self.interleaved:
+            # only the vertices whose attributes changed are uploaded again
+            self.vbos['interleaved'].update_attributes({name: self.as_float32(data, buffer_type) for name, data, buffer_type, _ in streams})
+        else:
+            for name, data, buffer_type, normalized in streams:
+                self.update_vbo(name, data, buffer_type, normalized)
+
+    def get_vertex_streams(self):
+        """
+        Returns the (name, data, buffer type, normalized) of each vertex attribute of the mesh. The
+        buffer type is None for float attributes, whose type follows from their width.
+        """
+        if self.compact:
+            # the shaders only read the tangent, so the bitangent is not uploaded
+            streams, self.decode_matrix = vertex_format.compact_streams(self.mesh)
+            return [(name, data, buffer_type, normalized) for name, (data, buffer_type, normalized) in streams.items()]
+
+        attributes = [
+            ('position', self.mesh.vertices),
+            ('normal', self.mesh.normals),
+            ('color', self.mesh.colors),
+            ('texCoord', self.mesh.textureCoords),
+            ('tangent', self.mesh.tangents),
+            ('bitangent', self.mesh.bitangents),
+        ]
+        return [(name, data, None, False) for name, data in attributes if data is not None]
+
+    @staticmethod
+    def as_float32(data, buffer_type):
+        # interleaved float attributes are packed as 32 bit floats whatever the mesh arrays hold
+        return np.asarray(data, dtype=np.float32) if buffer_type is None else data
+
+    def get_vertex_elements(self, streams):
+        """
+        Returns the (name, data, BufferElement) of each vertex stream, for buffers interleaving them.
+        """
+        elements = []
+        for name, data, buffer_type, normalized in streams:
+            data = self.as_float32(data, buffer_type)
+            if buffer_type is None:
+                buffer_type = vertex_format.float_buffer_type(data.shape[1])
+            elements.append((name, data, BufferElement(buffer_type, normalized=normalized)))
+        return elements
+
+    def init_interleaved(self, streams):
+        """
+        Packs every vertex attribute into one interleaved vertex buffer.
+        """
+        elements = self.get_vertex_elements(streams)
+
+        if self.geometry is not None:
+            buffer = self.geometry.interleaved_buffer('interleaved:compact' if self.compact else 'interleaved', elements)
+        else:
+            buffer = InterleavedBuffer(elements)
+        self.vbos['interleaved'] = buffer
+
+        # each element takes one attribute location, in layout order
+        for location, name in enumerate(buffer.get_names(), start=self.vao._index_count):
+            self.attributes[name] = location
+        self.vao.add_vertex_buffer(buffer)
+
+    def init_arena(self, streams):
+        """
+        Copies the vertices and every level of detail of the mesh into the geometry arena of its vertex
+        format, and draws from the arena's vertex array.
+        """
+        elements = self.get_vertex_elements(streams)
+        layout = [(name, element) for name, _, element in elements]
+        data = {name: data for name, data, _ in elements}
+        levels = [self.mesh.faces] + self.mesh.lods
+        # indices are local to the mesh, so small meshes keep 16 bit indices
+        index_type = vertex_format.index_dtype(len(self.mesh.vertices))
+
+        if self.geometry is not None:
+            self.allocation = self.geometry.arena_allocation('arena:compact' if self.compact else 'arena', layout, data, levels, index_type)
+        else:
+            self.allocation = geometry_arenas.arena(layout, index_type).allocate(data, levels)
 
+        self.vao = self.allocation.arena.vao
+        self.attributes.update(self.allocation.arena.get_attribute_locations())
+        self.lod_ranges = self.allocation.lod_ranges
 
-    def update_vbo(self, name, data):
+    def update_vbo(self, name, data, buffer_type=None, normalized=False):
         if name in self.vbos:
             self.vbos[name].update(data)
         else:
-            self.init_vbo(name, data)
+            self.init_vbo(name, data, buffer_type, normalized)
 
-    def init_vbo(self, name, data):
+    def init_vbo(self, name, data, buffer_type=None, normalized=False):
 
         if data is None:
             return
 
-        if data.shape[1] == 1:
-            buffer_type = BufferType.FLOAT_1
-        elif data.shape[1] == 2:
-            buffer_type = BufferType.FLOAT_2
-        elif data.shape[1] == 3:
-            buffer_type = BufferType.FLOAT_3
-        elif data.shape[1] == 4:
-            buffer_type = BufferType.FLOAT_4
-        else:
-            buffer_type = BufferType.FLOAT_3
+        # float streams get their type from their width
+        if buffer_type is None:
+            buffer_type = vertex_format.float_buffer_type(data.shape[1])
 
-        self.vbos[name] = VertexBuffer(data)
+        if self.geometry is not None:
+            # compact and float streams of the same mesh are different buffers
+            self.vbos[name] = self.geometry.vertex_buffer(name + ':compact' if self.compact else name, data)
+        else:
+            self.vbos[name] = VertexBuffer(data)
         self.vbos[name].set_layout(BufferLayout([
-            BufferElement(buffer_type)
+            BufferElement(buffer_type, normalized=normalized)
         ]))
 
         self.attributes[name] = self.vao._index_count
@@ -131,55 +279,169 @@ class BaseModel():
 
             self.vao.bind()
 
-            if M == TransformMatrix():
-                self.shader.bind(
-                    model=self,
-                    M=np.array(self.M.get_transform())
-                )
-            else:
-                self.shader.bind(
-                    model=self,
-                    M=np.matmul(np.array(M.get_transform()), np.array(self.M.get_transform()))
-                )
+            self.shader.bind(
+                model=self,
+                M=self.get_model_matrix(M)
+            )
 
-            if self.ibo is None:
+            if self.allocation is not None:
+                count = self.allocation.arena.draw(self.primative, self.allocation, self.lod_level)
+                lod_selector.count(count // 3, self.lod_ranges[0][1] // 3)
+                geometry_arenas.count(1)
+            elif self.ibo is None:
                 gl.glDrawArrays(self.primative, 0, self.mesh.vertices.shape[0])
             else:
-                gl.glDrawElements(self.primative, self.mesh.faces.flatten().shape[0], gl.GL_UNSIGNED_INT, None)
+                offset, count = self.get_lod_range(self.lod_level)
+                gl.glDrawElements(self.primative, count, self.ibo.get_type(), ctypes.c_void_p(offset))
+                lod_selector.count(count // 3, self.lod_ranges[0][1] // 3)
 
-            self.vao.unbind()
+    def get_model_matrix(self, M=TransformMatrix()):
+        """
+        Returns the model matrix the shader is bound with, under the transform of the parent model.
+        """
+        if M == TransformMatrix():
+            return self.decode(np.array(self.M.get_transform()))
+        return self.decode(np.matmul(np.array(M.get_transform()), np.array(self.M.get_transform())))
+
+    def get_batch_key(self):
+        """
+        Returns a key equal for arena models that can be drawn in one multi-draw call: same arena,
+        shader, transform, material and textures. None when the model is not drawn from an arena.
+        """
+        if self.allocation is None or self.shader is None:
+            return None
+        decode = self.decode_matrix.tobytes() if self.decode_matrix is not None else None
+        return (id(self.allocation.arena), id(self.shader), self.primative, np.array(self.M.get_transform()).tobytes(), decode,
+                self.mesh.material.get_key(), tuple(id(texture) for texture in self.mesh.textures))
+
+    def decode(self, M):
+        """
+        Returns the model matrix the shader is bound with: compact positions are decoded by it.
+        """
+        if self.decode_matrix is None:
+            return M
+        return np.matmul(M, self.decode_matrix)
+
+    def get_lod_range(self, level):
+        """
+        Returns the (byte offset, index count) of a level of detail in the index buffer, the coarsest
+        level of the mesh is used for levels past it.
+        """
+        return self.lod_ranges[min(level, len(self.lod_ranges) - 1)]
+
+    def get_bounds(self):
+        """
+        Returns the (2, 3) box and the (centre, radius) sphere around the mesh, in the space of the
+        parent model. They are derived from the bounds of the mesh again only when M changed.
+        """
+        if self._bounds_version != self.M.version:
+            M = np.array(self.M.get_transform(), dtype=np.float32)[np.newaxis]
+            centers, radii = transform_spheres(self.mesh.get_bounding_sphere(), M)
+            self._bounds = (transform_boxes(self.mesh.get_bounding_box(), M)[0], (centers[0], float(radii[0])))
+            self._bounds_version = self.M.version
+        return self._bounds
+
+    def get_bounding_box(self):
+        """
+        Returns the (2, 3) corners of the box around the model, in the space of the parent model.
+        """
+        return self.get_bounds()[0]
+
+    def get_bounding_sphere(self):
+        """
+        Returns the centre and radius of a sphere around the model, in the space of the parent model.
+        """
+        return self.get_bounds()[1]
 
 class InstancedModel(BaseModel):
 
-    def __init__(self, scene, num_instances, mesh=None, primative=gl.GL_TRIANGLES, visable=True):
+    # instance attributes are bound past the per-vertex attributes so every submesh agrees on the location
+    INSTANCE_ATTRIBUTE_LOCATION = 8
+
+    def __init__(self, scene, num_instances, mesh=None, primative=gl.GL_TRIANGLES, visable=True, instance_buffer=None, instance_attribute=None, geometry=None, compact=False, interleaved=None):
         self.num_instances = num_instances
-        BaseModel.__init__(self, scene=scene, mesh=mesh, primative=primative, visable=visable)
+        self.instance_buffer = instance_buffer
+        self.instance_attribute = instance_attribute
+        # first instance of each level of detail, set by the parent model when it sorts its instances by level
+        self.instance_boundaries = None
+        self.first_instance = 0
+        BaseModel.__init__(self, scene=scene, mesh=mesh, primative=primative, visable=visable, geometry=geometry, compact=compact, interleaved=interleaved)
+
+    def bind(self):
+        BaseModel.bind(self)
+
+        if self.instance_buffer is not None:
+            # the per-vertex attributes must all sit below the instance attribute, or they would share a location
+            used = max(self.attributes.values(), default=-1)
+            if used >= self.INSTANCE_ATTRIBUTE_LOCATION:
+                raise ValueError('(E) Error: vertex attribute location {} of {} clashes with instance attribute location {}'.format(
+                    used, self.name, self.INSTANCE_ATTRIBUTE_LOCATION))
+
+            # the instance buffer is owned by the parent model and shared by all of its submeshes
+            self.attributes[self.instance_attribute] = self.INSTANCE_ATTRIBUTE_LOCATION
+            self.vao.add_vertex_buffer(self.instance_buffer, location=self.INSTANCE_ATTRIBUTE_LOCATION)
+            self.vao.unbind()
+
+    def get_instance_count(self):
+        if self.instance_buffer is None:
+            return self.num_instances
+        # the parent model sizes the shared buffer to the instances it uploaded, which may exceed num_instances
+        return self.instance_buffer.get_instance_count()
 
     def draw(self, M=TransformMatrix()):
         if self.visable:
+            num_instances = self.get_instance_count()
+            if num_instances == 0:
+                return
+
             self.vao.bind()
             if M == TransformMatrix():
                 self.shader.bind(
                     model=self,
-                    M=np.array(self.M.get_transform())
+                    M=self.decode(np.array(self.M.get_transform()))
                 )
             else:
                 self.shader.bind(
                     model=self,
-                    M=np.matmul(np.array(M.get_transform()), np.array(self.M.get_transform()))
+                    M=self.decode(np.matmul(np.array(M.get_transform()), np.array(self.M.get_transform())))
                 )
 
             if self.ibo is None:
-                gl.glDrawArraysInstanced(self.primative, 0, self.mesh.vertices.shape[0], self.num_instances)
-            else:
-                gl.glDrawElementsInstanced(self.primative, self.mesh.faces.flatten().shape[0], gl.GL_UNSIGNED_INT, None, self.num_instances)
-
-            self.vao.unbind()
+                gl.glDrawArraysInstanced(self.primative, 0, self.mesh.vertices.shape[0], num_instances)
+                return
+
+            # one draw per level of detail, over the instances of that level. Meshes with fewer levels
+            # than the parent draw the instances of the remaining levels with their coarsest level
+            boundaries = self.instance_boundaries if self.instance_boundaries is not None else [0, num_instances]
+            levels = min(len(self.lod_ranges), len(boundaries) - 1)
+            full = self.lod_ranges[0][1] // 3
+
+            for level in range(levels):
+                first = boundaries[level]
+                last = boundaries[level + 1] if level < levels - 1 else boundaries[-1]
+                count = min(last, num_instances) - first
+                if count <= 0:
+                    continue
+
+                self.set_first_instance(first)
+                offset, index_count = self.lod_ranges[level]
+                gl.glDrawElementsInstanced(self.primative, index_count, self.ibo.get_type(), ctypes.c_void_p(offset), count)
+                lod_selector.count(index_count // 3 * count, full * count)
+
+    def set_first_instance(self, first):
+        """
+        Points the instance attribute at the given instance, GL 3.3 has no base instance so the
+        attribute offset into the instance buffer is moved instead.
+        """
+        if first != self.first_instance and self.instance_buffer is not None:
+            element_size = self.instance_buffer.get_layout().get_stride()
+            self.vao.set_vertex_buffer_offset(self.instance_buffer, self.INSTANCE_ATTRIBUTE_LOCATION, first * element_size)
+            self.first_instance = first
 
 class ModelFromMesh(BaseModel):
 
-    def __init__(self, scene, mesh, name=None, shader=None, visable=True):
-        BaseModel.__init__(self, scene=scene, mesh=mesh, visable=visable)
+    def __init__(self, scene, mesh, name=None, shader=None, visable=True, geometry=None, compact=False, interleaved=None, arena=False):
+        BaseModel.__init__(self, scene=scene, mesh=mesh, visable=visable, geometry=geometry, compact=compact, interleaved=interleaved, arena=arena)
 
         if name is not None:
             self.name = name
@@ -200,8 +462,9 @@ class ModelFromMesh(BaseModel):
 
 class ModelFromMeshInstanced(InstancedModel):
 
-    def __init__(self, scene, mesh, name=None, shader=None, visable=True, num_instances=100):
-        InstancedModel.__init__(self, scene=scene, mesh=mesh, visable=visable, num_instances=num_instances)
+    def __init__(self, scene, mesh, name=None, shader=None, visable=True, num_instances=100, instance_buffer=None, instance_attribute=None, geometry=None, compact=False, interleaved=None):
+        InstancedModel.__init__(self, scene=scene, mesh=mesh, visable=visable, num_instances=num_instances,
+                                instance_buffer=instance_buffer, instance_attribute=instance_attribute, geometry=geometry, compact=compact, interleaved=interleaved)
 
         if name is not None:
             self.name = name
@@ -228,54 +491,570 @@ class CompModel(BaseModel):
         self.visable = visable
         self.scene = scene
         self.M = TransformMatrix()
+        # bounds of the components in model space, and the component bounds they were merged from
+        self._local_bounds = None
+        self._local_parts = None
+        # bounds in the space of the parent model, and the local bounds and version of M they were computed for
+        self._bounds = None
+        self._bounds_key = None
+        self._world_bounds = None
+        self._world_bounds_key = None
+        # number of levels of detail of the most detailed component
+        self.lod_count = max([len(component.lod_ranges) for component in models] + [1])
+        # hardware occlusion queries of the model, see enable_occlusion_queries
+        self.query_set = None
+
+    def get_local_bounds(self):
+        """
+        Returns the box and sphere around every component in model space, before M. They are merged
+        again only when the bounds of a component changed.
+        """
+        parts = [component.get_bounds() for component in self.components]
+        if self._local_parts is None or len(parts) != len(self._local_parts) or any(a is not b for a, b in zip(parts, self._local_parts)):
+            self._local_bounds = (merge_boxes([box for box, _ in parts]), merge_spheres([sphere for _, sphere in parts]))
+            self._local_parts = parts
+        return self._local_bounds
+
+    def get_bounds(self):
+        """
+        Returns the box and sphere around the model in the space of the parent model.
+        """
+        local = self.get_local_bounds()
+        if self._bounds_key is None or self._bounds_key[0] is not local or self._bounds_key[1] != self.M.version:
+            self._bounds = self.transform_bounds(local, np.array(self.M.get_transform(), dtype=np.float32))
+            self._bounds_key = (local, self.M.version)
+        return self._bounds
+
+    def get_world_bounds(self, M=TransformMatrix()):
+        """
+        Returns the box and sphere around the model in world space, under the transform of the parent model.
+        """
+        local = self.get_local_bounds()
+        world = self.get_world_transform(M)
+        if self._world_bounds_key is None or self._world_bounds_key[0] is not local or self._world_bounds_key[1] != world.tobytes():
+            self._world_bounds = self.transform_bounds(local, world)
+            self._world_bounds_key = (local, world.tobytes())
+        return self._world_bounds
+
+    @staticmethod
+    def transform_bounds(bounds, M):
+        box, sphere = bounds
+        centers, radii = transform_spheres(sphere, M[np.newaxis])
+        return transform_boxes(box, M[np.newaxis])[0], (centers[0], float(radii[0]))
+
+    def get_world_transform(self, M=TransformMatrix()):
+        """
+        Returns the transform the components are drawn with, as a numpy array.
+        """
+        if M == TransformMatrix():
+            return np.array(self.M.get_transform(), dtype=np.float32)
+        return np.matmul(np.array(M.get_transform()), np.array(self.M.get_transform())).astype(np.float32)
+
+    def select_lod(self, M=TransformMatrix()):
+        """
+        Picks the level of detail of the components from the size of the model on screen.
+        """
+        camera = getattr(self.scene, 'camera', None)
+        if self.lod_count == 1 or camera is None:
+            return
+
+        center, radius = self.get_world_bounds(M)[1]
+        level = int(lod_selector.select(camera, center, radius))
+        for component in self.components:
+            component.lod_level = level
+
+    def get_batch_key(self):
+        return None
+
+    def get_stats_name(self):
+        """
+        Returns the name the culling counters of the model are recorded under.
+        """
+        return type(self).__name__
+
+    def cull(self, M=TransformMatrix()):
+        """
+        Returns True when the bounds of the model are fully outside the view frustum, recording the
+        model as drawn or culled.
+        """
+        camera = getattr(self.scene, 'camera', None)
+        if not frustum_culler.enabled or camera is None:
+            frustum_culler.count(self.get_stats_name(), 1, 0)
+            return False
+
+        box, (center, radius) = self.get_world_bounds(M)
+        visible = bool(frustum_culler.visible(camera, center, radius)[0])
+        if visible and occlusion_culler.active:
+            visible = not occlusion_culler.cull(camera, box[np.newaxis])[0]
+        frustum_culler.count(self.get_stats_name(), int(visible), int(not visible))
+        return not visible
+
+    def enable_occlusion_queries(self):
+        """
+        Opt in to hardware occlusion queries: the model is drawn on the result of a query of its box
+        (of each instance's box for instanced models) while occlusion_queries is enabled.
+        """
+        if self.query_set is None:
+            self.query_set = occlusion_queries.create_set()
+
+    def query_occlusion(self, M=TransformMatrix()):
+        """
+        Queries the box of the model when due, returns the query the draw is conditioned on or None to
+        draw unconditionally.
+        """
+        if self.query_set is None or not occlusion_queries.active:
+            return None
+        return occlusion_queries.condition(self.query_set, self.get_world_bounds(M)[0])
 
     def draw(self, M=TransformMatrix()):
         if self.visable:
+            if self.cull(M):
+                return
+            self.select_lod(M)
+
+            # the GPU skips the draws when the box of the model was hidden, without waiting for the result
+            query = self.query_occlusion(M)
+            if query is not None:
+                gl.glBeginConditionalRender(query, gl.GL_QUERY_NO_WAIT)
+
+            transform = TransformMatrix()
+            if M==TransformMatrix():
+                transform.matrix =self.M.get_transform()
+            else:
+                transform.matrix = np.matmul(np.array(M.get_transform()), np.array(self.M.get_transform()))
+
+            # consecutive components that bind the same state are drawn with one multi-draw
+            batch = []
+            batch_key = None
             for component in self.components:
-                transform = TransformMatrix()
-                if M==TransformMatrix():
-                    transform.matrix =self.M.get_transform()
+                if not component.visable:
+                    continue
+                key = component.get_batch_key()
+                if batch and key != batch_key:
+                    self.draw_batch(batch, transform)
+                    batch = []
+
+                if key is None:
+                    component.draw(
+                        M=transform
+                    )
                 else:
-                    transform.matrix = np.matmul(np.array(M.get_transform()), np.array(self.M.get_transform()))
+                    batch.append(component)
+                    batch_key = key
+            self.draw_batch(batch, transform)
 
-                component.draw(
-                    M=transform
-                )
+            if query is not None:
+                gl.glEndConditionalRender()
+
+    def draw_batch(self, batch, M):
+        """
+        Draws arena components sharing a batch key, with the state of the first one.
+        """
+        if len(batch) <= 1:
+            for component in batch:
+                component.draw(M=M)
+            return
+
+        first = batch[0]
+        first.vao.bind()
+        first.shader.bind(
+            model=first,
+            M=first.get_model_matrix(M)
+        )
+        first.allocation.arena.multi_draw(first.primative, [component.allocation for component in batch], [component.lod_level for component in batch])
+
+        for component in batch:
+            lod_selector.count(component.get_lod_range(component.lod_level)[1] // 3, component.lod_ranges[0][1] // 3)
+        geometry_arenas.count(len(batch))
 
     def update(self):
         for component in self.components:
             component.update()
 
+    def release(self):
+        for component in self.components:
+            component.release()
+        if self.query_set is not None:
+            occlusion_queries.release_set(self.query_set)
+            self.query_set = None
 
-class ModelFromObj(CompModel):
 
-    def __init__(self, scene, obj, shader=None, visable=True, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True):
-        model_loader = ModelLoader()
-        meshes = model_loader.load_model(obj, generate_normals=generate_normals, flip_uvs=flip_uvs, flip_winding=flip_winding, optimize_meshes=optimize_meshes)
+class ModelFromObj(CompModel):
+    # draw the submeshes from the geometry arenas unless told otherwise
+    ARENA = True
+
+    def __init__(self, scene, obj, shader=None, visable=True, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True, compact=False, interleaved=None, arena=None, merge_materials=False):
+        arena = ModelFromObj.ARENA if arena is None else arena
+        # meshes and their GPU buffers are shared with every other model of the same file. Merging by
+        # material draws one submesh per material instead of one per Assimp mesh
+        self.asset = asset_registry.acquire(obj, generate_normals=generate_normals, flip_uvs=flip_uvs, flip_winding=flip_winding, optimize_meshes=optimize_meshes,
+                                            merge_materials=merge_materials)
+        meshes = self.asset.meshes
+        # decode the textures of every submesh in parallel before binding them one by one
+        texture_cache.prefetch(meshes)
 
         models = []
-        for mesh in meshes:
-            models.append(ModelFromMesh(scene, mesh, visable=visable, shader=shader))
+        for mesh, geometry in zip(meshes, self.asset.geometries):
+            models.append(ModelFromMesh(scene, mesh, visable=visable, shader=shader, geometry=geometry, compact=compact, interleaved=interleaved, arena=arena))
 
         CompModel.__init__(self, scene, models, visable=visable)
 
+    def release(self):
+        CompModel.release(self)
+        asset_registry.release(self.asset)
+
+    def get_stats_name(self):
+        return self.asset.path
+
 
 class ModelFromObjInstanced(CompModel):
 
-    def __init__(self, scene, obj, shader=None, visable=True, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True, num_instances=100):
-        model_loader = ModelLoader()
-        meshes = model_loader.load_model(obj, generate_normals=generate_normals, flip_uvs=flip_uvs, flip_winding=flip_winding, optimize_meshes=optimize_meshes)
+    def __init__(self, scene, obj, shader=None, visable=True, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True, num_instances=100, compact=False, interleaved=None, merge_materials=False):
+        # the shader gives the layout of the instances, checked before the asset is acquired so that a
+        # missing one does not leave it referenced
+        if getattr(shader, 'instance_attribute', None) is None:
+            raise ValueError('(E) Error: instanced model {} needs a shader with an instance attribute, got {}'.format(obj, shader))
+
+        # meshes and their GPU buffers are shared with every other model of the same file. Merging by
+        # material draws one submesh per material instead of one per Assimp mesh
+        self.asset = asset_registry.acquire(obj, generate_normals=generate_normals, flip_uvs=flip_uvs, flip_winding=flip_winding, optimize_meshes=optimize_meshes,
+                                            merge_materials=merge_materials)
+        meshes = self.asset.meshes
+        # decode the textures of every submesh in parallel before binding them one by one
+        texture_cache.prefetch(meshes)
+
+        # per-instance data (offsets or matrices, depending on the shader) lives in one buffer shared by every submesh
+        self.instance_attribute, self.instance_type = shader.instance_attribute
+        self.init_instances(InstanceBuffer(self.instance_type, capacity=num_instances), num_instances)
+
+        self.offsets = []
+        self.matricies = []
 
         models = []
-        for mesh in meshes:
-            models.append(ModelFromMeshInstanced(scene, mesh, visable=visable, shader=shader, num_instances=num_instances))
+        for mesh, geometry in zip(meshes, self.asset.geometries):
+            models.append(ModelFromMeshInstanced(scene, mesh, visable=visable, shader=shader, num_instances=num_instances,
+                                                 instance_buffer=self.instance_buffer, instance_attribute=self.instance_attribute,
+                                                 geometry=geometry, compact=compact, interleaved=interleaved))
 
         CompModel.__init__(self, scene, models, visable=visable)
 
+    def release(self):
+        CompModel.release(self)
+        asset_registry.release(self.asset)
+
+    def init_instances(self, instance_buffer, num_instances):
+        """
+        Creates the storage of the instances, empty, and the state of their culling and upload.
+
+        Args:
+            instance_buffer (InstanceBuffer): The buffer the instances are uploaded to.
+            num_instances (int): The number of instances to make room for.
+        """
+        self.instance_buffer = instance_buffer
+        self.instance_data = np.zeros((max(num_instances, 1), BufferElement(self.instance_type).get_size() // 4), 'f')
+        self.instance_count = 0
+        self.instances_dirty = False
+        # indices of the uploaded instances: the visible ones, sorted by level of detail, and the first
+        # instance of each level among them
+        self.instance_order = None
+        self.instance_boundaries = None
+        # every instance, uploaded for the faces of environment maps when they changed, and the buffer
+        # the submeshes currently read their instances from
+        self.reflection_buffer = None
+        self.reflections_dirty = True
+        self.bound_buffer = self.instance_buffer
+        # instances inside the frustum this frame, whose boxes may be queried after the draw
+        self.query_candidates = None
+        # world space bounds of each instance, the instances written since they were computed, and
+        # the model bounds and world transform they were computed for
+        self.instance_boxes = np.zeros((len(self.instance_data), 2, 3), dtype=np.float32)
+        self.instance_centers = np.zeros((len(self.instance_data), 3), dtype=np.float32)
+        self.instance_radii = np.zeros(len(self.instance_data), dtype=np.float32)
+        self.instance_bounds_dirty = np.ones(len(self.instance_data), dtype=bool)
+        self.instance_bounds_key = None
+        # hierarchy over the instance boxes of models that rarely move, refitted as their bounds are recomputed
+        self.spatial_index = None
+
     def set_num_instances(self, num_instances):
         for model in self.components:
             model.num_instances = num_instances
 
     def add_num_instances(self, num_instances):
         for model in self.components:
-            model.num_instances += num_instances
\ No newline at end of file
+            model.num_instances += num_instances
+
+    def add_offset(self, offset):
+        """
+        Adds an instance placed at the given world offset.
+
+        Args:
+            offset (numpy.ndarray): The world space offset of the instance.
+
+        Returns:
+            int: The index of the new instance.
+        """
+        self.offsets.append(offset)
+        self.set_instance(len(self.offsets) - 1, np.array(offset, 'f'))
+        return len(self.offsets) - 1
+
+    def add_matrix(self, M):
+        """
+        Adds an instance transformed by the given matrix.
+
+        Args:
+            M (TransformMatrix): The transform of the instance, kept by reference.
+
+        Returns:
+            int: The index of the new instance.
+        """
+        self.matricies.append(M)
+        self.update_matrix(len(self.matricies) - 1)
+        return len(self.matricies) - 1
+
+    def update_matrix(self, index):
+        """
+        Re-reads the transform of an instance after it has been modified in place.
+
+        Args:
+            index (int): The index of the instance.
+        """
+        # attribute matrices are read column by column, so store the transpose
+        self.set_instance(index, np.array(self.matricies[index].get_transform(), 'f').T.flatten())
+
+    def set_instance(self, index, data):
+        """
+        Writes the raw per-instance data of an instance, growing the storage if needed.
+
+        Args:
+            index (int): The index of the instance.
+            data (numpy.ndarray): The flattened instance data.
+        """
+        if index >= len(self.instance_data):
+            instance_data = np.zeros((max(2 * len(self.instance_data), index + 1), self.instance_data.shape[1]), 'f')
+            instance_data[:len(self.instance_data)] = self.instance_data
+            self.instance_data = instance_data
+
+            instance_bounds_dirty = np.ones(len(instance_data), dtype=bool)
+            instance_bounds_dirty[:len(self.instance_bounds_dirty)] = self.instance_bounds_dirty
+            self.instance_bounds_dirty = instance_bounds_dirty
+
+        self.instance_data[index] = data
+        self.instance_count = max(self.instance_count, index + 1)
+        self.instances_dirty = True
+        self.reflections_dirty = True
+        self.instance_bounds_dirty[index] = True
+
+    def get_instance_bounds(self, M=TransformMatrix()):
+        """
+        Returns the world space boxes (K, 2, 3), sphere centres (K, 3) and sphere radii (K,) of the
+        instances. Only the instances written since the last call are bounded again, unless the
+        model moved or its bounds changed.
+        """
+        local = self.get_local_bounds()
+        world = self.get_world_transform(M)
+        count = self.instance_count
+
+        if len(self.instance_boxes) < len(self.instance_data):
+            self.instance_boxes = np.zeros((len(self.instance_data), 2, 3), dtype=np.float32)
+            self.instance_centers = np.zeros((len(self.instance_data), 3), dtype=np.float32)
+            self.instance_radii = np.zeros(len(self.instance_data), dtype=np.float32)
+            self.instance_bounds_key = None
+
+        if self.instance_bounds_key is None or self.instance_bounds_key[0] is not local or self.instance_bounds_key[1] != world.tobytes():
+            self.instance_bounds_dirty[:] = True
+            self.instance_bounds_key = (local, world.tobytes())
+
+        rows = np.flatnonzero(self.instance_bounds_dirty[:count])
+        if len(rows):
+            box, sphere = local
+            data = self.instance_data[rows]
+            if self.instance_type == BufferType.MATF_4:
+                # matrices are stored transposed, see update_matrix
+                matrices = data.reshape(-1, 4, 4).transpose(0, 2, 1) @ world
+            else:
+                # offsets are added after the model transform
+                matrices = np.repeat(world[np.newaxis], len(rows), axis=0)
+                matrices[:, :3, 3] += data[:, :3]
+
+            self.instance_boxes[rows] = transform_boxes(box, matrices)
+            self.instance_centers[rows], self.instance_radii[rows] = transform_spheres(sphere, matrices)
+            self.instance_bounds_dirty[rows] = False
+
+            if self.spatial_index is not None and len(self.spatial_index) == count:
+                self.spatial_index.refit(self.instance_boxes[rows], rows)
+
+        return self.instance_boxes[:count], self.instance_centers[:count], self.instance_radii[:count]
+
+    def get_instance_spheres(self, M=TransformMatrix()):
+        """
+        Returns the world space centres (K, 3) and radii (K,) of the bounding spheres of the instances.
+        """
+        _, centers, radii = self.get_instance_bounds(M)
+        return centers, radii
+
+    def build_spatial_index(self, M=TransformMatrix()):
+        """
+        Builds a bounding volume hierarchy over the instances, so that select_lod culls them by walking
+        the hierarchy instead of testing each one. Meant for instances that rarely move.
+        """
+        self.spatial_index = SpatialIndex(self.get_instance_bounds(M)[0])
+        return self.spatial_index
+
+    def cull(self, M=TransformMatrix()):
+        # instances are culled one by one in select_lod
+        return False
+
+    def query_occlusion(self, M=TransformMatrix()):
+        # instances are queried one by one after the draw
+        return None
+
+    def query_instances(self, M=TransformMatrix()):
+        """
+        Queries the boxes of the instances inside the frustum that are due, after they were drawn: their
+        own depth is behind their box, so an instance is only hidden by what is in front of it.
+        """
+        if self.query_set is None or not occlusion_queries.active or self.query_candidates is None:
+            return
+        rows = occlusion_queries.schedule(self.query_set, self.query_candidates)
+        occlusion_queries.issue(self.query_set, rows, self.get_instance_bounds(M)[0][rows])
+
+    def select_lod(self, M=TransformMatrix()):
+        """
+        Culls the instances outside the view frustum and picks the level of detail of the others from
+        their size on screen. The visible instances are uploaded compacted and sorted by level, so that
+        each level is drawn as one range of instances.
+        """
+        camera = getattr(self.scene, 'camera', None)
+        cull = frustum_culler.enabled and camera is not None
+        lod = self.lod_count > 1 and camera is not None
+        self.query_candidates = None
+        if not (cull or lod) or self.instance_count == 0:
+            self.upload_instances()
+            self.bind_instance_buffer(self.instance_buffer, self.instance_boundaries)
+            frustum_culler.count(self.get_stats_name(), self.instance_count, 0)
+            return
+        if frustum_culler.reflection_pass:
+            self.select_reflections()
+            return
+
+        boxes, centers, radii = self.get_instance_bounds(M)
+        if not cull:
+            order = np.arange(self.instance_count)
+        elif self.spatial_index is not None:
+            if len(self.spatial_index) != self.instance_count:
+                self.spatial_index = SpatialIndex(boxes)
+            order = self.spatial_index.query_frustum(frustum_culler.get_planes(camera))
+        else:
+            order = np.flatnonzero(frustum_culler.visible(camera, centers, radii))
+        if cull and len(order):
+            # instances outside the potentially visible set of the camera's cell, then those hidden by the nearest towers
+            order = order[pvs.visible(self, camera, order)]
+        if cull and occlusion_culler.active and len(order):
+            order = order[~occlusion_culler.cull(camera, boxes[order])]
+        if self.query_set is not None and occlusion_queries.active:
+            # instances whose box was last hidden are left out, their boxes are still queried after the draw
+            self.query_candidates = order
+            order = order[occlusion_queries.visible(self.query_set, order, self.instance_count)]
+        if lod:
+            levels = np.minimum(lod_selector.select(camera, centers[order], radii[order]), self.lod_count - 1)
+        else:
+            levels = np.zeros(len(order), dtype=np.int64)
+        by_level = np.argsort(levels, kind='stable')
+        order, levels = order[by_level], levels[by_level]
+        frustum_culler.count(self.get_stats_name(), len(order), self.instance_count - len(order))
+
+        if self.instances_dirty or self.instance_order is None or not np.array_equal(order, self.instance_order):
+            self.instance_buffer.set_data(self.instance_data[order])
+            self.instances_dirty = False
+            self.instance_order = order
+            self.instance_boundaries = np.searchsorted(levels, np.arange(self.lod_count + 1)).tolist()
+        self.bind_instance_buffer(self.instance_buffer, self.instance_boundaries)
+
+    def select_reflections(self):
+        """
+        Draws every instance, at its coarsest level, for the faces of an environment map. They are
+        uploaded to a buffer of their own when they change, instead of being culled and uploaded again
+        for each face, and the upload of the main pass is left as it is.
+        """
+        if self.reflection_buffer is None:
+            self.reflection_buffer = InstanceBuffer(self.instance_type, capacity=self.instance_count)
+        if self.reflections_dirty:
+            self.reflection_buffer.set_data(self.instance_data[:self.instance_count])
+            self.reflections_dirty = False
+        self.bind_instance_buffer(self.reflection_buffer, [0] * self.lod_count + [self.instance_count])
+        frustum_culler.count(self.get_stats_name(), self.instance_count, 0)
+
+    def bind_instance_buffer(self, buffer, boundaries):
+        """
+        Points the instance attribute of every submesh at a buffer of the instance layout, and sets the
+        first instance of each level of detail in it.
+        """
+        for model in self.components:
+            if buffer is not self.bound_buffer:
+                model.vao.replace_vertex_buffer(model.instance_buffer, buffer, model.INSTANCE_ATTRIBUTE_LOCATION)
+                model.instance_buffer = buffer
+                model.first_instance = 0
+            model.instance_boundaries = boundaries
+        self.bound_buffer = buffer
+
+    def upload_instances(self):
+        """
+        Uploads every instance if they changed since the last upload, or if it only uploaded the
+        instances that were not culled.
+        """
+        if self.instances_dirty or self.instance_order is not None:
+            self.instance_buffer.set_data(self.instance_data[:self.instance_count])
+            self.instances_dirty = False
+            self.instance_order = None
+            self.instance_boundaries = None
+
+    def get_stats_name(self):
+        return self.asset.path
+
+    def draw(self, M=TransformMatrix()):
+        if self.visable:
+            CompModel.draw(self, M)
+            self.query_instances(M)
+
+
+if __name__ == "__main__":
+    # Cull the instances of a model, then turn culling off and check that every instance is uploaded
+    # again. Runs without a GL context: the model has no submeshes, and its buffer records what it is given
+    import glm
+
+    class RecordingBuffer:
+        def set_data(self, data):
+            self.data = np.array(data)
+
+    class Camera:
+        def projection(self):
+            return np.array(glm.perspective(glm.radians(45), 1.0, 0.1, 100))
+
+        def view(self):
+            return np.identity(4)
+
+    class Scene:
+        camera = Camera()
+
+    class Asset:
+        path = 'instances'
+
+    model = ModelFromObjInstanced.__new__(ModelFromObjInstanced)
+    CompModel.__init__(model, Scene(), [])
+    model.asset = Asset()
+    model.instance_type = BufferType.FLOAT_3
+    buffer = RecordingBuffer()
+    model.init_instances(buffer, 8)
+    # half the instances in front of the camera, half behind it
+    for index in range(8):
+        model.set_instance(index, np.array([0, 0, -10 if index % 2 == 0 else 10], 'f'))
+
+    frustum_culler.enabled = True
+    model.select_lod()
+    assert len(buffer.data) == 4 and model.instance_order is not None, len(buffer.data)
+
+    frustum_culler.enabled = False
+    model.select_lod()
+    assert np.array_equal(buffer.data, model.instance_data[:8]), len(buffer.data)
+    assert model.instance_order is None and model.instance_boundaries is None
+    print(f'culled upload: 4 of 8 instances, after culling is turned off: {len(buffer.data)} of 8 instances')
@@ -1,12 +1,23 @@
-import pyassimp as assimp
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
 import numpy as np
 
 from mesh import Mesh
 from material import Material
+from mesh_cache import mesh_cache
+from lod import LOD_RATIOS, simplify_chain
+import index_optimizer
+import mesh_kernels
+import bounds
 
 class ModelLoader:
     """
-    A class for loading 3D models using the Assimp library.
+    A class for loading 3D models using the Assimp library. Imported meshes are stored in the mesh
+    cache, later loads of an unchanged model read them back without importing Assimp at all.
 
     Args:
         path (str): The path to the model file.
@@ -15,13 +26,106 @@ class ModelLoader:
         flip_winding (bool, optional): Whether to flip the winding order of the faces. Defaults to False.
         optimize_meshes (bool, optional): Whether to optimize the meshes in the model. Defaults to True.
         generate_tangents (bool, optional): Whether to generate tangents and bitangents for the model. Defaults to True.
+        optimize_indices (bool, optional): Whether to reorder the triangles and vertices for the vertex cache,
+            overdraw and vertex fetch. Defaults to True.
+        lod_ratios (tuple, optional): The fraction of the triangles kept by each simplified level of detail,
+            generated on import and cached with the meshes. Defaults to LOD_RATIOS.
+        merge_materials (bool, optional): Whether to merge the meshes sharing a material and textures into one
+            mesh, with the node transforms applied to their vertices. Defaults to False.
 
     Returns:
         list: A list of Mesh objects representing the loaded model.
     """
 
-    def load_model(self, path, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True, generate_tangents=True):
-        meshes = []
+    def load_model(self, path, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True, generate_tangents=True, optimize_indices=True, lod_ratios=LOD_RATIOS, merge_materials=False):
+        flags = self._flags(generate_normals, flip_uvs, flip_winding, optimize_meshes, generate_tangents, optimize_indices, lod_ratios, merge_materials)
+
+        key = mesh_cache.key(f"models/{path}", flags)
+        records = mesh_cache.load(key)
+
+        if records is None:
+            records = self._import_meshes(path, **flags)
+            mesh_cache.store(key, records)
+
+        return self._build_meshes(records)
+
+    def load_models(self, paths, workers=None, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True, generate_tangents=True, optimize_indices=True, lod_ratios=LOD_RATIOS, merge_materials=False):
+        """
+        Loads a batch of models, importing the ones missing from the mesh cache in parallel on a
+        process pool. The workers hand their arrays back through shared memory, only the small
+        layout header is pickled. Nothing touches OpenGL, the models are uploaded by the caller.
+
+        Args:
+            paths (list): The paths of the model files, relative to the models directory.
+            workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+        Returns:
+            dict: The list of Mesh objects of each path.
+        """
+        flags = self._flags(generate_normals, flip_uvs, flip_winding, optimize_meshes, generate_tangents, optimize_indices, lod_ratios, merge_materials)
+
+        keys = {}
+        for path in dict.fromkeys(paths):
+            keys[path] = mesh_cache.key(f"models/{path}", flags)
+
+        # cached models are mapped straight from disk
+        records = {path: mesh_cache.load(key) for path, key in keys.items()}
+        missing = [path for path, record in records.items() if record is None]
+
+        if missing:
+            workers = min(workers or os.cpu_count() or 1, len(missing))
+            print('Importing {} models on {} processes'.format(len(missing), workers))
+
+            # workers are spawned, a forked child would inherit the GL context and the threads of the window
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {path: executor.submit(_import_shared, path, flags) for path in missing}
+
+                for path, future in futures.items():
+                    name, layout = future.result()
+                    shm = shared_memory.SharedMemory(name=name)
+                    try:
+                        # the shared arrays are written to the cache, which then maps them back
+                        shared = _unpack_shared(shm, layout)
+                        mesh_cache.store(keys[path], shared)
+                        # the views must be gone before the block can be closed
+                        del shared
+                    finally:
+                        shm.close()
+                        shm.unlink()
+
+                    records[path] = mesh_cache.load(keys[path])
+
+        return {path: self._build_meshes(records[path]) for path in keys}
+
+    def preload(self, paths, workers=None, **flags):
+        """
+        Imports a batch of models into the mesh cache in parallel, so that loading them one by one
+        afterwards only maps the cached files.
+        """
+        self.load_models(paths, workers=workers, **flags)
+
+    @staticmethod
+    def _flags(generate_normals, flip_uvs, flip_winding, optimize_meshes, generate_tangents, optimize_indices, lod_ratios, merge_materials):
+        return {
+            'generate_normals': generate_normals,
+            'flip_uvs': flip_uvs,
+            'flip_winding': flip_winding,
+            'optimize_meshes': optimize_meshes,
+            'generate_tangents': generate_tangents,
+            'optimize_indices': optimize_indices,
+            'lod_ratios': list(lod_ratios),
+            'merge_materials': merge_materials,
+        }
+
+    def _import_meshes(self, path, generate_normals=True, flip_uvs=True, flip_winding=False, optimize_meshes=True, generate_tangents=True, optimize_indices=True, lod_ratios=LOD_RATIOS, merge_materials=False):
+        """
+        Imports the model with Assimp and returns the plain arrays and material properties of each mesh,
+        along with the faces of its levels of detail.
+        """
+        # only imported on a cache miss
+        import pyassimp as assimp
+
+        records = []
         processing = assimp.postprocess.aiProcess_Triangulate | assimp.postprocess.aiProcess_JoinIdenticalVertices
         if flip_uvs:
             processing = processing | assimp.postprocess.aiProcess_FlipUVs
@@ -35,6 +139,7 @@ class ModelLoader:
         if optimize_meshes:
             processing = processing | assimp.postprocess.aiProcess_OptimizeMeshes
 
+        imported = []
         with assimp.load(f"models/{path}", processing=processing) as scene:
             for mesh in scene.meshes:
                 faces = mesh.faces
@@ -49,34 +154,228 @@ class ModelLoader:
                 if texCoords is not None:
                     texCoords = texCoords[0][:, :2]
 
-                # load map_Kd
-                map_Kd = m.properties.get(('file', 1), None)
-                # load map_Ks
-                map_Ks = m.properties.get(('file', 2), None)
-                map_Ns = m.properties.get(('file', 7), None)
-                map_bump = m.properties.get(('file', 5), None)
-
-                material = Material(
-                    Ka=np.array(m.properties['ambient'], dtype=np.float32),
-                    Kd=np.array(m.properties['diffuse'], dtype=np.float32),
-                    Ks=np.array(m.properties['specular'], dtype=np.float32),
-                    Ns=np.array(m.properties['shininess'], dtype=np.float32),
-                    map_Kd=map_Kd,
-                    map_Ks=map_Ks,
-                    map_Ns=map_Ns,
-                    map_bump=map_bump,
-                )
-
-                # create model
-                m = Mesh(
-                    vertices=vertices,
-                    normals=normals,
-                    textureCoords=texCoords,
-                    faces=faces,
-                    material=material,
-                    tangents=tangents,
-                    bitangents=bitangents
-                )
-                meshes.append(m)
-
-        return meshes
\ No newline at end of file
+                material = {
+                    'Ka': np.asarray(m.properties['ambient'], dtype=np.float32).tolist(),
+                    'Kd': np.asarray(m.properties['diffuse'], dtype=np.float32).tolist(),
+                    'Ks': np.asarray(m.properties['specular'], dtype=np.float32).tolist(),
+                    'Ns': np.asarray(m.properties['shininess'], dtype=np.float32).tolist(),
+                    # load map_Kd
+                    'map_Kd': m.properties.get(('file', 1), None),
+                    # load map_Ks
+                    'map_Ks': m.properties.get(('file', 2), None),
+                    'map_Ns': m.properties.get(('file', 7), None),
+                    'map_bump': m.properties.get(('file', 5), None),
+                }
+
+                imported.append(({
+                    'vertices': vertices,
+                    'normals': normals,
+                    'textureCoords': texCoords,
+                    'tangents': tangents,
+                    'bitangents': bitangents,
+                    'faces': faces,
+                }, material))
+
+            if merge_materials:
+                transforms = _node_transforms(scene)
+                before = len(imported)
+                imported = _merge_by_material(imported, transforms)
+                print('{}: merged {} submeshes into {} by material'.format(path, before, len(imported)))
+
+            for arrays, material in imported:
+                faces = arrays.pop('faces')
+                vertices = arrays['vertices']
+                triangles = faces.ndim == 2 and faces.shape[1] == 3 and len(faces) > 0
+
+                # triangles are reordered for the vertex cache and overdraw, vertices in the order they are used
+                if optimize_indices and triangles:
+                    faces, order, before, after = index_optimizer.optimize(vertices, faces)
+                    arrays = {name: array[order] if array is not None else None for name, array in arrays.items()}
+                    print('{}: ACMR {:.3f} -> {:.3f}'.format(path, before, after))
+
+                arrays['faces'] = faces
+
+                # bounds are stored with the mesh so that cached models never walk their vertices again
+                center, radius = bounds.bounding_sphere(arrays['vertices'])
+                arrays['bounding_box'] = bounds.bounding_box(arrays['vertices'])
+                arrays['bounding_sphere'] = np.append(center, radius).astype(np.float32)
+
+                # simplified levels index the same vertices, so they are stored as extra face arrays
+                if lod_ratios and triangles:
+                    levels = simplify_chain(arrays['vertices'], faces, lod_ratios, normals=arrays['normals'], uvs=arrays['textureCoords'])
+                    for level, lod_faces in enumerate(levels, start=1):
+                        if optimize_indices:
+                            lod_faces = lod_faces[index_optimizer.optimize_vertex_cache(lod_faces, len(arrays['vertices']))]
+                        arrays['lod_{}'.format(level)] = lod_faces.astype(faces.dtype)
+
+                records.append({
+                    'arrays': arrays,
+                    'material': material,
+                })
+
+        return records
+
+    def _build_meshes(self, records):
+        """
+        Creates the Mesh objects from imported or cached mesh records, the arrays are used as they are.
+        """
+        meshes = []
+        for record in records:
+            arrays = record['arrays']
+            m = record['material']
+
+            material = Material(
+                Ka=np.array(m['Ka'], dtype=np.float32),
+                Kd=np.array(m['Kd'], dtype=np.float32),
+                Ks=np.array(m['Ks'], dtype=np.float32),
+                Ns=np.array(m['Ns'], dtype=np.float32),
+                map_Kd=m['map_Kd'],
+                map_Ks=m['map_Ks'],
+                map_Ns=m['map_Ns'],
+                map_bump=m['map_bump'],
+            )
+
+            # entries cached before bounds were stored compute them on first use
+            sphere = arrays.get('bounding_sphere')
+            if sphere is not None:
+                sphere = (sphere[:3], float(sphere[3]))
+
+            lods = []
+            while 'lod_{}'.format(len(lods) + 1) in arrays:
+                lods.append(arrays['lod_{}'.format(len(lods) + 1)])
+
+            # create model
+            mesh = Mesh(
+                vertices=arrays['vertices'],
+                normals=arrays['normals'],
+                textureCoords=arrays['textureCoords'],
+                faces=arrays['faces'],
+                material=material,
+                tangents=arrays['tangents'],
+                bitangents=arrays['bitangents'],
+                lods=lods,
+                bounding_box=arrays.get('bounding_box'),
+                bounding_sphere=sphere
+            )
+            meshes.append(mesh)
+
+        return meshes
+
+
+def _node_transforms(scene):
+    """
+    Returns the world transforms of each mesh of an Assimp scene, one per node referencing the mesh.
+    Meshes that no node references keep their own space.
+    """
+    transforms = [[] for _ in scene.meshes]
+    # pyassimp resolves the mesh indices of the nodes to the mesh objects of the scene
+    index = {id(mesh): i for i, mesh in enumerate(scene.meshes)}
+
+    def visit(node, parent):
+        world = parent @ np.asarray(node.transformation, dtype=np.float64)
+        for mesh in node.meshes:
+            if id(mesh) in index:
+                transforms[index[id(mesh)]].append(world)
+        for child in node.children:
+            visit(child, world)
+
+    visit(scene.rootnode, np.eye(4))
+    return [mesh_transforms or [np.eye(4)] for mesh_transforms in transforms]
+
+
+def _transform_arrays(arrays, M):
+    """ Returns the arrays of a mesh moved by a 4x4 transform, normals by its inverse transpose """
+    if np.allclose(M, np.eye(4)):
+        return arrays
+
+    linear = M[:3, :3]
+    moved = dict(arrays)
+    moved['vertices'] = (arrays['vertices'] @ linear.T + M[:3, 3]).astype(np.float32)
+    if arrays['normals'] is not None:
+        moved['normals'] = mesh_kernels.normalize(arrays['normals'] @ np.linalg.inv(linear))
+    for name in ('tangents', 'bitangents'):
+        if arrays[name] is not None:
+            moved[name] = mesh_kernels.normalize(arrays[name] @ linear.T)
+    return moved
+
+
+def _merge_by_material(imported, transforms):
+    """
+    Merges the meshes that share a material, textures and vertex attributes into one mesh per
+    material, with the node transforms applied to their vertices.
+    :param imported: a list of (arrays, material) of each mesh, the arrays holding the faces
+    :param transforms: the world transforms of each mesh, see _node_transforms
+    :return: the list of (arrays, material) of the merged meshes, in order of first use
+    """
+    groups = {}
+    for (arrays, material), mesh_transforms in zip(imported, transforms):
+        present = tuple(name for name, array in arrays.items() if array is not None)
+        key = (json.dumps(material, sort_keys=True), present, arrays['faces'].shape[1:])
+        for M in mesh_transforms:
+            groups.setdefault(key, []).append((_transform_arrays(arrays, M), material))
+
+    merged = []
+    for parts in groups.values():
+        if len(parts) == 1:
+            merged.append(parts[0])
+            continue
+
+        # faces index the concatenated vertices, so each part is offset by the vertices before it
+        offsets = np.cumsum([0] + [len(arrays['vertices']) for arrays, _ in parts[:-1]])
+        first = parts[0][0]
+        arrays = {name: np.concatenate([part[name] for part, _ in parts]) if first[name] is not None else None
+                  for name in first if name != 'faces'}
+        arrays['faces'] = np.concatenate([part['faces'].astype(np.uint32) + np.uint32(offset) for (part, _), offset in zip(parts, offsets)])
+        merged.append((arrays, parts[0][1]))
+
+    return merged
+
+
+def _import_shared(path, flags):
+    """
+    Process pool worker: imports a model and copies its arrays into one shared memory block.
+    Returns the block name and the layout needed to read the arrays back.
+    """
+    records = ModelLoader()._import_meshes(path, **flags)
+
+    layout = []
+    offset = 0
+    for record in records:
+        entries = {}
+        for name, array in record['arrays'].items():
+            if array is None:
+                entries[name] = None
+                continue
+            array = np.ascontiguousarray(array)
+            offset += -offset % 16
+            entries[name] = (offset, array.shape, array.dtype.str)
+            offset += array.nbytes
+        layout.append((entries, record['material']))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (entries, _), record in zip(layout, records):
+        for name, entry in entries.items():
+            if entry is not None:
+                start, shape, dtype = entry
+                array = np.ascontiguousarray(record['arrays'][name])
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = array
+
+    # the block outlives the worker, it is unlinked by the main process once read
+    shm.close()
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm.name, layout
+
+
+def _unpack_shared(shm, layout):
+    """ Returns mesh records whose arrays are views of a block filled by _import_shared """
+    records = []
+    for entries, material in layout:
+        arrays = {}
+        for name, entry in entries.items():
+            if entry is None:
+                arrays[name] = None
+            else:
+                start, shape, dtype = entry
+                arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        records.append({'arrays': arrays, 'material': material})
+    return records
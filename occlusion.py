@@ -0,0 +1,295 @@
+import time
+
+import numpy as np
+
+from spatial_index import boxes_in_planes
+from culling import frustum_planes
+
+# Software occlusion culling: the boxes of the nearest occluders (the towers) are rasterized on the CPU
+# into a small depth buffer, reduced into a hierarchical-Z pyramid of the farthest depth under each
+# texel, and the screen rectangle of every other box is tested against the pyramid level where it
+# covers at most 2x2 texels. Depths are clip space w, the distance along the view direction.
+#
+# Both sides are conservative: an occluder face only covers the pixels it fully covers, at the depth
+# of its farthest corner, and a box is occluded only when its nearest corner is behind the farthest
+# depth under its whole rectangle. Boxes crossing the near plane are never occluders nor occluded.
+
+# size of the depth buffer, in pixels
+WIDTH = 160
+HEIGHT = 96
+# number of occluders rasterized per frame, nearest first
+MAX_OCCLUDERS = 48
+# corners closer than this to the camera plane are treated as crossing it
+MIN_DEPTH = 1e-3
+
+# the six faces of a box as cycles of corner indices, bit 0 of a corner selects the upper x, bit 1 y and bit 2 z
+BOX_FACES = np.array([
+    [0, 2, 6, 4], [1, 3, 7, 5],
+    [0, 1, 5, 4], [2, 3, 7, 6],
+    [0, 1, 3, 2], [4, 5, 7, 6],
+])
+
+
+def box_corners(boxes):
+    '''
+    Returns the (K, 8, 3) corners of (K, 2, 3) boxes.
+    '''
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 2, 3)
+    bits = (np.arange(8)[:, np.newaxis] >> np.arange(3)) & 1
+    return np.where(bits, boxes[:, np.newaxis, 1], boxes[:, np.newaxis, 0])
+
+
+def project_boxes(projection_view, boxes, width, height):
+    '''
+    Returns the (K, 8, 2) pixel coordinates and (K, 8) depths of the corners of (K, 2, 3) boxes.
+    '''
+    corners = box_corners(boxes)
+    m = np.asarray(projection_view, dtype=np.float32)
+    clip = corners @ m[:, :3].T + m[:, 3]
+    depth = clip[..., 3]
+    ndc = clip[..., :2] / np.where(depth > MIN_DEPTH, depth, 1.0)[..., np.newaxis]
+    return (ndc * 0.5 + 0.5) * np.array([width, height], dtype=np.float32), depth
+
+
+def camera_position(projection_view):
+    '''
+    Returns the position of the camera of a perspective projection @ view matrix, the point it maps to w = 0
+    on the view axis.
+    '''
+    eye = np.linalg.inv(np.asarray(projection_view, dtype=np.float64)) @ [0.0, 0.0, 1.0, 0.0]
+    return (eye[:3] / eye[3]).astype(np.float32)
+
+
+def rasterize_boxes(projection_view, boxes, width=WIDTH, height=HEIGHT):
+    '''
+    Returns the (height, width) depth buffer of (K, 2, 3) occluder boxes, inf where nothing is drawn.
+    '''
+    depth = np.full((height, width), np.inf, dtype=np.float32)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 2, 3)
+    screen, corner_depth = project_boxes(projection_view, boxes, width, height)
+
+    # only the faces towards the camera are drawn, the lower or upper face on each axis the camera is outside of
+    eye = camera_position(projection_view)
+    below, above = eye < boxes[:, 0], eye > boxes[:, 1]
+
+    for points, depths, lower_faces, upper_faces in zip(screen, corner_depth, below, above):
+        if depths.min() <= MIN_DEPTH:
+            continue
+        lower = np.maximum(np.floor(points.min(axis=0)).astype(int), 0)
+        upper = np.minimum(np.ceil(points.max(axis=0)).astype(int), [width, height])
+        faces = BOX_FACES[np.stack([lower_faces, upper_faces], axis=1).reshape(-1)]
+        if (upper <= lower).any() or len(faces) == 0:
+            continue
+        region = depth[lower[1]:upper[1], lower[0]:upper[0]]
+        # occluders are given nearest first, those already hidden by nearer ones add nothing
+        if region.max() < depths.min():
+            continue
+
+        # edges of each face, oriented so that the inside is on their left
+        starts = points[faces]
+        ends = np.roll(starts, -1, axis=1)
+        area = np.sum(starts[..., 0] * ends[..., 1] - ends[..., 0] * starts[..., 1], axis=1)
+        sign = np.sign(area)[:, np.newaxis]
+        dx = (ends[..., 0] - starts[..., 0]) * sign
+        dy = (ends[..., 1] - starts[..., 1]) * sign
+        # a pixel is fully inside an edge when its centre is at least half its extent along the edge normal
+        # inside, the edge function dx * (y - y0) - dy * (x - x0) is separated into its y and x terms
+        constant = dy * starts[..., 0] - dx * starts[..., 1] - 0.5 * (np.abs(dx) + np.abs(dy))
+
+        x = np.arange(lower[0], upper[0], dtype=np.float32) + 0.5
+        y = np.arange(lower[1], upper[1], dtype=np.float32) + 0.5
+        y_terms = (dx[..., np.newaxis] * y + constant[..., np.newaxis])[..., np.newaxis]
+        x_terms = (dy[..., np.newaxis] * x)[:, :, np.newaxis]
+        covered = np.logical_and.reduce(y_terms >= x_terms, axis=1) & (area != 0)[:, np.newaxis, np.newaxis]
+
+        face_depth = depths[faces].max(axis=1)
+        box_depth = np.where(covered, face_depth[:, np.newaxis, np.newaxis], np.inf).min(axis=0)
+        np.minimum(region, box_depth, out=region)
+
+    return depth
+
+
+def build_pyramid(depth):
+    '''
+    Returns the hierarchical-Z pyramid of a depth buffer, each level holding the farthest depth of 2x2
+    texels of the level below, down to a single texel.
+    '''
+    pyramid = [depth]
+    while depth.shape != (1, 1):
+        height, width = depth.shape
+        padded = np.full((height + height % 2, width + width % 2), np.inf, dtype=np.float32)
+        padded[:height, :width] = depth
+        depth = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+        pyramid.append(depth)
+    return pyramid
+
+
+def boxes_occluded(projection_view, pyramid, boxes):
+    '''
+    Returns the (K,) mask of the (K, 2, 3) boxes hidden behind the depths of a hierarchical-Z pyramid.
+    '''
+    height, width = pyramid[0].shape
+    screen, corner_depth = project_boxes(projection_view, boxes, width, height)
+    occluded = np.zeros(len(screen), dtype=bool)
+
+    lower = np.floor(screen.min(axis=1)).astype(int)
+    upper = np.floor(screen.max(axis=1)).astype(int)
+    nearest = corner_depth.min(axis=1)
+    # boxes crossing the near plane, or fully outside the buffer, are left to the frustum test
+    testable = (nearest > MIN_DEPTH) & (upper >= 0).all(axis=1) & (lower < [width, height]).all(axis=1)
+    lower = np.clip(lower, 0, [width - 1, height - 1])
+    upper = np.clip(upper, 0, [width - 1, height - 1])
+
+    # the level where the rectangle spans at most 2x2 texels
+    size = (upper - lower + 1).max(axis=1)
+    levels = np.minimum(np.ceil(np.log2(size)).astype(int), len(pyramid) - 1)
+
+    for level in np.unique(levels[testable]):
+        boxes_at_level = np.flatnonzero(testable & (levels == level))
+        x0, y0 = (lower[boxes_at_level] >> level).T
+        x1, y1 = (upper[boxes_at_level] >> level).T
+        texels = pyramid[level]
+        farthest = np.maximum.reduce([texels[y0, x0], texels[y0, x1], texels[y1, x0], texels[y1, x1]])
+        occluded[boxes_at_level] = nearest[boxes_at_level] > farthest
+
+    return occluded
+
+
+class OcclusionCuller:
+    '''
+    Rasterizes the nearest occluders once per camera view and culls the boxes they hide, counting the
+    boxes tested and occluded during each frame.
+    '''
+
+    def __init__(self, width=WIDTH, height=HEIGHT, max_occluders=MAX_OCCLUDERS):
+        self.enabled = True
+        # models only cull their boxes during the main pass of a frame, not for the faces of environment maps
+        self.active = False
+        self.width = width
+        self.height = height
+        self.max_occluders = max_occluders
+        # models whose instance boxes hide what is behind them
+        self.occluders = []
+        # the pyramid is built again only when the camera matrices or the occluders change
+        self._projection_view = None
+        self._pyramid = None
+        self._key = None
+        # boxes tested and occluded during the current frame, and the time spent building pyramids
+        self.tested = 0
+        self.occluded = 0
+        self.build_time = 0.0
+
+    def begin_pass(self, camera):
+        """ Start the main pass of a frame, models cull their boxes until end_pass """
+        self.active = self.enabled and camera is not None
+
+    def end_pass(self):
+        """ End the main pass, other passes draw without rasterizing the occluders for their own view """
+        self.active = False
+
+    def add_occluder(self, model):
+        """ Rasterize the instances of an instanced model as occluders """
+        self.occluders.append(model)
+
+    def get_occluder_boxes(self):
+        """ Return the world space boxes of every occluder instance """
+        boxes = [model.get_instance_bounds()[0] for model in self.occluders]
+        return np.concatenate(boxes) if boxes else np.zeros((0, 2, 3), dtype=np.float32)
+
+    def get_pyramid(self, camera):
+        """ Return the hierarchical-Z pyramid of the occluders seen by the camera """
+        projection_view = np.array(camera.projection()) @ np.array(camera.view())
+        boxes = self.get_occluder_boxes()
+        key = (projection_view.tobytes(), len(boxes))
+        if key != self._key:
+            start = time.perf_counter()
+            # the nearest occluders inside the frustum
+            outside, _ = boxes_in_planes(frustum_planes(projection_view), boxes)
+            boxes = boxes[~outside]
+            distances = np.linalg.norm(boxes.mean(axis=1) - camera_position(projection_view), axis=1)
+            boxes = boxes[np.argsort(distances)[:self.max_occluders]]
+
+            self._pyramid = build_pyramid(rasterize_boxes(projection_view, boxes, self.width, self.height))
+            self._projection_view = projection_view
+            self._key = key
+            self.build_time += time.perf_counter() - start
+        return self._pyramid
+
+    def cull(self, camera, boxes):
+        """ Return the mask of the (K, 2, 3) boxes hidden from the camera by the occluders """
+        pyramid = self.get_pyramid(camera)
+        occluded = boxes_occluded(self._projection_view, pyramid, boxes)
+        self.tested += len(occluded)
+        self.occluded += int(np.count_nonzero(occluded))
+        return occluded
+
+    def reset_counters(self):
+        """ Return the boxes tested and occluded and the pyramid build time of the last frame, then reset them """
+        counters = (self.tested, self.occluded, self.build_time)
+        self.tested = 0
+        self.occluded = 0
+        self.build_time = 0.0
+        return counters
+
+
+# every model is tested against the same occluders
+occlusion_culler = OcclusionCuller()
+
+
+if __name__ == "__main__":
+    # Look down a street of a grid city at ground level, check the result against the known layout and
+    # report the occlusion rate and the time spent on each step
+    import glm
+
+    projection = np.array(glm.perspective(glm.radians(45), 1.5, 0.1, 1000))
+    view = np.array(glm.lookAt(glm.vec3(0, 2, 0), glm.vec3(30, 2, 1), glm.vec3(0, 1, 0)))
+    projection_view = projection @ view
+
+    # a wall in front of the camera hides a box behind it, a box beside it stays visible
+    wall = np.array([[[10, 0, -20], [11, 30, 20]]], dtype=np.float32)
+    pyramid = build_pyramid(rasterize_boxes(projection_view, wall))
+    tests = np.array([[[20, 0, -1], [22, 3, 1]], [[5, 0, -1], [6, 3, 1]], [[20, 0, 60], [22, 3, 62]]], dtype=np.float32)
+    assert boxes_occluded(projection_view, pyramid, tests).tolist() == [True, False, False]
+
+    # towers on a grid, with the camera between two rows
+    rng = np.random.default_rng(0)
+    x, z = np.meshgrid(np.arange(-20, 20) * 12.0, np.arange(-20, 20) * 12.0)
+    centers = np.stack([x.ravel(), np.zeros(x.size), z.ravel() + 6.0], axis=1)
+    heights = rng.uniform(10, 60, len(centers))
+    boxes = np.stack([centers - [4, 0, 4], centers + np.stack([np.full(len(centers), 4), heights, np.full(len(centers), 4)], axis=1)], axis=1).astype(np.float32)
+
+    outside, _ = boxes_in_planes(frustum_planes(projection_view), boxes)
+    candidates = boxes[~outside]
+    distances = np.linalg.norm(candidates.mean(axis=1) - [0, 2, 0], axis=1)
+    occluders = candidates[np.argsort(distances)[:MAX_OCCLUDERS]]
+
+    start = time.perf_counter()
+    depth = rasterize_boxes(projection_view, occluders)
+    raster_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pyramid = build_pyramid(depth)
+    pyramid_time = time.perf_counter() - start
+    start = time.perf_counter()
+    occluded = boxes_occluded(projection_view, pyramid, candidates)
+    test_time = time.perf_counter() - start
+
+    # an occluder does not hide itself
+    for box in occluders[:8]:
+        alone = build_pyramid(rasterize_boxes(projection_view, box[np.newaxis]))
+        assert not boxes_occluded(projection_view, alone, box[np.newaxis])[0]
+
+    # every point sampled on the occluded boxes is behind an occluder: the segment from the camera to
+    # the point enters an occluder box before its end (slab test)
+    eye = np.array([0, 2, 0], dtype=np.float32)
+    for box in candidates[occluded]:
+        points = box[0] + rng.random((64, 3)) * (box[1] - box[0])
+        direction = points - eye
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0 = (occluders[:, np.newaxis, 0] - eye) / direction
+            t1 = (occluders[:, np.newaxis, 1] - eye) / direction
+        enter = np.nanmax(np.minimum(t0, t1), axis=2)
+        leave = np.nanmin(np.maximum(t0, t1), axis=2)
+        assert ((enter <= leave) & (enter > 0) & (enter < 1)).any(axis=0).all()
+    print(f'{len(candidates)} towers in the frustum, {len(occluders)} occluders rasterized at {WIDTH}x{HEIGHT}: '
+          f'{occluded.mean():.1%} occluded')
+    print(f'rasterize {raster_time * 1000:.2f} ms, pyramid {pyramid_time * 1000:.2f} ms, test {test_time * 1000:.2f} ms')
@@ -0,0 +1,261 @@
+import ctypes
+
+import OpenGL.GL as gl
+import numpy as np
+
+from shaders import BaseShaderProgram
+from vao import VertexArray
+from vbo import VertexBuffer, BufferLayout, BufferElement, BufferType
+from ibo import IndexBuffer
+from gl_state import state_cache
+from occlusion import BOX_FACES, box_corners, camera_position
+
+# Hardware occlusion queries with coherent hierarchical culling style scheduling: the bounding box of
+# an object is drawn with colour and depth writes off inside a GL_ANY_SAMPLES_PASSED query (a
+# GL_SAMPLES_PASSED one on contexts older than 3.3 without ARB_occlusion_query2), and the result is
+# read back frames later, only once available, so the CPU never waits on the GPU.
+#
+# Visibility is assumed to stay the same from one frame to the next: objects found visible are queried
+# again every VISIBLE_INTERVAL frames only, spread over the frames, objects found hidden every frame,
+# within a budget of queries per frame. Models draw under glBeginConditionalRender on their last query
+# so that the GPU skips them when the box was hidden, without the CPU knowing the result. Instanced
+# models query the boxes of their instances after drawing them, and leave the instances last found
+# hidden out of the next upload.
+
+# frames between two queries of an object found visible
+VISIBLE_INTERVAL = 8
+# queries issued per frame at most, over every model
+MAX_QUERIES = 128
+# boxes are grown by this part of their size, and by the margin in world units, so that an object drawn
+# before its box does not hide it and a box almost containing the camera counts as visible
+BOX_SCALE = 0.02
+BOX_MARGIN = 0.05
+# boxes closer than this to the camera are visible without a query, their faces could be clipped
+NEAR_MARGIN = 1.0
+
+
+class OcclusionBoxShader(BaseShaderProgram):
+    '''
+    Draws the unit cube scaled onto the box tested by a query, the colour is masked out.
+    '''
+
+    def __init__(self):
+        BaseShaderProgram.__init__(self, 'occlusion_box')
+
+
+class QuerySet:
+    '''
+    The occlusion queries of the parts of one model (the model itself, or each of its instances) and
+    the visibility they last returned.
+    '''
+
+    def __init__(self):
+        self.queries = np.zeros(0, dtype=np.uint32)
+        # result of the last query read, queries waiting for their result, and the frame of the last query
+        self.visible = np.ones(0, dtype=bool)
+        self.pending = np.zeros(0, dtype=bool)
+        self.issued = np.zeros(0, dtype=bool)
+        self.last_query = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def resize(self, count, frame, interval):
+        """ Add queries up to the given count, the new parts are visible and due over the next frames """
+        extra = count - len(self.queries)
+        if extra <= 0:
+            return
+        self.queries = np.concatenate([self.queries, np.atleast_1d(gl.glGenQueries(extra)).astype(np.uint32)])
+        self.visible = np.concatenate([self.visible, np.ones(extra, dtype=bool)])
+        self.pending = np.concatenate([self.pending, np.zeros(extra, dtype=bool)])
+        self.issued = np.concatenate([self.issued, np.zeros(extra, dtype=bool)])
+        self.last_query = np.concatenate([self.last_query, frame - np.random.randint(interval, size=extra)])
+
+    def release(self):
+        """ Delete the queries """
+        if len(self.queries):
+            gl.glDeleteQueries(len(self.queries), self.queries)
+        self.__init__()
+
+
+class OcclusionQueries:
+    '''
+    Schedules the occlusion queries of the models that opted in, reads back their results without
+    waiting, and counts the queries issued and the objects skipped during each frame.
+    '''
+
+    def __init__(self, interval=VISIBLE_INTERVAL, max_queries=MAX_QUERIES):
+        # opt-in: models only query their boxes when enabled and during the main pass of a frame
+        self.enabled = False
+        self.active = False
+        self.interval = interval
+        self.max_queries = max_queries
+        self.frame = 0
+        self._sets = []
+        self._budget = 0
+        self._eye = None
+        # the box program, unit cube and query target, created with the first query as they need a GL context
+        self._shader = None
+        self._vao = None
+        self._target = None
+        # queries issued, objects last found hidden and draws conditioned on a query during the current frame
+        self.issued = 0
+        self.hidden = 0
+        self.conditional = 0
+
+    def create_set(self):
+        """ Return a new set of queries, polled every frame until released """
+        query_set = QuerySet()
+        self._sets.append(query_set)
+        return query_set
+
+    def release_set(self, query_set):
+        """ Delete the queries of a set """
+        if query_set in self._sets:
+            self._sets.remove(query_set)
+        query_set.release()
+
+    def begin_pass(self, camera):
+        """ Start the main pass of a frame: read the results available and reset the query budget """
+        if not self.enabled or camera is None:
+            return
+        self.active = True
+        self.frame += 1
+        self._budget = self.max_queries
+        self._eye = camera_position(np.array(camera.projection()) @ np.array(camera.view()))
+        self.poll()
+
+    def end_pass(self):
+        """ End the main pass, queries are not issued by other passes such as environment map faces """
+        self.active = False
+
+    def poll(self):
+        """ Read the results of the pending queries that are available, never waits for the others """
+        for query_set in self._sets:
+            for row in np.flatnonzero(query_set.pending):
+                query = int(query_set.queries[row])
+                if gl.glGetQueryObjectuiv(query, gl.GL_QUERY_RESULT_AVAILABLE):
+                    query_set.visible[row] = bool(gl.glGetQueryObjectuiv(query, gl.GL_QUERY_RESULT))
+                    query_set.pending[row] = False
+
+    def visible(self, query_set, rows, count):
+        """
+        Return the mask of the given parts of a set whose last result was visible, growing the set to count parts.
+        """
+        query_set.resize(count, self.frame, self.interval)
+        visible = query_set.visible[rows]
+        self.hidden += len(visible) - int(np.count_nonzero(visible))
+        return visible
+
+    def schedule(self, query_set, rows):
+        """
+        Return the parts of a set to query this frame among the given ones: those found hidden, and those
+        found visible more than interval frames ago, least recently queried first, within the budget.
+        """
+        rows = np.asarray(rows)
+        due = rows[~query_set.pending[rows] & (~query_set.visible[rows] | (self.frame - query_set.last_query[rows] >= self.interval))]
+        due = due[np.argsort(query_set.last_query[due], kind='stable')][:self._budget]
+        return due
+
+    def issue(self, query_set, rows, boxes):
+        """
+        Draw the (K, 2, 3) boxes of the given parts of a set, each inside its own query.
+        :return: the parts queried, boxes next to the camera are set visible instead
+        """
+        if len(rows) == 0:
+            return rows
+        self._budget -= len(rows)
+        query_set.last_query[rows] = self.frame
+
+        boxes = np.asarray(boxes, dtype=np.float32)
+        extent = boxes[:, 1] - boxes[:, 0]
+        boxes = boxes + np.array([-1, 1])[np.newaxis, :, np.newaxis] * (extent * BOX_SCALE + BOX_MARGIN)[:, np.newaxis]
+
+        # the camera is inside or right next to these boxes, they are visible and their faces may be clipped
+        near = ((self._eye > boxes[:, 0] - NEAR_MARGIN) & (self._eye < boxes[:, 1] + NEAR_MARGIN)).all(axis=1)
+        query_set.visible[rows[near]] = True
+        rows, boxes = rows[~near], boxes[~near]
+        if len(rows) == 0:
+            return rows
+
+        self.bind()
+        for row, (lower, upper) in zip(rows, boxes):
+            M = np.diag(np.append(upper - lower, 1.0)).astype(np.float32)
+            M[:3, 3] = lower
+            self._shader.uniforms['M'].bind(M)
+            gl.glBeginQuery(self._target, int(query_set.queries[row]))
+            gl.glDrawElements(gl.GL_TRIANGLES, len(BOX_FACES) * 6, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+            gl.glEndQuery(self._target)
+        self.unbind()
+
+        query_set.pending[rows] = True
+        query_set.issued[rows] = True
+        self.issued += len(rows)
+        return rows
+
+    def condition(self, query_set, box):
+        """
+        Query the box of a single part set when due, and return the query its draw is conditioned on, or
+        None when it was last found visible and is not queried this frame.
+        """
+        query_set.resize(1, self.frame, self.interval)
+        queried = self.issue(query_set, self.schedule(query_set, np.zeros(1, dtype=np.int64)), np.asarray(box)[np.newaxis])
+
+        if not query_set.visible[0]:
+            self.hidden += 1
+        if not query_set.issued[0] or (query_set.visible[0] and not len(queried)):
+            return None
+        self.conditional += 1
+        return int(query_set.queries[0])
+
+    def get_target(self):
+        """ Return GL_ANY_SAMPLES_PASSED when the context supports it, GL_SAMPLES_PASSED otherwise """
+        version = (int(gl.glGetIntegerv(gl.GL_MAJOR_VERSION)), int(gl.glGetIntegerv(gl.GL_MINOR_VERSION)))
+        if version >= (3, 3):
+            return gl.GL_ANY_SAMPLES_PASSED
+        extensions = {gl.glGetStringi(gl.GL_EXTENSIONS, index) for index in range(int(gl.glGetIntegerv(gl.GL_NUM_EXTENSIONS)))}
+        if b'GL_ARB_occlusion_query2' in extensions:
+            return gl.GL_ANY_SAMPLES_PASSED
+        print('(W) Warning: GL_ANY_SAMPLES_PASSED is not supported, occlusion queries count samples instead')
+        return gl.GL_SAMPLES_PASSED
+
+    def bind(self):
+        """ Bind the box program and unit cube, with colour and depth writes off """
+        if self._shader is None:
+            self._target = self.get_target()
+            self._shader = OcclusionBoxShader()
+            self._shader.compile({'position': 0})
+            # buffers are created with no vertex array bound, so that no vertex array captures the index buffer
+            state_cache.bind_vertex_array(0)
+            self._vao = VertexArray()
+            vbo = VertexBuffer(box_corners(np.array([[0, 0, 0], [1, 1, 1]]))[0].astype(np.float32))
+            vbo.set_layout(BufferLayout([BufferElement(BufferType.FLOAT_3)]))
+            self._vao.add_vertex_buffer(vbo)
+            self._vao.set_index_buffer(IndexBuffer(BOX_FACES[:, [0, 1, 2, 0, 2, 3]].reshape(-1).astype(np.uint8)))
+
+        state_cache.use_program(self._shader.program)
+        self._vao.bind()
+        self._cull_face = state_cache.is_enabled(gl.GL_CULL_FACE)
+        # boxes the camera looks at from the inside still need their back faces
+        state_cache.disable(gl.GL_CULL_FACE)
+        state_cache.set_depth_mask(False)
+        gl.glColorMask(gl.GL_FALSE, gl.GL_FALSE, gl.GL_FALSE, gl.GL_FALSE)
+
+    def unbind(self):
+        """ Restore colour and depth writes """
+        gl.glColorMask(gl.GL_TRUE, gl.GL_TRUE, gl.GL_TRUE, gl.GL_TRUE)
+        state_cache.set_depth_mask(True)
+        if self._cull_face:
+            state_cache.enable(gl.GL_CULL_FACE)
+
+    def reset_counters(self):
+        """ Return the queries issued, objects skipped and conditional draws of the last frame, then reset them """
+        counters = (self.issued, self.hidden, self.conditional)
+        self.issued = 0
+        self.hidden = 0
+        self.conditional = 0
+        return counters
+
+
+# every model shares the query scheduling and its budget
+occlusion_queries = OcclusionQueries()
@@ -0,0 +1,250 @@
+import numpy as np
+
+import mesh_kernels
+
+# Vectorised generators for the procedural primitives. Every generator returns a dict of float32
+# arrays (uint32 for faces) with the keys used by Mesh: vertices, faces, normals, textureCoords,
+# tangents and bitangents. Use get() to share the arrays between meshes.
+
+_cache = {}
+
+
+def get(primitive, *resolution, inside=True):
+    '''
+    Returns the arrays of a primitive, generated on first use and shared afterwards. The arrays are
+    read only, assign a modified copy to a mesh rather than changing them in place.
+    :param primitive: 'sphere', 'cube', 'plane', 'cylinder' or 'grid'
+    :param resolution: the resolution arguments of the generator
+    :param inside: the winding, False reverses the faces
+    '''
+    key = (primitive, resolution, inside)
+    arrays = _cache.get(key)
+
+    if arrays is None:
+        arrays = GENERATORS[primitive](*resolution)
+        if not inside:
+            arrays = _flip_winding(arrays)
+
+        for array in arrays.values():
+            if array is not None:
+                array.setflags(write=False)
+        _cache[key] = arrays
+
+    return arrays
+
+
+def _flip_winding(arrays):
+    arrays = dict(arrays)
+    if arrays['faces'] is not None:
+        arrays['faces'] = np.ascontiguousarray(arrays['faces'][:, [0, 2, 1]])
+    else:
+        # unindexed primitives are drawn in vertex order, swap the last two vertices of each triangle
+        order = np.arange(len(arrays['vertices'])).reshape(-1, 3)[:, [0, 2, 1]].reshape(-1)
+        for name, array in arrays.items():
+            if array is not None and name != 'faces':
+                arrays[name] = np.ascontiguousarray(array[order])
+    return arrays
+
+
+def _with_tangents(vertices, faces, textureCoords, normals=None, weighting='area'):
+    if normals is None:
+        normals = mesh_kernels.vertex_normals(vertices, faces, weighting)
+    tangents, bitangents, _ = mesh_kernels.vertex_tangents(vertices, faces, textureCoords, normals)
+    return normals, tangents, bitangents
+
+
+def sphere(nvert=50, nhoriz=100):
+    '''
+    Unit UV sphere with nvert - 1 rings of nhoriz vertices between the two poles.
+    '''
+    n = (nvert - 1) * nhoriz + 2
+
+    # ring i, segment j -> vertex 1 + i * nhoriz + j
+    i = np.arange(nvert - 1, dtype=np.float32)[:, np.newaxis]
+    j = np.arange(nhoriz, dtype=np.float32)[np.newaxis, :]
+    theta = (i + 1) * np.float32(np.pi / nvert)
+    phi = j * np.float32(2. * np.pi / nhoriz)
+
+    vertices = np.zeros((n, 3), dtype=np.float32)
+    vertices[0] = [0., 1., 0.]
+    vertices[-1] = [0., -1., 0.]
+    vertices[1:-1, 0] = (np.sin(theta) * np.cos(phi)).reshape(-1)
+    vertices[1:-1, 1] = np.broadcast_to(np.cos(theta), (nvert - 1, nhoriz)).reshape(-1)
+    vertices[1:-1, 2] = (np.sin(theta) * np.sin(phi)).reshape(-1)
+
+    textureCoords = np.zeros((n, 2), dtype=np.float32)
+    textureCoords[1:-1, 0] = np.broadcast_to(j / nhoriz, (nvert - 1, nhoriz)).reshape(-1)
+    textureCoords[1:-1, 1] = np.broadcast_to(i / nvert, (nvert - 1, nhoriz)).reshape(-1)
+
+    # pole fans, the top and bottom triangles of each segment are interleaved
+    s = np.arange(nhoriz - 1)
+    lastrow = n - nhoriz - 2
+    top = np.stack([np.zeros_like(s), s + 2, s + 1], axis=1)
+    bottom = np.stack([lastrow + s + 2, np.full_like(s, n - 1), lastrow + s + 1], axis=1)
+    caps = np.concatenate([
+        np.stack([top, bottom], axis=1).reshape(-1, 3),
+        [[0, 1, nhoriz], [lastrow + 1, n - 1, n - 2]],
+    ])
+
+    # quads between consecutive rings, two triangles each, plus the two closing the ring
+    r = np.arange(1, nvert - 1)[:, np.newaxis]
+    lastrow = nhoriz * (r - 1) + 1
+    row = nhoriz * r + 1
+    s = s[np.newaxis, :]
+    a = np.stack(np.broadcast_arrays(row + s, lastrow + s, row + s + 1), axis=-1)
+    b = np.stack(np.broadcast_arrays(row + s + 1, lastrow + s, lastrow + s + 1), axis=-1)
+    last = np.stack([
+        np.concatenate([row + nhoriz - 1, lastrow + nhoriz - 1, row], axis=1),
+        np.concatenate([row, lastrow + nhoriz - 1, lastrow], axis=1),
+    ], axis=1)
+    body = np.concatenate([np.stack([a, b], axis=2).reshape(nvert - 2, -1, 3), last], axis=1)
+
+    faces = np.concatenate([caps, body.reshape(-1, 3)]).astype(np.uint32)
+
+    # the triangles shrink towards the poles, angle weighting keeps the normals radial there
+    normals, tangents, bitangents = _with_tangents(vertices, faces, textureCoords, weighting='angle')
+    return {'vertices': vertices, 'faces': faces, 'normals': normals, 'textureCoords': textureCoords,
+            'tangents': tangents, 'bitangents': bitangents}
+
+
+def plane():
+    '''
+    Unit square in the XY plane facing +Z.
+    '''
+    vertices = np.array([[-1., -1., 0.], [1., -1., 0.], [-1., 1., 0.], [1., 1., 0.]], dtype=np.float32)
+    faces = np.array([[0, 1, 2], [1, 3, 2]], dtype=np.uint32)
+    textureCoords = np.array([[0., 0.], [1., 0.], [0., 1.], [1., 1.]], dtype=np.float32)
+
+    normals, tangents, bitangents = _with_tangents(vertices, faces, textureCoords)
+    return {'vertices': vertices, 'faces': faces, 'normals': normals, 'textureCoords': textureCoords,
+            'tangents': tangents, 'bitangents': bitangents}
+
+
+def cube():
+    '''
+    Unindexed cube from -1 to 1, 6 faces of 2 triangles with their own normals and texture coordinates.
+    '''
+    # vertices, normals, texture coords
+    vertices = np.array([
+        [-1.0, -1.0, -1.0,  0.0,  0.0, -1.0, 0.0, 0.0,],
+        [ 1.0,  1.0, -1.0,  0.0,  0.0, -1.0, 1.0, 1.0,],
+        [ 1.0, -1.0, -1.0,  0.0,  0.0, -1.0, 1.0, 0.0,],
+        [ 1.0,  1.0, -1.0,  0.0,  0.0, -1.0, 1.0, 1.0,],
+        [-1.0, -1.0, -1.0,  0.0,  0.0, -1.0, 0.0, 0.0,],
+        [-1.0,  1.0, -1.0,  0.0,  0.0, -1.0, 0.0, 1.0,],
+        [-1.0, -1.0,  1.0,  0.0,  0.0,  1.0, 0.0, 0.0,],
+        [ 1.0, -1.0,  1.0,  0.0,  0.0,  1.0, 1.0, 0.0,],
+        [ 1.0,  1.0,  1.0,  0.0,  0.0,  1.0, 1.0, 1.0,],
+        [ 1.0,  1.0,  1.0,  0.0,  0.0,  1.0, 1.0, 1.0,],
+        [-1.0,  1.0,  1.0,  0.0,  0.0,  1.0, 0.0, 1.0,],
+        [-1.0, -1.0,  1.0,  0.0,  0.0,  1.0, 0.0, 0.0,],
+        [-1.0,  1.0,  1.0, -1.0,  0.0,  0.0, 1.0, 0.0,],
+        [-1.0,  1.0, -1.0, -1.0,  0.0,  0.0, 1.0, 1.0,],
+        [-1.0, -1.0, -1.0, -1.0,  0.0,  0.0, 0.0, 1.0,],
+        [-1.0, -1.0, -1.0, -1.0,  0.0,  0.0, 0.0, 1.0,],
+        [-1.0, -1.0,  1.0, -1.0,  0.0,  0.0, 0.0, 0.0,],
+        [-1.0,  1.0,  1.0, -1.0,  0.0,  0.0, 1.0, 0.0,],
+        [ 1.0,  1.0,  1.0,  1.0,  0.0,  0.0, 1.0, 0.0,],
+        [ 1.0, -1.0, -1.0,  1.0,  0.0,  0.0, 0.0, 1.0,],
+        [ 1.0,  1.0, -1.0,  1.0,  0.0,  0.0, 1.0, 1.0,],
+        [ 1.0, -1.0, -1.0,  1.0,  0.0,  0.0, 0.0, 1.0,],
+        [ 1.0,  1.0,  1.0,  1.0,  0.0,  0.0, 1.0, 0.0,],
+        [ 1.0, -1.0,  1.0,  1.0,  0.0,  0.0, 0.0, 0.0,],
+        [-1.0, -1.0, -1.0,  0.0, -1.0,  0.0, 0.0, 1.0,],
+        [ 1.0, -1.0, -1.0,  0.0, -1.0,  0.0, 1.0, 1.0,],
+        [ 1.0, -1.0,  1.0,  0.0, -1.0,  0.0, 1.0, 0.0,],
+        [ 1.0, -1.0,  1.0,  0.0, -1.0,  0.0, 1.0, 0.0,],
+        [-1.0, -1.0,  1.0,  0.0, -1.0,  0.0, 0.0, 0.0,],
+        [-1.0, -1.0, -1.0,  0.0, -1.0,  0.0, 0.0, 1.0,],
+        [-1.0,  1.0, -1.0,  0.0,  1.0,  0.0, 0.0, 1.0,],
+        [ 1.0,  1.0 , 1.0,  0.0,  1.0,  0.0, 1.0, 0.0,],
+        [ 1.0,  1.0, -1.0,  0.0,  1.0,  0.0, 1.0, 1.0,],
+        [ 1.0,  1.0,  1.0,  0.0,  1.0,  0.0, 1.0, 0.0,],
+        [-1.0,  1.0, -1.0,  0.0,  1.0,  0.0, 0.0, 1.0,],
+        [-1.0,  1.0,  1.0,  0.0,  1.0,  0.0, 0.0, 0.0 ],
+    ], dtype='f')
+
+    positions = np.ascontiguousarray(vertices[:, :3])
+    normals = np.ascontiguousarray(vertices[:, 3:6])
+    textureCoords = np.ascontiguousarray(vertices[:, 6:])
+
+    faces = np.arange(len(positions), dtype=np.uint32).reshape(-1, 3)
+    _, tangents, bitangents = _with_tangents(positions, faces, textureCoords, normals)
+    return {'vertices': positions, 'faces': None, 'normals': normals, 'textureCoords': textureCoords,
+            'tangents': tangents, 'bitangents': bitangents}
+
+
+def grid(nx=10, nz=10):
+    '''
+    Flat grid of nx by nz quads in the XZ plane from -1 to 1, facing +Y.
+    '''
+    x, z = np.meshgrid(np.linspace(-1., 1., nx + 1, dtype=np.float32), np.linspace(-1., 1., nz + 1, dtype=np.float32))
+    vertices = np.stack([x.reshape(-1), np.zeros(x.size, dtype=np.float32), z.reshape(-1)], axis=1)
+    textureCoords = np.stack([(x.reshape(-1) + 1) / 2, (z.reshape(-1) + 1) / 2], axis=1).astype(np.float32)
+
+    # quad (i, j) has corners a, a + 1, a + nx + 1, a + nx + 2
+    a = (np.arange(nz)[:, np.newaxis] * (nx + 1) + np.arange(nx)[np.newaxis, :]).reshape(-1)
+    faces = np.concatenate([
+        np.stack([a, a + nx + 1, a + 1], axis=1),
+        np.stack([a + 1, a + nx + 1, a + nx + 2], axis=1),
+    ], axis=1).reshape(-1, 3).astype(np.uint32)
+
+    normals, tangents, bitangents = _with_tangents(vertices, faces, textureCoords)
+    return {'vertices': vertices, 'faces': faces, 'normals': normals, 'textureCoords': textureCoords,
+            'tangents': tangents, 'bitangents': bitangents}
+
+
+def cylinder(segments=32):
+    '''
+    Capped cylinder of radius 1 from y = -1 to 1. The side and the caps have separate vertices so
+    the edges stay sharp.
+    '''
+    phi = np.linspace(0., 2. * np.pi, segments + 1, dtype=np.float32)
+    ring = np.stack([np.cos(phi), np.zeros_like(phi), np.sin(phi)], axis=1)
+
+    # side: a bottom and a top ring, the seam is duplicated for the texture coordinates
+    side_vertices = np.concatenate([ring + [0., -1., 0.], ring + [0., 1., 0.]]).astype(np.float32)
+    side_normals = np.concatenate([ring, ring]).astype(np.float32)
+    side_uvs = np.concatenate([
+        np.stack([phi / (2. * np.pi), np.zeros_like(phi)], axis=1),
+        np.stack([phi / (2. * np.pi), np.ones_like(phi)], axis=1),
+    ]).astype(np.float32)
+
+    s = np.arange(segments)
+    top = segments + 1
+    side_faces = np.concatenate([
+        np.stack([s, s + top, s + 1], axis=1),
+        np.stack([s + 1, s + top, s + top + 1], axis=1),
+    ], axis=1).reshape(-1, 3)
+
+    # caps: a centre vertex and a ring each
+    cap_vertices, cap_normals, cap_uvs, cap_faces = [], [], [], []
+    offset = len(side_vertices)
+    for y in [-1., 1.]:
+        centre = offset
+        cap_vertices.append(np.concatenate([[[0., y, 0.]], ring[:-1] + [0., y, 0.]]))
+        cap_normals.append(np.tile([0., y, 0.], (segments + 1, 1)))
+        cap_uvs.append(np.concatenate([[[0.5, 0.5]], ring[:-1][:, [0, 2]] * 0.5 + 0.5]))
+        rim = centre + 1 + s
+        next_rim = centre + 1 + (s + 1) % segments
+        # counter clockwise seen from outside the cap
+        cap_faces.append(np.stack([np.full_like(s, centre), next_rim, rim] if y > 0 else [np.full_like(s, centre), rim, next_rim], axis=1))
+        offset += segments + 1
+
+    vertices = np.concatenate([side_vertices] + cap_vertices).astype(np.float32)
+    normals = np.concatenate([side_normals] + cap_normals).astype(np.float32)
+    textureCoords = np.concatenate([side_uvs] + cap_uvs).astype(np.float32)
+    faces = np.concatenate([side_faces] + cap_faces).astype(np.uint32)
+
+    _, tangents, bitangents = _with_tangents(vertices, faces, textureCoords, normals)
+    return {'vertices': vertices, 'faces': faces, 'normals': normals, 'textureCoords': textureCoords,
+            'tangents': tangents, 'bitangents': bitangents}
+
+
+GENERATORS = {
+    'sphere': sphere,
+    'cube': cube,
+    'plane': plane,
+    'cylinder': cylinder,
+    'grid': grid,
+}
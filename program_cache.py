@@ -0,0 +1,135 @@
+import hashlib
+import os
+
+import OpenGL.GL as gl
+import numpy as np
+
+class ProgramCache:
+    '''
+    Shares linked shader programs between shader objects built from identical sources, and
+    persists the linked binaries to disk so that later runs can skip GLSL compilation.
+    '''
+
+    def __init__(self, directory='.cache/shaders'):
+        """
+        Create the cache.
+        :param directory: the directory the program binaries are stored in
+        """
+        self.directory = directory
+        # key -> (program, shared state of the program)
+        self._programs = {}
+        self._binaries_supported = None
+        self._driver = None
+
+        self.hits = 0
+        self.misses = 0
+        self.binary_hits = 0
+
+    @staticmethod
+    def key(vertex_source, fragment_source, attributes):
+        """
+        Return the key of a program.
+        :param vertex_source: the preprocessed vertex shader source
+        :param fragment_source: the preprocessed fragment shader source
+        :param attributes: the attribute name to location bindings of the program
+        """
+        h = hashlib.sha256()
+        h.update(vertex_source.encode())
+        h.update(b'\0')
+        h.update(fragment_source.encode())
+        for name, location in sorted(attributes.items()):
+            h.update('\0{}={}'.format(name, location).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Return the (program, state) pair stored for the key, or None """
+        entry = self._programs.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def add(self, key, program, state):
+        """ Share a linked program and its state under the key """
+        self._programs[key] = (program, state)
+
+    def binaries_supported(self):
+        """ Return True if the driver can save and load program binaries """
+        if self._binaries_supported is None:
+            try:
+                formats = gl.glGetIntegerv(gl.GL_NUM_PROGRAM_BINARY_FORMATS)
+                self._binaries_supported = bool(gl.glProgramBinary) and bool(gl.glGetProgramBinary) and int(formats) > 0
+            except Exception:
+                self._binaries_supported = False
+
+            if not self._binaries_supported:
+                print('(W) Warning: program binaries are not supported by the driver, shaders will be compiled every run')
+
+        return self._binaries_supported
+
+    def _path(self, key):
+        # binaries are only valid for the driver that produced them
+        if self._driver is None:
+            driver = b''.join(gl.glGetString(name) or b'' for name in (gl.GL_VENDOR, gl.GL_RENDERER, gl.GL_VERSION))
+            self._driver = hashlib.sha256(driver).hexdigest()[:16]
+        return os.path.join(self.directory, '{}-{}.bin'.format(key, self._driver))
+
+    def load_binary(self, key):
+        """
+        Create a program from a binary saved by a previous run.
+        :return: the linked program, or None if there is no usable binary
+        """
+        if not self.binaries_supported():
+            return None
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        data = np.fromfile(path, dtype=np.uint8)
+        if data.shape[0] <= 4:
+            return None
+        binary_format = int(data[:4].view(np.uint32)[0])
+        binary = data[4:]
+
+        program = gl.glCreateProgram()
+        gl.glProgramBinary(program, binary_format, binary, binary.shape[0])
+
+        # loading fails if the driver has changed since the binary was saved
+        if gl.glGetProgramiv(program, gl.GL_LINK_STATUS) != gl.GL_TRUE:
+            print('(W) Warning: discarding stale program binary {}'.format(path))
+            gl.glDeleteProgram(program)
+            os.remove(path)
+            return None
+
+        self.binary_hits += 1
+        return program
+
+    def prepare_binary(self, program):
+        """ Hint the driver that the binary of the program will be retrieved, call before linking """
+        if self.binaries_supported():
+            gl.glProgramParameteri(program, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, gl.GL_TRUE)
+
+    def save_binary(self, key, program):
+        """ Save the binary of a linked program for the next run """
+        if not self.binaries_supported():
+            return
+
+        length = int(gl.glGetProgramiv(program, gl.GL_PROGRAM_BINARY_LENGTH))
+        if length == 0:
+            return
+
+        binary = np.zeros(length, np.uint8)
+        written = np.zeros(1, np.int32)
+        binary_format = np.zeros(1, np.uint32)
+        gl.glGetProgramBinary(program, length, written, binary_format, binary)
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(key), 'wb') as file:
+            file.write(binary_format.tobytes())
+            file.write(binary[:int(written[0])].tobytes())
+
+
+# programs are shared by every shader object of the application
+program_cache = ProgramCache()
@@ -0,0 +1,416 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+import numpy as np
+
+from coordinate_system import CoordinateSystem
+from occlusion import camera_position
+
+# Potentially visible sets: for each road cell of the city grid, the static items (the tower and road
+# instances of the city's spatial index) that may be seen from some point of the cell at street level.
+# They are baked once per city layout and the renderer then only draws the items of the set of the
+# camera's cell.
+#
+# The sets are conservative, with occluder shrinking: eye points are placed on a grid over the eye
+# volume of the cell, and the towers are shrunk by half the grid spacing. An item hidden from an eye
+# point by the shrunk towers is hidden by the real towers from every point of the volume within half
+# the spacing of it, so an item is left out of a set only when it is hidden from every eye point.
+#
+# From an eye point, an item is hidden when every segment to every point of its box crosses a tower.
+# The box is tested against one tower at a time, and its parts no single tower hides are halved, so
+# that towers next to each other hide it together. Items with parts still not proven hidden after
+# MAX_SPLITS halvings are taken as seen. Towers are taken as solid boxes.
+
+# the eye volume of a cell goes from the ground to this height, the sets are not used above it
+EYE_HEIGHT = 8.0
+# distance between eye points, the towers are shrunk by half of it on their sides and top. They keep
+# their base, which stands on the ground the eye volume starts from
+EYE_SPACING = 4.0
+# times the parts of an item no tower hides are halved before the item is taken as seen
+MAX_SPLITS = 8
+
+
+def cell_volume(cell):
+    '''
+    Returns the (2, 3) box of the eye points of a road cell: the cell, from the ground to EYE_HEIGHT.
+    '''
+    center = CoordinateSystem.get_world_pos(*cell)
+    half = np.array([CoordinateSystem.X_SEP / 2, 0, CoordinateSystem.Y_SEP / 2], dtype=np.float32)
+    return np.array([center - half, center + half + [0, EYE_HEIGHT, 0]], dtype=np.float32)
+
+
+def eye_points(cell):
+    '''
+    Returns the (O, 3) eye points of a road cell, every point of its eye volume is within half of
+    EYE_SPACING of one of them along each axis.
+    '''
+    volume = cell_volume(cell)
+    radius = EYE_SPACING / 2
+    axes = []
+    for lower, upper in zip(volume[0], volume[1]):
+        count = max(int(np.ceil((upper - lower) / EYE_SPACING)), 1)
+        axes.append(np.linspace(lower + radius, upper - radius, count) if upper - lower > EYE_SPACING else np.array([(lower + upper) / 2]))
+    return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3).astype(np.float32)
+
+
+def occluder_boxes(boxes):
+    '''
+    Returns the (K, 2, 3) boxes sight lines are tested against for (K, 2, 3) tower boxes: shrunk by half
+    of EYE_SPACING, except for their base. Towers too thin to shrink are NaN and never hide anything.
+    '''
+    occluders = np.array(boxes, dtype=np.float32)
+    occluders[:, 0, [0, 2]] += EYE_SPACING / 2
+    occluders[:, 1] -= EYE_SPACING / 2
+    occluders[(occluders[:, 0] > occluders[:, 1]).any(axis=1)] = np.nan
+    return occluders
+
+
+def segments_blocked(starts, ends, boxes):
+    '''
+    Returns the (R,) mask of the segments crossing their box, for (R, 3) segment ends and (R, 2, 3)
+    boxes (slab test).
+    '''
+    direction = ends - starts
+    direction = np.where(np.abs(direction) < 1e-9, 1e-9, direction)
+    t0 = (boxes[:, 0] - starts) / direction
+    t1 = (boxes[:, 1] - starts) / direction
+    enter = np.minimum(t0, t1).max(axis=1)
+    leave = np.maximum(t0, t1).min(axis=1)
+    return (enter <= leave) & (leave > 0.0) & (enter < 1.0)
+
+
+def shafts_blocked(sources, targets, occluders):
+    '''
+    Returns the (P,) mask of the pairs of boxes whose every segment, from any point of the source box
+    to any point of the target box, crosses the occluder box of the pair. For (P, 2, 3) boxes, sources
+    may be points.
+
+    A pair is blocked when the occluder spans the boxes along an axis and the points where the
+    segments cross one of its faces are all inside that face. The crossing points are bounded with
+    interval arithmetic, so a pair may be missed but is never reported blocked when it is not.
+    '''
+    blocked = np.zeros(len(sources), dtype=bool)
+    # pairs that do not span a face divide by zero, their results are masked out
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # segments are undirected, each pair is tested from both ends
+        for near, far in ((sources, targets), (targets, sources)):
+            for axis in range(3):
+                # range of the distance along the axis from a point of near to a point of far
+                closest = far[:, 0, axis] - near[:, 1, axis]
+                furthest = far[:, 1, axis] - near[:, 0, axis]
+                for side in range(2):
+                    plane = occluders[:, side, axis]
+                    crossed = (closest > 0) & (near[:, 1, axis] <= plane) & (plane <= far[:, 0, axis])
+                    # range of the segment parameter where the segments reach the plane
+                    first = (plane - near[:, 1, axis]) / furthest
+                    last = np.minimum((plane - near[:, 0, axis]) / closest, 1.0)
+                    for other in range(3):
+                        if other == axis:
+                            continue
+                        lower = np.minimum((1 - first) * near[:, 0, other] + first * far[:, 0, other], (1 - last) * near[:, 0, other] + last * far[:, 0, other])
+                        upper = np.maximum((1 - first) * near[:, 1, other] + first * far[:, 1, other], (1 - last) * near[:, 1, other] + last * far[:, 1, other])
+                        crossed &= (lower >= occluders[:, 0, other]) & (upper <= occluders[:, 1, other])
+                    blocked |= crossed
+    return blocked
+
+
+def halve_boxes(boxes):
+    '''
+    Returns the two halves of each of (P, 2, 3) boxes, cut across their longest side.
+    '''
+    rows = np.arange(len(boxes))
+    axis = np.argmax(boxes[:, 1] - boxes[:, 0], axis=1)
+    middle = boxes[rows, :, axis].mean(axis=1)
+    lower, upper = boxes.copy(), boxes.copy()
+    lower[rows, 1, axis] = middle
+    upper[rows, 0, axis] = middle
+    return lower, upper
+
+
+def seen_from(eye, boxes, occluders, item_occluders, items):
+    '''
+    Returns the mask of the given items not proven hidden from an eye point.
+    :param boxes: (N, 2, 3) boxes of every item
+    :param occluders: (K, 2, 3) boxes sight lines are tested against
+    :param item_occluders: (N,) occluder index of each item, -1 for items that are not occluders
+    :param items: (M,) indices of the items to test
+    '''
+    seen = np.zeros(len(boxes), dtype=bool)
+    # parts of the items, none of which is proven hidden yet
+    targets = np.array(boxes[items], dtype=np.float32)
+    eyes = np.broadcast_to(eye, (len(items), 2, 3))
+
+    for split in range(MAX_SPLITS + 1):
+        if len(items) == 0:
+            break
+
+        # only the occluders overlapping the box around the eye and a part can hide it, never the item itself
+        lower = np.minimum(eye, targets[:, 0])
+        upper = np.maximum(eye, targets[:, 1])
+        candidates = ((occluders[np.newaxis, :, 0] <= upper[:, np.newaxis]) & (occluders[np.newaxis, :, 1] >= lower[:, np.newaxis])).all(axis=2)
+        own = item_occluders[items]
+        candidates[np.flatnonzero(own >= 0), own[own >= 0]] = False
+        parts, blockers = np.nonzero(candidates)
+
+        hidden = np.zeros(len(items), dtype=bool)
+        hidden[parts[shafts_blocked(eyes[parts], targets[parts], occluders[blockers])]] = True
+
+        # a part not hidden whose centre is in sight proves its item seen
+        probe = ~hidden[parts]
+        hit = segments_blocked(np.broadcast_to(eye, (int(np.count_nonzero(probe)), 3)), targets.mean(axis=1)[parts[probe]], occluders[blockers[probe]])
+        clear = ~hidden
+        clear[parts[probe][hit]] = False
+        seen[items[clear]] = True
+
+        if split == MAX_SPLITS:
+            # items with parts still not proven hidden
+            seen[items[~hidden]] = True
+            break
+
+        # the parts not hidden of the items not seen yet are halved
+        keep = ~hidden & ~seen[items]
+        items, targets = items[keep], targets[keep]
+        targets = np.concatenate(halve_boxes(targets))
+        items = np.tile(items, 2)
+        eyes = np.broadcast_to(eye, (len(items), 2, 3))
+    return seen
+
+
+def bake_cell(cell, boxes, occluders, item_occluders):
+    '''
+    Returns the (N,) mask of the items that may be seen from a road cell.
+    :param boxes: (N, 2, 3) boxes of the items
+    :param occluders: (K, 2, 3) boxes sight lines are tested against, from occluder_boxes
+    :param item_occluders: (N,) occluder index of each item, -1 for items that are not occluders
+    '''
+    visible = np.zeros(len(boxes), dtype=bool)
+    for eye in eye_points(cell):
+        remaining = np.flatnonzero(~visible)
+        if len(remaining) == 0:
+            break
+        visible |= seen_from(eye, boxes, occluders, item_occluders, remaining)
+    return visible
+
+
+def _bake_cells(cells, boxes, occluders, item_occluders):
+    # worker process entry point, the sets of a batch of cells as packed bits
+    return np.stack([np.packbits(bake_cell(cell, boxes, occluders, item_occluders)) for cell in cells])
+
+
+class PotentiallyVisibleSets:
+    '''
+    The potentially visible sets of the road cells of one city, baked in a process pool (in the
+    background while the city is drawn without them) and cached on disk, and the culling of the static
+    instances against the set of the camera's cell.
+    '''
+
+    # bump when the visibility test or the layout of the entries changes
+    VERSION = 2
+
+    def __init__(self, directory='.cache/pvs'):
+        """
+        Create empty sets.
+        :param directory: the directory the baked sets are stored in
+        """
+        self.directory = directory
+        self.enabled = True
+        # road cell -> row of the bits, one bit per item of the city's spatial index
+        self.cells = {}
+        self.bits = None
+        self.item_count = 0
+        # id of each static model -> index of its first instance among the items
+        self.model_items = {}
+        # mask of the items seen from the camera's cell, derived again only when the camera moves
+        self._mask = None
+        self._mask_key = None
+        # pool of the bake running, and the number of bakes started, a bake only stores the sets of the last
+        self._executor = None
+        self._generation = 0
+        # instances tested and culled during the current frame
+        self.tested = 0
+        self.culled = 0
+
+    def key(self, seed, boxes, item_occluders):
+        """ Return the key of a city: its seed, the boxes of its items and the visibility settings """
+        h = hashlib.sha256()
+        h.update('v{} seed {} height {} spacing {} splits {}'.format(self.VERSION, seed, EYE_HEIGHT, EYE_SPACING, MAX_SPLITS).encode())
+        h.update(np.ascontiguousarray(boxes, dtype=np.float32).tobytes())
+        h.update(np.ascontiguousarray(item_occluders, dtype=np.int32).tobytes())
+        return h.hexdigest()
+
+    def bake(self, seed, cells, boxes, occluder_mask, workers=None, background=False):
+        """
+        Load the sets of a city from the cache, or bake them in parallel and store them.
+        :param seed: the seed the city was generated with
+        :param cells: the (i, j) road cells
+        :param boxes: (N, 2, 3) boxes of the static items
+        :param occluder_mask: (N,) mask of the items that hide what is behind them (the towers)
+        :param background: bake on a thread and return at once, nothing is culled against the sets until they are stored
+        """
+        boxes = np.asarray(boxes, dtype=np.float32)
+        occluders = occluder_boxes(boxes[occluder_mask])
+        item_occluders = np.full(len(boxes), -1, dtype=np.int64)
+        item_occluders[occluder_mask] = np.arange(len(occluders))
+        cells = [tuple(int(value) for value in cell) for cell in cells]
+
+        # the sets of a previous city no longer apply
+        self.cancel()
+        self.bits = None
+        self._generation += 1
+
+        path = os.path.join(self.directory, self.key(seed, boxes, item_occluders) + '.npz')
+        if os.path.exists(path):
+            with np.load(path) as entry:
+                self.store(entry['cells'], entry['bits'], len(boxes))
+            print('Loaded potentially visible sets of {} cells'.format(len(self.cells)))
+            return
+
+        workers = min(workers or os.cpu_count() or 1, max(len(cells), 1))
+        print('Baking potentially visible sets of {} cells on {} processes'.format(len(cells), workers))
+        # workers are spawned, a forked child would inherit the GL context and the threads of the window
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        args = (self._executor, path, cells, boxes, occluders, item_occluders, self._generation)
+        if background:
+            threading.Thread(target=self._bake, args=args, daemon=True).start()
+        else:
+            self._bake(*args)
+
+    def _bake(self, executor, path, cells, boxes, occluders, item_occluders, generation):
+        start = time.perf_counter()
+        try:
+            # one task per cell, so that a cancelled bake only waits for the cells being baked
+            futures = [executor.submit(_bake_cells, [cell], boxes, occluders, item_occluders) for cell in cells]
+            results = [future.result() for future in futures]
+        except CancelledError:
+            return
+        finally:
+            executor.shutdown(wait=False)
+
+        stored_cells = np.array(cells, dtype=np.int32).reshape(-1, 2)
+        bits = np.concatenate(results) if results else np.zeros((0, (len(boxes) + 7) // 8), dtype=np.uint8)
+        os.makedirs(self.directory, exist_ok=True)
+        np.savez(path, cells=stored_cells, bits=bits)
+
+        if generation == self._generation:
+            self.store(stored_cells, bits, len(boxes))
+            print('Baked potentially visible sets of {} cells in {:.1f} s'.format(len(cells), time.perf_counter() - start))
+
+    def store(self, cells, bits, item_count):
+        """ Use the sets of (C, 2) cells, one row of packed bits per cell over item_count items """
+        self.cells = {tuple(cell): row for row, cell in enumerate(np.asarray(cells).tolist())}
+        self.item_count = item_count
+        self._mask_key = None
+        # set last, models cull against the sets as soon as the bits are there
+        self.bits = bits
+
+    def cancel(self):
+        """ Abandon the bake running, the cells already being baked are finished but not stored """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def set_models(self, models, model_ids):
+        """ Record where the instances of each static model start among the items """
+        for index, model in enumerate(models):
+            self.model_items[id(model)] = int(np.searchsorted(model_ids, index))
+
+    def get_cell(self, position):
+        """ Return the (i, j) cell of a world position """
+        return (int(round(float(position[0]) / CoordinateSystem.X_SEP)), int(round(float(position[2]) / CoordinateSystem.Y_SEP)))
+
+    def get_mask(self, camera):
+        """ Return the mask of the items seen from the camera's cell, or None when no set applies """
+        projection_view = np.array(camera.projection()) @ np.array(camera.view())
+        key = projection_view.tobytes()
+        if key != self._mask_key:
+            self._mask = None
+            eye = camera_position(projection_view)
+            row = self.cells.get(self.get_cell(eye))
+            if row is not None and 0.0 <= eye[1] <= EYE_HEIGHT:
+                self._mask = np.unpackbits(self.bits[row], count=self.item_count).astype(bool)
+            self._mask_key = key
+        return self._mask
+
+    def visible(self, model, camera, instances):
+        """ Return the mask of the given instances of a static model in the set of the camera's cell """
+        start = self.model_items.get(id(model))
+        if not self.enabled or start is None or self.bits is None or camera is None:
+            return np.ones(len(instances), dtype=bool)
+        mask = self.get_mask(camera)
+        if mask is None:
+            return np.ones(len(instances), dtype=bool)
+
+        visible = mask[start + np.asarray(instances)]
+        self.tested += len(visible)
+        self.culled += len(visible) - int(np.count_nonzero(visible))
+        return visible
+
+    def reset_counters(self):
+        """ Return the instances tested and culled during the last frame, then reset them """
+        counters = (self.tested, self.culled)
+        self.tested = 0
+        self.culled = 0
+        return counters
+
+
+# the sets of the city being drawn
+pvs = PotentiallyVisibleSets()
+
+
+if __name__ == "__main__":
+    # Bake a grid city of random tower heights, check the sets against the layout and report the time
+    import time
+    from city_map import CityMap
+
+    city_map = CityMap(5, 5, seed=1)
+    cells = city_map.get_road_cells()
+    rng = np.random.default_rng(city_map.seed)
+
+    boxes, occluder_mask = [], []
+    for i in range(city_map.n):
+        for j in range(city_map.n):
+            center = CoordinateSystem.get_world_pos(i - city_map.n // 2, j - city_map.n // 2)
+            half = np.array([CoordinateSystem.X_SEP / 2, 0, CoordinateSystem.Y_SEP / 2], dtype=np.float32)
+            if city_map.map[i][j] > 0:
+                boxes.append([center - half * 0.8, center + half * 0.8 + [0, rng.uniform(15, 60), 0]])
+                occluder_mask.append(True)
+            else:
+                boxes.append([center - half, center + half + [0, 0.3, 0]])
+                occluder_mask.append(False)
+    boxes = np.array(boxes, dtype=np.float32)
+    occluder_mask = np.array(occluder_mask)
+
+    sets = PotentiallyVisibleSets(directory=os.path.join('.cache', 'pvs_test'))
+    start = time.perf_counter()
+    sets.bake(city_map.seed, cells, boxes, occluder_mask)
+    print(f'baked in {time.perf_counter() - start:.2f} s')
+
+    sizes = np.array([np.unpackbits(row, count=len(boxes)).sum() for row in sets.bits])
+    print(f'{len(cells)} road cells, {len(boxes)} items: {sizes.mean():.0f} visible per cell on average '
+          f'({sizes.mean() / len(boxes):.1%}), {sets.bits.nbytes} bytes of sets')
+
+    # the items of a cell's own position are always in its set
+    for cell, row in list(sets.cells.items())[:20]:
+        mask = np.unpackbits(sets.bits[row], count=len(boxes)).astype(bool)
+        own = (cell[0] + city_map.n // 2) * city_map.n + cell[1] + city_map.n // 2
+        assert mask[own]
+
+    # every item left out must be hidden by the towers, not shrunk, from every point of its cell
+    towers = boxes[occluder_mask]
+    tower_items = np.flatnonzero(occluder_mask)
+    checked = 0
+    for cell, row in list(sets.cells.items())[:40]:
+        volume = cell_volume(cell)
+        for item in np.flatnonzero(~np.unpackbits(sets.bits[row], count=len(boxes)).astype(bool)):
+            starts = rng.uniform(volume[0], volume[1], size=(500, 3))
+            ends = rng.uniform(boxes[item, 0], boxes[item, 1], size=(500, 3))
+            others = towers[tower_items != item]
+            blocked = segments_blocked(np.repeat(starts, len(others), axis=0), np.repeat(ends, len(others), axis=0),
+                                       np.tile(others, (len(starts), 1, 1))).reshape(len(starts), -1).any(axis=1)
+            assert blocked.all(), (cell, item)
+            checked += len(starts)
+    print(f'{checked} sight lines to items left out of the sets, all blocked')
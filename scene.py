@@ -3,6 +3,15 @@ import OpenGL.GL as gl
 from imgui.integrations.glfw import GlfwRenderer
 import imgui
 from camera3d import Camera3d
+from shaders import PhongShader, UniformState
+from ubo import LightUniformBuffer, FrameUniformBuffer
+from gl_state import state_cache
+from lod import lod_selector
+from geometry_arena import geometry_arenas
+from culling import frustum_culler
+from occlusion import occlusion_culler
+from occlusion_query import occlusion_queries
+from pvs import pvs
 
 class Scene():
 
@@ -10,7 +19,7 @@ class Scene():
         imgui.shutdown()
         glfw.terminate()
 
-    def __init__(self, width=800, height=600, title="untitled", FPS=60):
+    def __init__(self, width=800, height=600, title="untitled", FPS=60, max_lights=30, max_spot_lights=3):
         self.window_size = (width, height)
         self.width = width
         self.height = height
@@ -24,9 +33,9 @@ class Scene():
         if not glfw.init():
             raise Exception("Failed to initialize GLFW")
 
-        # set the window hints
+        # set the window hints, 3.3 is the version of the shaders and brings GL_ANY_SAMPLES_PASSED queries
         glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
-        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 2)
+        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
         glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, gl.GL_TRUE)
         glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
 
@@ -47,7 +56,7 @@ class Scene():
         # opengl options
         # Here we start initialising the window from the OpenGL side
         print(self.get_window_framebuffer_size())
-        gl.glViewport(0, 0, int(self.get_window_framebuffer_size()[0]), int(self.get_window_framebuffer_size()[1]))
+        state_cache.set_viewport(0, 0, *self.get_window_framebuffer_size())
 
         # this selects the background color
         gl.glClearColor(0.7, 0.7, 1.0, 1.0)
@@ -57,9 +66,9 @@ class Scene():
         glfw.set_input_mode(self._window, glfw.CURSOR, glfw.CURSOR_DISABLED)
 
         # enable depth test for clean output (see lecture on clipping & visibility for an explanation
-        gl.glEnable(gl.GL_DEPTH_TEST)
+        state_cache.enable(gl.GL_DEPTH_TEST)
 
-        gl.glEnable(gl.GL_BLEND)
+        state_cache.enable(gl.GL_BLEND)
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
         # set the window callbacks
@@ -75,14 +84,48 @@ class Scene():
         self.directional_light = None
         self.camera = Camera3d(width/height, z_far=1000)
         self.delta_time = 0.
+        self.time = 0.
+        # uniform uploads skipped / issued during the last frame
+        self.uniform_hits = 0
+        self.uniform_misses = 0
+        # GL state changes skipped / issued during the last frame
+        self.state_hits = 0
+        self.state_misses = 0
+        # triangles drawn during the last frame, and the triangles the full meshes would have drawn
+        self.lod_triangles = 0
+        self.full_triangles = 0
+        # geometry arena draw calls issued during the last frame, and the meshes they drew
+        self.arena_draw_calls = 0
+        self.arena_draws = 0
+        # model type -> (drawn, culled) instances during the last frame, over every pass
+        self.cull_counters = {}
+        # boxes tested against the occluders and found hidden during the last frame, and the time spent rasterizing them
+        self.occlusion_tested = 0
+        self.occlusion_occluded = 0
+        self.occlusion_time = 0.
+        # occlusion queries issued, objects skipped on their result and conditional draws during the last frame
+        self.queries_issued = 0
+        self.queries_hidden = 0
+        self.queries_conditional = 0
+        # static instances tested against the potentially visible set of the camera's cell and culled during the last frame
+        self.pvs_tested = 0
+        self.pvs_culled = 0
+
+        # camera matrices are computed once per frame and shared by every program
+        self.frame_buffer = FrameUniformBuffer()
+
+        # all lights are uploaded once per frame to a uniform buffer shared by every phong program,
+        # the programs size their light arrays to match (must be set before any shader is created)
+        PhongShader.max_lights = max_lights
+        PhongShader.max_spot_lights = max_spot_lights
+        self.light_buffer = LightUniformBuffer(max_lights, max_spot_lights)
 
     def enable_face_culling(self, cull_face=gl.GL_BACK, front_face=gl.GL_CCW):
-        gl.glEnable(gl.GL_CULL_FACE)
-        gl.glCullFace(cull_face)
-        gl.glFrontFace(front_face)
+        state_cache.enable(gl.GL_CULL_FACE)
+        state_cache.set_cull_face(cull_face, front_face)
 
     def disable_face_culling(self):
-        gl.glDisable(gl.GL_CULL_FACE)
+        state_cache.disable(gl.GL_CULL_FACE)
 
     def key_callback(self, window, key, scancode, action, mods):
         # give imgui callbacks a chance to process the event
@@ -112,15 +155,39 @@ class Scene():
     def scroll_callback(self, window, xoffset, yoffset):
         self.impl.scroll_callback(window, xoffset, yoffset)
 
+    def update(self):
+        '''
+        Advance the scene by one frame, called before the frame's uniform buffers are written.
+        '''
+        pass
+
+    def update_uniform_buffers(self):
+        '''
+        Write the per-frame uniform buffers read by every shader program.
+        '''
+        self.light_buffer.update(self.directional_light, self.lights, self.spot_lights)
+        self.update_frame_uniforms()
+
+    def update_frame_uniforms(self):
+        '''
+        Write the camera matrices for the current camera, also called for each face of an environment map.
+        '''
+        self.frame_buffer.update(self.camera, self.time)
+
     def draw(self, framebuffer=False):
         if not framebuffer:
             # clear the screen
             gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
             # update the camera
+            occlusion_culler.begin_pass(self.camera)
+            occlusion_queries.begin_pass(self.camera)
 
         for model in self.models:
             model.draw()
 
+        occlusion_culler.end_pass()
+        occlusion_queries.end_pass()
+
     def run(self):
         # lock to self.FPS        
         glfw.set_time(0)
@@ -135,6 +202,7 @@ class Scene():
             new_time = glfw.get_time()
             self.delta_time = new_time - time
             time = new_time
+            self.time = time
 
             # set the title
             glfw.set_window_title(self._window, f'{self.title} - FPS: {1/self.delta_time:.2f}')
@@ -147,6 +215,10 @@ class Scene():
             # start the imgui frame
             imgui.new_frame()
 
+            # advance the scene and upload this frame's lights
+            self.update()
+            self.update_uniform_buffers()
+
             # call the draw function
             self.draw()
             # cProfile.runctx('self.draw()', globals(), locals())
@@ -155,9 +227,24 @@ class Scene():
             imgui.render()
             # draw imgui data
             self.impl.render(imgui.get_draw_data())
+            # imgui binds its own program, vertex array and font texture
+            state_cache.invalidate_bindings()
             # swap the buffers
             glfw.swap_buffers(self._window)
 
+            # record the redundant uniform and state change counters of this frame
+            self.uniform_hits, self.uniform_misses = UniformState.reset_counters()
+            self.state_hits, self.state_misses = state_cache.reset_counters()
+            self.lod_triangles, self.full_triangles = lod_selector.reset_counters()
+            self.arena_draw_calls, self.arena_draws = geometry_arenas.reset_counters()
+            self.cull_counters = frustum_culler.reset_counters()
+            self.occlusion_tested, self.occlusion_occluded, self.occlusion_time = occlusion_culler.reset_counters()
+            self.queries_issued, self.queries_hidden, self.queries_conditional = occlusion_queries.reset_counters()
+            self.pvs_tested, self.pvs_culled = pvs.reset_counters()
+
+        # a visibility bake still running would hold up the exit until it finished
+        pvs.cancel()
+
 
     def get_window_framebuffer_size(self):
         return glfw.get_framebuffer_size(self._window)
\ No newline at end of file
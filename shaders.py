@@ -3,6 +3,62 @@ import OpenGL.GL.shaders as shaders
 import numpy as np
 import re
 
+from vbo import BufferType
+from ubo import UNIFORM_BLOCK_BINDINGS
+from gl_state import state_cache
+from program_cache import program_cache
+
+class UniformState:
+    '''
+    Shadow copy of the uniform values currently held by one linked program, used to skip
+    glUniform calls that would not change anything. The class counters accumulate over
+    all programs and are reset by the scene every frame.
+    '''
+
+    # number of glUniform calls skipped / issued since the last reset
+    hits = 0
+    misses = 0
+
+    def __init__(self):
+        self.values = {}
+
+    def changed(self, location, value):
+        '''
+        Records the value about to be sent to a uniform location.
+        :param location: the uniform location in the program
+        :param value: the new value
+        :return: True if the GL call is needed, False if the program already holds the value
+        '''
+        # uniforms optimised out of the program never need a call, and are not counted as skipped
+        if location == -1:
+            return False
+
+        previous = self.values.get(location)
+        if isinstance(value, np.ndarray):
+            if isinstance(previous, np.ndarray) and previous.shape == value.shape and np.array_equal(previous, value):
+                UniformState.hits += 1
+                return False
+            self.values[location] = value.copy()
+        else:
+            if previous is not None and not isinstance(previous, np.ndarray) and previous == value:
+                UniformState.hits += 1
+                return False
+            self.values[location] = value
+
+        UniformState.misses += 1
+        return True
+
+    @classmethod
+    def reset_counters(cls):
+        '''
+        Resets the hit/miss counters and returns their values before the reset.
+        '''
+        counters = (cls.hits, cls.misses)
+        cls.hits = 0
+        cls.misses = 0
+        return counters
+
+
 class Uniform:
     '''
     We create a simple class to handle uniforms, this is not necessary,
@@ -16,18 +72,26 @@ class Uniform:
         self.name = name
         self.value = value
         self.location = -1
+        self.state = None
 
-    def link(self, program):
+    def link(self, program, state=None):
         '''
         This function needs to be called after compiling the GLSL program to fetch the location of the uniform
         in the program from its name
         :param program: the GLSL program where the uniform is used
+        :param state: the shadow state of the program, used to skip redundant uploads
         '''
         self.location = gl.glGetUniformLocation(program=program, name=self.name)
+        self.state = state
 
         # if self.location == -1:
         #     print('(E) Warning, no uniform {}'.format(self.name))
 
+    def _changed(self):
+        if self.state is None:
+            return True
+        return self.state.changed(self.location, self.value)
+
     def bind_matrix(self, M=None, number=1, transpose=True):
         '''
         Call this before rendering to bind the Python matrix to the GLSL uniform mat4.
@@ -38,6 +102,8 @@ class Uniform:
         '''
         if M is not None:
             self.value = M
+        if not self._changed():
+            return
         if self.value.shape[0] == 4 and self.value.shape[1] == 4:
             gl.glUniformMatrix4fv(self.location, number, transpose, self.value)
         elif self.value.shape[0] == 3 and self.value.shape[1] == 3:
@@ -64,24 +130,28 @@ class Uniform:
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
-        gl.glUniform1i(self.location, self.value)
+        if self._changed():
+            gl.glUniform1i(self.location, self.value)
 
     def bind_float(self, value=None):
         if value is not None:
             self.value = value
-        gl.glUniform1f(self.location, self.value)
+        if self._changed():
+            gl.glUniform1f(self.location, self.value)
 
     def bind_vector(self, value=None):
         if value is not None:
             self.value = value
-        if value.shape[0] == 2:
-            gl.glUniform2fv(self.location, 1, value)
-        elif value.shape[0] == 3:
-            gl.glUniform3fv(self.location, 1, value)
-        elif value.shape[0] == 4:
-            gl.glUniform4fv(self.location, 1, value)
+        if not self._changed():
+            return
+        if self.value.shape[0] == 2:
+            gl.glUniform2fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 3:
+            gl.glUniform3fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 4:
+            gl.glUniform4fv(self.location, 1, self.value)
         else:
-            print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(value.shape[0]))
+            print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(self.value.shape[0]))
 
     def set(self, value):
         '''
@@ -95,6 +165,10 @@ class BaseShaderProgram:
     This is the base class for loading and compiling the GLSL shaders.
     '''
 
+    # file contents and fully expanded includes, shared by all programs so that each file is read once
+    _file_cache = {}
+    _include_cache = {}
+
     def __init__(self, name=None, vertex_shader=None, fragment_shader=None):
         '''
         Initialises the shaders
@@ -116,18 +190,25 @@ class BaseShaderProgram:
                 #version 330
 
                 in vec3 position;   // vertex position
-                uniform mat4 PVM; // the Perspective-View-Model matrix is received as a Uniform
+                layout(std140) uniform Frame {
+                    mat4 P;
+                    mat4 V;
+                    mat4 PV;
+                    mat4 V_inv;
+                    vec3 viewPos;
+                    float time;
+                };
+                uniform mat4 M; // the Model matrix is received as a Uniform
 
                 // main function of the shader
                 void main() {
-                    gl_Position = PVM * vec4(position, 1.0f);  // first we transform the position using PVM matrix
+                    gl_Position = PV * M * vec4(position, 1.0f);  // first we transform the position using the PV and M matrices
                 }
             '''
         else:
             print('Load vertex shader from file: {}'.format(vertex_shader))
-            with open(vertex_shader, 'r') as file:
-                self.vertex_shader_source = file.read()
-                
+            self.vertex_shader_source = self.read_file(vertex_shader)
+
             self.vertex_shader_source = self.preprocess(self.vertex_shader_source)
 
         # load the fragment shader GLSL code
@@ -140,16 +221,18 @@ class BaseShaderProgram:
             '''
         else:
             print('Load fragment shader from file: {}'.format(fragment_shader))
-            with open(fragment_shader, 'r') as file:
-                self.fragment_shader_source = file.read()
+            self.fragment_shader_source = self.read_file(fragment_shader)
 
             self.fragment_shader_source = self.preprocess(self.fragment_shader_source)
 
         # in order to simplify extension of the class in the future, we start storing uniforms in a dictionary.
         self.uniforms = {
-            'PVM': Uniform('PVM'),  # project view model matrix
+            'M': Uniform('M'),  # model matrix, the camera matrices are read from the 'Frame' uniform block
         }
 
+        # shadow copy of the uniform values held by the linked program
+        self.uniform_state = UniformState()
+
         self.compiled = False
 
     def preprocess(self, source, version=True, depth=0):
@@ -177,7 +260,9 @@ class BaseShaderProgram:
         if version:
             # Read the version.glsl file and append it to the source code
             # This adds a the glsl verison on top so that it remains consistent between all shaders
-            source = self.read("utils/version.glsl") + source
+            # followed by the program specific defines
+            defines = ''.join('#define {} {}\n'.format(name, value) for name, value in self.get_defines().items())
+            source = self.read("utils/version.glsl") + '\n' + defines + source
 
         # Split the source code into lines
         lines = source.split('\n')
@@ -188,24 +273,42 @@ class BaseShaderProgram:
             if line.strip().startswith('#include'):
                 # Extract the filename from the line
                 filename = re.findall(r'"([^"]*)"', line)[0]
-                try:
-                    # Read the included code from the file
-                    included_code = self.read(filename)
-                except FileNotFoundError:
-                    # Raise an error if the file cannot be found
-                    raise FileNotFoundError(f'(E) Error: Could not find file {filename} in shader {self.name} on line {i}')
-                # preprocess the included code
-                # WARNING: may create infinate loop if circular incldues
-                included_code = self.preprocess(included_code, version=False, depth=depth+1)
+
+                # includes do not depend on the program, so each file is only expanded once
+                included_code = BaseShaderProgram._include_cache.get(filename)
+                if included_code is None:
+                    try:
+                        # Read the included code from the file
+                        included_code = self.read(filename)
+                    except FileNotFoundError:
+                        # Raise an error if the file cannot be found
+                        raise FileNotFoundError(f'(E) Error: Could not find file {filename} in shader {self.name} on line {i}')
+                    # preprocess the included code
+                    # WARNING: may create infinate loop if circular incldues
+                    included_code = self.preprocess(included_code, version=False, depth=depth+1)
+                    BaseShaderProgram._include_cache[filename] = included_code
                 # Replace the line with the included code
                 lines[i] = included_code
 
         # Join the lines back into a single string
         return '\n'.join(lines)
 
+    def get_defines(self):
+        '''
+        Returns the preprocessor defines injected after the version directive of every shader stage
+        '''
+        return {}
+
     def read(self, filename):
-        with open(f"shaders/{filename}", 'r') as file:
-            return file.read()
+        return self.read_file(f"shaders/{filename}")
+
+    def read_file(self, path):
+        source = BaseShaderProgram._file_cache.get(path)
+        if source is None:
+            with open(path, 'r') as file:
+                source = file.read()
+            BaseShaderProgram._file_cache[path] = source
+        return source
 
     def add_uniform(self, name):
         self.uniforms[name] = Uniform(name)
@@ -219,6 +322,40 @@ class BaseShaderProgram:
             # print('(W) Warning: Trying to compile already compiled shader program {}'.format(self.name))
             return
 
+        # programs built from the same sources and attribute bindings are shared, along with their
+        # uniform state since the uniform values belong to the GL program
+        key = program_cache.key(self.vertex_shader_source, self.fragment_shader_source, attributes)
+        cached = program_cache.get(key)
+
+        if cached is not None:
+            self.program, self.uniform_state = cached
+        else:
+            # a binary saved by a previous run skips compilation entirely
+            self.program = program_cache.load_binary(key)
+
+            if self.program is not None:
+                print('Loaded GLSL program binary [{}, program: {}]'.format(self.name, self.program))
+            else:
+                self.link_program(attributes)
+                program_cache.save_binary(key, self.program)
+
+            program_cache.add(key, self.program, self.uniform_state)
+
+        # tell OpenGL to use this shader program for rendering
+        state_cache.use_program(self.program)
+
+        # link all uniforms
+        for uniform in self.uniforms:
+            self.uniforms[uniform].link(self.program, self.uniform_state)
+
+        self.bind_uniform_blocks()
+
+        self.compiled = True
+
+    def link_program(self, attributes):
+        '''
+        Compiles both shaders and links them into a new program
+        '''
         print('Compiling GLSL shaders [{}]...'.format(self.name))
         try:
             self.program = gl.glCreateProgram()
@@ -230,18 +367,19 @@ class BaseShaderProgram:
 
         self.bindAttributes(attributes)
 
+        program_cache.prepare_binary(self.program)
         gl.glLinkProgram(self.program)
 
-        # tell OpenGL to use this shader program for rendering
-        gl.glUseProgram(self.program)
-
         print('... done compiling GLSL shaders [{}, program: {}]'.format(self.name, self.program))
 
-        # link all uniforms
-        for uniform in self.uniforms:
-            self.uniforms[uniform].link(self.program)
-
-        self.compiled = True
+    def bind_uniform_blocks(self):
+        '''
+        Attaches the uniform blocks used by the program to their shared binding points
+        '''
+        for name, binding in UNIFORM_BLOCK_BINDINGS.items():
+            index = gl.glGetUniformBlockIndex(self.program, name)
+            if index != gl.GL_INVALID_INDEX:
+                gl.glUniformBlockBinding(self.program, index, binding)
 
     def bindAttributes(self, attributes):
         # bind all shader attributes to the correct locations in the VAO
@@ -255,13 +393,10 @@ class BaseShaderProgram:
         '''
 
         # tell OpenGL to use this shader program for rendering
-        gl.glUseProgram(self.program)
+        state_cache.use_program(self.program)
 
-        P = model.scene.camera.projection()
-        V = model.scene.camera.view()
-
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        # set the model matrix uniform
+        self.uniforms['M'].bind(np.array(M, 'f'))
 
         self.bind_textures(model)
 
@@ -271,7 +406,7 @@ class BaseShaderProgram:
 
             if texture.uniform not in self.uniforms.keys():
                 self.add_uniform(texture.uniform)
-                self.uniforms[texture.uniform].link(self.program)
+                self.uniforms[texture.uniform].link(self.program, self.uniform_state)
 
             self.uniforms[texture.uniform].bind(unit)
 
@@ -287,12 +422,12 @@ class BaseShaderProgram:
     def bind_material_texture(self, texture, texture_name, has_texture_name, texture_unit):
         if has_texture_name not in self.uniforms.keys():
             self.add_uniform(has_texture_name)
-            self.uniforms[has_texture_name].link(self.program)
+            self.uniforms[has_texture_name].link(self.program, self.uniform_state)
 
         if texture is not None:
             if texture_name not in self.uniforms.keys():
                 self.add_uniform(texture_name)
-                self.uniforms[texture_name].link(self.program)
+                self.uniforms[texture_name].link(self.program, self.uniform_state)
 
             texture.bind(texture_unit)
             self.uniforms[texture_name].bind(texture_unit)
@@ -305,8 +440,14 @@ class BaseShaderProgram:
 
 class PhongShader(BaseShaderProgram):
     '''
-    This is the base class for loading and compiling the GLSL shaders. Handles the lighting and material unifroms.
+    This is the base class for loading and compiling the GLSL shaders. Handles the material unifroms,
+    lights are read from the scene's light uniform buffer.
     '''
+
+    # size of the light arrays in the 'Lights' uniform block, set by the scene to match its light buffer
+    max_lights = 30
+    max_spot_lights = 3
+
     def __init__(self, name='phong'):
         '''
         Initialises the shaders
@@ -315,13 +456,9 @@ class PhongShader(BaseShaderProgram):
         BaseShaderProgram.__init__(self, name=name)
 
         self.uniforms = {}
-        self.max_lights = 30
-        self.max_spot_lights = 3
 
-        # MVP
-        self.add_uniform('PVM')
+        # model matrices, the camera matrices are read from the 'Frame' uniform block
         self.add_uniform('ViT')
-        self.add_uniform('viewPos')
         self.add_uniform('M')
 
         # material
@@ -331,114 +468,25 @@ class PhongShader(BaseShaderProgram):
         self.add_uniform('material.Ks')
         self.add_uniform('material.Ns')
 
-        # directional light
-        self.add_uniform('dir_light.dir')
-        self.add_uniform('dir_light.Ia')
-        self.add_uniform('dir_light.Id')
-        self.add_uniform('dir_light.Is')
-
-        # point light
-        self.add_uniform('light_count')
-        for i in range(self.max_lights):
-            self.add_uniform('lights[{}].position'.format(i))
-            self.add_uniform('lights[{}].Ia'.format(i))
-            self.add_uniform('lights[{}].Id'.format(i))
-            self.add_uniform('lights[{}].Is'.format(i))
-            self.add_uniform('lights[{}].constant'.format(i))
-            self.add_uniform('lights[{}].linear'.format(i))
-            self.add_uniform('lights[{}].quadratic'.format(i))
-            self.add_uniform('lights[{}].intensity'.format(i))
-
-        # spot lights
-        self.add_uniform('spot_light_count')
-        for i in range(self.max_spot_lights):
-            self.add_uniform('spot_lights[{}].position'.format(i))
-            self.add_uniform('spot_lights[{}].direction'.format(i))
-            self.add_uniform('spot_lights[{}].Ia'.format(i))
-            self.add_uniform('spot_lights[{}].Id'.format(i))
-            self.add_uniform('spot_lights[{}].Is'.format(i))
-
-            self.add_uniform('spot_lights[{}].constant'.format(i))
-            self.add_uniform('spot_lights[{}].linear'.format(i))
-            self.add_uniform('spot_lights[{}].quadratic'.format(i))
-            self.add_uniform('spot_lights[{}].intensity'.format(i))
-
-            self.add_uniform('spot_lights[{}].cutoff'.format(i))
-            self.add_uniform('spot_lights[{}].outer_cutoff'.format(i))
-    
     def bind(self, model, M):
         '''
         Call this function to enable this GLSL Program (you can have multiple GLSL programs used during rendering!)
         '''
 
-        P = model.scene.camera.projection()
-        V = model.scene.camera.view()
-
         # tell OpenGL to use this shader program for rendering
-        gl.glUseProgram(self.program)
-
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        state_cache.use_program(self.program)
 
         self.uniforms['M'].bind(M)
 
         # set the Vit matrix uniform
         self.uniforms['ViT'].bind(np.linalg.inv(M)[:3, :3].transpose())
 
-        # set the view position in view space
-        self.uniforms['viewPos'].bind_vector(np.array(model.scene.camera.position(), 'f'))
-
         # bind the textures
         self.bind_textures(model)
 
         # bind material properties
         self.bind_material_uniforms(model.mesh.material)
 
-        # bind the light properties
-        self.bind_light_uniforms(model.scene.directional_light, model.scene.lights, model.scene.spot_lights, V)
-
-    def bind_light_uniforms(self, dir_light, point_lights, spot_lights, V):
-        # bind directional light
-        self.uniforms['dir_light.dir'].bind_vector(np.array(dir_light.direction, 'f'))
-        self.uniforms['dir_light.Ia'].bind_vector(np.array(dir_light.Ia, 'f'))
-        self.uniforms['dir_light.Id'].bind_vector(np.array(dir_light.Id, 'f'))
-        self.uniforms['dir_light.Is'].bind_vector(np.array(dir_light.Is, 'f'))
-
-        # check if we have too many lights
-        if len(point_lights) > self.max_lights:
-            print(f'(E) Warning: Max light count of {self.max_lights} exceeded')
-
-        # bind point lights
-        for index, light in enumerate(point_lights):
-            self.uniforms[f'lights[{index}].position'].bind_vector(np.array(light.position, 'f'))
-            self.uniforms[f'lights[{index}].Ia'].bind_vector(np.array(light.Ia, 'f'))
-            self.uniforms[f'lights[{index}].Id'].bind_vector(np.array(light.Id, 'f'))
-            self.uniforms[f'lights[{index}].Is'].bind_vector(np.array(light.Is, 'f'))
-            self.uniforms[f'lights[{index}].constant'].bind_float(light.constant)
-            self.uniforms[f'lights[{index}].linear'].bind_float(light.linear)
-            self.uniforms[f'lights[{index}].quadratic'].bind_float(light.quadratic)
-            self.uniforms[f'lights[{index}].intensity'].bind_float(light.intensity)
-
-        # bind light count
-        self.uniforms['light_count'].bind_int(len(point_lights))
-
-        # bind spot lights
-        for index, light in enumerate(spot_lights):
-            self.uniforms[f'spot_lights[{index}].position'].bind_vector(np.array(light.position, 'f'))
-            self.uniforms[f'spot_lights[{index}].direction'].bind_vector(np.array(light.direction, 'f'))
-            self.uniforms[f'spot_lights[{index}].Ia'].bind_vector(np.array(light.Ia, 'f'))
-            self.uniforms[f'spot_lights[{index}].Id'].bind_vector(np.array(light.Id, 'f'))
-            self.uniforms[f'spot_lights[{index}].Is'].bind_vector(np.array(light.Is, 'f'))
-            self.uniforms[f'spot_lights[{index}].constant'].bind_float(light.constant)
-            self.uniforms[f'spot_lights[{index}].linear'].bind_float(light.linear)
-            self.uniforms[f'spot_lights[{index}].quadratic'].bind_float(light.quadratic)
-            self.uniforms[f'spot_lights[{index}].intensity'].bind_float(light.intensity)
-            self.uniforms[f'spot_lights[{index}].cutoff'].bind_float(np.cos(np.radians(light.cutoff)))
-            self.uniforms[f'spot_lights[{index}].outer_cutoff'].bind_float(np.cos(np.radians(light.outer_cutoff)))
-
-        # bind light count
-        self.uniforms['spot_light_count'].bind_int(len(spot_lights))
-
     def bind_material_uniforms(self, material):
         self.uniforms['material.Ka'].bind_vector(np.array(material.Ka, 'f'))
         self.uniforms['material.Kd'].bind_vector(np.array(material.Kd, 'f'))
@@ -446,13 +494,16 @@ class PhongShader(BaseShaderProgram):
         self.uniforms['material.Ns'].bind_float(material.Ns)
         self.uniforms['material.alpha'].bind(material.alpha)
 
+    def get_defines(self):
+        return {'MAX_LIGHTS': self.max_lights, 'MAX_SPOT_LIGHTS': self.max_spot_lights}
+
     def add_uniform(self, name):
         if name in self.uniforms:
             print('(W) Warning re-defining already existing uniform %s' % name)
         self.uniforms[name] = Uniform(name)
 
     def unbind(self):
-        gl.glUseProgram(0)
+        state_cache.use_program(0)
 
 class FlatShader(PhongShader):
     def __init__(self):
@@ -478,44 +529,18 @@ class PhongShaderNormalMap(PhongShader):
         PhongShader.__init__(self, name='phong_normal_map')
 
 class PhongShaderInstanced(PhongShader):
+
+    # per-instance attribute read from the model's instance buffer
+    instance_attribute = ('offset', BufferType.FLOAT_3)
+
     def __init__(self, name='phong_instanced'):
         PhongShader.__init__(self, name=name)
-        self.add_uniform("PV")
-        self.add_uniform("V")
-        self.offsets = []
-
-    def add_offset(self, offset):
-        self.add_uniform(f'offsets[{len(self.offsets)}]')
-        self.uniforms[f'offsets[{len(self.offsets)}]'].link(self.program)
-        self.offsets.append(offset)
-        
-    def bind(self, model, M):
-        PhongShader.bind(self, model, M)
 
-        self.uniforms["V"].bind(np.array(model.scene.camera.view(), 'f'))
-        self.uniforms["PV"].bind(np.matmul(model.scene.camera.projection(), model.scene.camera.view()))
 
-        for index, offset in enumerate(self.offsets):
-            self.uniforms[f'offsets[{index}]'].bind_vector(offset)
+class PhongShaderNormalMapInstancedMatrices(PhongShader):
 
+    # per-instance attribute read from the model's instance buffer
+    instance_attribute = ('matrix', BufferType.MATF_4)
 
-class PhongShaderNormalMapInstancedMatrices(PhongShader):
     def __init__(self, name='phong_instanced_normal_map_matricies'):
         PhongShader.__init__(self, name=name)
-        self.add_uniform("PV")
-        self.add_uniform("V")
-        self.matricies = []
-
-    def add_matrix(self, M):
-        self.add_uniform(f'matricies[{len(self.matricies)}]')
-        self.uniforms[f'matricies[{len(self.matricies)}]'].link(self.program)
-        self.matricies.append(M)
-
-    def bind(self, model, M):
-        PhongShader.bind(self, model, M)
-
-        self.uniforms["V"].bind(np.array(model.scene.camera.view(), 'f'))
-        self.uniforms["PV"].bind(np.matmul(model.scene.camera.projection(), model.scene.camera.view()))
-
-        for index, M in enumerate(self.matricies):
-            self.uniforms[f'matricies[{index}]'].bind(np.array(M.matrix, 'f'))
\ No newline at end of file
@@ -3,7 +3,7 @@ in vec3 normal_world_space;     // the normal of the vertex in view coordinates
 
 out vec4 final_color;
 
-uniform vec3 viewPos;
+#include "utils/frame_block.glsl"
 
 uniform samplerCube env_map;
 
@@ -7,7 +7,8 @@ out vec3 fragPos;   // the position of the vertex in view coordinates
 out vec3 normal_world_space;     // the normal of the vertex in view coordinates
 
 
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+#include "utils/frame_block.glsl"
+
 uniform mat4 M;
 
 void main(void)
@@ -15,7 +16,7 @@ void main(void)
     // 1. first, we transform the position using PVM matrix.
     // note that gl_Position is a standard output of the
     // vertex shader.
-    gl_Position = PVM * vec4(position, 1.0f);
+    gl_Position = PV * M * vec4(position, 1.0f);
 
     mat3 MiT = transpose(inverse(mat3(M)));
 
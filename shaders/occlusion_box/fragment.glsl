@@ -0,0 +1,7 @@
+// colour writes are masked while the boxes are drawn, the query only counts the samples passing the depth test
+out vec4 final_color;
+
+void main(void)
+{
+	final_color = vec4(1.0);
+}
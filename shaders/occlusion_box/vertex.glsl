@@ -0,0 +1,11 @@
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// corner of the unit cube
+
+#include "utils/frame_block.glsl"
+
+uniform mat4 M;	// maps the unit cube onto the box being tested
+
+void main(void)
+{
+	gl_Position = PV*M*vec4(position, 1);
+}
@@ -8,22 +8,13 @@ out vec4 final_color;
 
 //=== includes
 #include "utils/material.glsl"
-#include "utils/lights.glsl"
+#include "utils/light_block.glsl"
+#include "utils/frame_block.glsl"
 #include "utils/phong_lighting.glsl"
 
 //=== uniform variables
 uniform Material material; // material properties
 
-uniform PointLight lights[MAX_LIGHTS]; // point lights
-uniform int light_count; // number of point lights
-
-uniform SpotLight spot_lights[MAX_SPOT_LIGHTS]; // spot lights
-uniform int spot_light_count; // number of spot lights
-
-uniform DirLight dir_light; // directional light
-
-uniform vec3 viewPos; // position of the camera in world space
-
 void main() {
     vec3 viewDir = normalize(viewPos - fragPos);
 
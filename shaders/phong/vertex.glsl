@@ -9,14 +9,15 @@ out vec2 fragment_texCoord;  // the texture coordinates of the vertex
 out vec3 normal_world_space; // the normal of the vertex in world space
 
 //=== uniforms
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+#include "utils/frame_block.glsl"
+
 uniform mat4 M;     // the Model matrix is received as a Uniform
 
 void main() {
     // 1. first, we transform the position using PVM matrix.
     // note that gl_Position is a standard output of the
     // vertex shader.
-    gl_Position = PVM * vec4(position, 1.0f);
+    gl_Position = PV * M * vec4(position, 1.0f);
 
     mat3 MiT = transpose(inverse(mat3(M)));
 
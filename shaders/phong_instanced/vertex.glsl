@@ -2,6 +2,7 @@
 in vec3 position;	// the position attribute contains the vertex position
 in vec3 normal;		// store the vertex normal
 in vec2 texCoord;
+in vec3 offset;     // per-instance world offset
 
 //=== out attributes are interpolated on the face, and passed on to the fragment shader
 out vec3 fragPos;            // the position of the vertex in world space
@@ -9,13 +10,11 @@ out vec2 fragment_texCoord;  // the texture coordinates of the vertex
 out vec3 normal_world_space; // the normal of the vertex in world space
 
 //=== uniforms
-uniform mat4 M;
-uniform mat4 PV;
+#include "utils/frame_block.glsl"
 
-uniform vec3 offsets[100];
+uniform mat4 M;
 
 void main() {
-    vec3 offset = offsets[gl_InstanceID];
     // 1. first, we transform the position using PVM matrix.
     // note that gl_Position is a standard output of the
     // vertex shader.
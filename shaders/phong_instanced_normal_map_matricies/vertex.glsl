@@ -3,6 +3,7 @@ in vec3 position;	// the position attribute contains the vertex position
 in vec3 normal;		// store the vertex normal
 in vec2 texCoord;
 in vec3 tangent;
+in mat4 matrix;     // per-instance transform
 
 //=== out attributes are interpolated on the face, and passed on to the fragment shader
 out vec3 fragPos;            // the position of the vertex in world space
@@ -10,16 +11,13 @@ out vec2 fragment_texCoord;  // the texture coordinates of the vertex
 out mat3 TBN;                // the TBN matrix
 
 //=== uniforms
-uniform mat4 M;
-uniform mat4 PV;
+#include "utils/frame_block.glsl"
 
-uniform mat4 matricies[100];
+uniform mat4 M;
 
 #include "utils/tbn.glsl"
 
 void main() {
-    mat4 matrix = matricies[gl_InstanceID];
-
     // 1. first, we transform the position using PVM matrix.
     // note that gl_Position is a standard output of the
     // vertex shader.
@@ -10,7 +10,8 @@ out vec2 fragment_texCoord;  // the texture coordinates of the vertex
 out mat3 TBN;                // the TBN matrix
 
 //=== uniforms
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+#include "utils/frame_block.glsl"
+
 uniform mat4 M;     // the Model matrix
 
 #include "utils/tbn.glsl"
@@ -19,7 +20,7 @@ void main() {
     // 1. first, we transform the position using PVM matrix.
     // note that gl_Position is a standard output of the
     // vertex shader.
-    gl_Position = PVM * vec4(position, 1.0f);
+    gl_Position = PV * M * vec4(position, 1.0f);
 
     // 2. calculate vectors used for shading calculations
     // those will be interpolate before being sent to the
@@ -4,10 +4,13 @@ in vec3 position;	// the position attribute contains the vertex position
 //=== out attributes are interpolated on the face, and passed on to the fragment shader
 out vec3 fragment_texCoord;
 
-uniform mat4 PVM;
+#include "utils/frame_block.glsl"
+
+uniform mat4 M;
 
 void main(void)
 {
-	gl_Position = PVM*vec4(position, 1);
+	// drop the camera translation so the skybox stays centred on the viewer
+	gl_Position = P*mat4(mat3(V))*M*vec4(position, 1);
 	fragment_texCoord = position;
 }
@@ -0,0 +1,19 @@
+/**
+ * @block Frame
+ * @brief Camera constants shared by every program, uploaded once per frame by the scene (see ubo.FrameUniformBuffer).
+ *
+ * @var P The projection matrix.
+ * @var V The view matrix.
+ * @var PV The projection-view matrix.
+ * @var V_inv The inverse of the view matrix.
+ * @var viewPos Position of the camera in world space.
+ * @var time Scene time in seconds.
+ */
+layout(std140) uniform Frame {
+    mat4 P;         // projection matrix
+    mat4 V;         // view matrix
+    mat4 PV;        // projection-view matrix
+    mat4 V_inv;     // inverse view matrix
+    vec3 viewPos;   // position of the camera in world space
+    float time;     // scene time in seconds
+};
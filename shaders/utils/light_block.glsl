@@ -0,0 +1,21 @@
+#include "utils/lights.glsl"
+
+/**
+ * @block Lights
+ * @brief All lights of the scene, uploaded once per frame by the scene (see ubo.LightUniformBuffer).
+ *
+ * The layout is std140 and must match the offsets used in LightUniformBuffer.
+ *
+ * @var light_count Number of point lights in use.
+ * @var spot_light_count Number of spot lights in use.
+ * @var dir_light The directional light.
+ * @var lights The point lights.
+ * @var spot_lights The spot lights.
+ */
+layout(std140) uniform Lights {
+    int light_count;                        // number of point lights
+    int spot_light_count;                   // number of spot lights
+    DirLight dir_light;                     // directional light
+    PointLight lights[MAX_LIGHTS];          // point lights
+    SpotLight spot_lights[MAX_SPOT_LIGHTS]; // spot lights
+};
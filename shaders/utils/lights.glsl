@@ -71,8 +71,11 @@ struct DirLight {
     vec3 Is;   // specular properties of the light source
 };
 
-// max number of point lights
-// #define MAX_LIGHTS 6
+// max number of point lights, normally injected by the shader program (see PhongShader.max_lights)
+#ifndef MAX_LIGHTS
 #define MAX_LIGHTS 30
+#endif
 // max number of spot lights
+#ifndef MAX_SPOT_LIGHTS
 #define MAX_SPOT_LIGHTS 3
+#endif
@@ -1,30 +1,24 @@
 import OpenGL.GL as gl
-import numpy as np
 
-from cube_map import CubeMap
+from texture_cache import texture_cache
 from model import ModelFromMesh
 from mesh import CubeMesh
 from shaders import BaseShaderProgram
+from gl_state import state_cache
 
 class SkyBoxShader(BaseShaderProgram):
+    '''
+    The camera translation is removed from the view matrix in the vertex shader.
+    '''
 
     def __init__(self):
         BaseShaderProgram.__init__(self, 'skybox')
 
-    def bind(self, model, M):
-        BaseShaderProgram.bind(self, model, M)
-        P = model.scene.camera.projection()  # get projection matrix from the scene
-        V = np.array(model.scene.camera.view())  # get view matrix from the camera
-        V = V.reshape((4,4))
-        Vr = np.identity(4)
-        Vr[:3, :3] = V[:3, :3]
-
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(Vr, M)))
-
 class SkyBox(ModelFromMesh):
 
     def __init__(self, scene, name, files=None, extension='jpg'):
-        self.cube_map = CubeMap("skybox_sampler", name=name, files=files, extension=extension)
+        # presets are kept by the texture cache, so switching back to a skybox does not reload its faces
+        self.cube_map = texture_cache.cube_map("skybox_sampler", name=name, files=files, extension=extension)
         ModelFromMesh.__init__(self, 
                                scene,
                                CubeMesh(texture=self.cube_map),
@@ -34,17 +28,21 @@ class SkyBox(ModelFromMesh):
 
         self.M.scale([10, 10, 10])
 
+    def release(self):
+        ModelFromMesh.release(self)
+        texture_cache.release(self.cube_map)
+
     def draw(self):
         # backface culling will not work as they must be viewed from inside
         # store the current state of backface culling
-        culling_enabled = gl.glIsEnabled(gl.GL_CULL_FACE)
+        culling_enabled = state_cache.is_enabled(gl.GL_CULL_FACE)
 
         if culling_enabled:
-            gl.glDisable(gl.GL_CULL_FACE)
+            state_cache.disable(gl.GL_CULL_FACE)
 
-        gl.glDepthMask(gl.GL_FALSE)
+        state_cache.set_depth_mask(False)
         ModelFromMesh.draw(self)
-        gl.glDepthMask(gl.GL_TRUE)
+        state_cache.set_depth_mask(True)
 
         if culling_enabled:
-            gl.glEnable(gl.GL_CULL_FACE)
+            state_cache.enable(gl.GL_CULL_FACE)
@@ -1,7 +1,11 @@
 import OpenGL.GL as gl
 import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
+from gl_state import state_cache
+
 
 class ImageWrapper:
     def __init__(self, name):
@@ -27,6 +31,61 @@ class ImageWrapper:
 
         return np.asarray(self.img, dtype=np.uint8)
 
+
+class ImageDecoder:
+    '''
+    Decodes images on a thread pool so that the files needed by a batch of meshes are decoded
+    concurrently (Pillow releases the GIL while decoding). The GL thread collects the decoded
+    pixel arrays with get and uploads them.
+    '''
+
+    def __init__(self, workers=None):
+        """
+        Create the decoder.
+        :param workers: the number of decoding threads, defaults to the number of CPUs
+        """
+        self._executor = None
+        # (name, format) -> future of the decoded pixel array
+        self._pending = {}
+        self.set_workers(workers)
+
+    def set_workers(self, workers=None):
+        """ Set the number of decoding threads, waits for the images already submitted """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image_decoder')
+
+    @staticmethod
+    def decode(name, format=gl.GL_RGBA):
+        """ Decode textures/<name> to a (height, width, channels) uint8 array """
+        return ImageWrapper(name).data(format)
+
+    def prefetch(self, names, format=gl.GL_RGBA):
+        """
+        Start decoding the given images in the background.
+        :param names: the image paths relative to the textures directory
+        :param format: the format the images are converted to, GL_RGBA or GL_RGB
+        """
+        for name in names:
+            key = (name, format)
+            if key not in self._pending:
+                self._pending[key] = self._executor.submit(self.decode, name, format)
+
+    def get(self, name, format=gl.GL_RGBA):
+        """
+        Return the decoded pixels of an image, waiting for its prefetch or decoding it on the calling
+        thread if it was not prefetched.
+        """
+        future = self._pending.pop((name, format), None)
+        if future is None:
+            return self.decode(name, format)
+        return future.result()
+
+
+# images are decoded by a single pool shared by all textures
+image_decoder = ImageDecoder()
+
 class Texture:
     '''
     Class to handle texture loading.
@@ -47,11 +106,16 @@ class Texture:
         self._bind()
 
         if img is None:
-            img = ImageWrapper(name)
+            # decoded on the image decoder threads if the texture was prefetched
+            data = image_decoder.get(name, format)
+            self.height, self.width = data.shape[:2]
 
             # load the texture in the buffer
-            gl.glTexImage2D(self.target, 0, format, img.width(), img.height(), 0, format, type, img.data(format))
+            gl.glTexImage2D(self.target, 0, format, self.width, self.height, 0, format, type, data)
         else:
+            self.width = img.shape[0]
+            self.height = img.shape[1]
+
             # if a data array is provided use this
             gl.glTexImage2D(self.target, 0, format, img.shape[0], img.shape[1], 0, format, type, img)
 
@@ -95,6 +159,9 @@ class Texture:
             width = data.shape[0]
             height = data.shape[1]
 
+        self.width = width
+        self.height = height
+
         self._bind()
 
         # load the texture in the buffer
@@ -102,15 +169,52 @@ class Texture:
 
         self.unbind()
 
+    def get_size(self):
+        '''
+        Returns the GPU memory used by the texture in bytes (level 0 only, no mipmaps are generated)
+        '''
+        texel_size = {gl.GL_RGB: 3, gl.GL_RGBA: 4}.get(self.format, 4)
+        layers = 6 if self.target == gl.GL_TEXTURE_CUBE_MAP else 1
+        return int(self.width) * int(self.height) * texel_size * layers
+
     def bind(self, unit):
-        gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
-        gl.glBindTexture(self.target, self.textureid)
+        state_cache.bind_texture(self.target, self.textureid, unit)
 
     def unbind(self):
-        gl.glBindTexture(self.target, 0)
+        state_cache.bind_texture(self.target, 0)
 
     def _bind(self):
-        gl.glBindTexture(self.target, self.textureid)
+        state_cache.bind_texture(self.target, self.textureid)
 
     def __del__(self):
+        state_cache.forget_texture(self.textureid)
         gl.glDeleteTextures([self.textureid])
+
+
+if __name__ == "__main__":
+    # Benchmark: wall clock time to decode every texture and skybox face with different pool sizes
+    import time
+
+    names = []
+    for root, _, files in os.walk('./textures'):
+        for file in sorted(files):
+            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
+                names.append(os.path.relpath(os.path.join(root, file), './textures'))
+
+    total_bytes = sum(os.path.getsize(os.path.join('./textures', name)) for name in names)
+    print(f'Decoding {len(names)} images ({total_bytes / 2**20:.1f} MB on disk)')
+
+    results = []
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        decoder = ImageDecoder(workers)
+
+        start = time.perf_counter()
+        decoder.prefetch(names)
+        decoded = sum(decoder.get(name).nbytes for name in names)
+        elapsed = time.perf_counter() - start
+
+        results.append((workers, elapsed, decoded))
+
+    print()
+    for workers, elapsed, decoded in results:
+        print(f'{workers:3d} workers: {elapsed:7.2f} s  ({decoded / 2**20 / elapsed:7.1f} MB/s decoded, {results[0][1] / elapsed:4.2f}x)')
@@ -0,0 +1,156 @@
+import OpenGL.GL as gl
+
+from texture import Texture, image_decoder
+from cube_map import CubeMap
+
+class TextureCache:
+    '''
+    Process wide registry of the textures loaded from disk. Textures are shared between every
+    model that asks for the same file with the same format and sampling parameters, and are
+    reference counted so that unused ones can be purged.
+    '''
+
+    def __init__(self):
+        """ Create an empty cache """
+        # key -> texture, and the number of users of each texture
+        self._textures = {}
+        self._refcounts = {}
+        self._keys = {}
+        # key -> sequence number of the release that left the texture unused, most recent last
+        self._unused = {}
+        self._releases = 0
+        # unused textures kept by swap_done, so that switching back and forth between two skyboxes is free
+        self.max_unused = 2
+
+        self.hits = 0
+        self.misses = 0
+        # bytes decoded from disk and uploaded to the GPU, and bytes that sharing avoided
+        self.decoded_bytes = 0
+        self.bytes_saved = 0
+
+    def texture(self, name, uniform='textureObject', wrap=gl.GL_REPEAT, sample=gl.GL_NEAREST, format=gl.GL_RGBA, type=gl.GL_UNSIGNED_BYTE):
+        """
+        Return the 2D texture loaded from textures/<name>, loading it on first use.
+        The arguments are the same as the Texture constructor.
+        """
+        key = self._texture_key(name, uniform, wrap, sample, format, type)
+        return self._acquire(key, lambda: Texture(name, uniform=uniform, wrap=wrap, sample=sample, format=format, type=type))
+
+    @staticmethod
+    def _texture_key(name, uniform='textureObject', wrap=gl.GL_REPEAT, sample=gl.GL_NEAREST, format=gl.GL_RGBA, type=gl.GL_UNSIGNED_BYTE):
+        return ('2d', name, uniform, format, type, wrap, sample)
+
+    def prefetch(self, meshes):
+        """
+        Start decoding, on the image decoder threads, every texture referenced by a batch of meshes
+        that is not loaded yet. The textures are then created by BaseModel.bind as usual.
+        :param meshes: the meshes about to be bound
+        """
+        names = set()
+        for mesh in meshes:
+            material = mesh.material
+            textures = [material.map_Kd, material.map_Ks, material.map_bump, material.map_Ns]
+            if mesh.textures is not None:
+                textures += list(mesh.textures)
+
+            for texture in textures:
+                if isinstance(texture, str) and self._texture_key(texture) not in self._textures:
+                    names.add(texture)
+
+        image_decoder.prefetch(sorted(names))
+
+    def cube_map(self, name, uniform='textureObject', files=None, wrap=gl.GL_CLAMP_TO_EDGE, sample=gl.GL_LINEAR, format=gl.GL_RGBA, type=gl.GL_UNSIGNED_BYTE, extension='jpg'):
+        """
+        Return the cube map loaded from the textures/<name> directory, loading it on first use.
+        The arguments are the same as the CubeMap constructor.
+        """
+        faces = tuple(sorted(files.items())) if files is not None else extension
+        key = ('cube', name, faces, uniform, format, type, wrap, sample)
+        return self._acquire(key, lambda: CubeMap(uniform, name=name, files=files, wrap=wrap, sample=sample, format=format, type=type, extension=extension))
+
+    def _acquire(self, key, create):
+        texture = self._textures.get(key)
+
+        if texture is None:
+            texture = create()
+            self._textures[key] = texture
+            self._refcounts[key] = 0
+            self._keys[id(texture)] = key
+
+            self.misses += 1
+            self.decoded_bytes += texture.get_size()
+        else:
+            self.hits += 1
+            self.bytes_saved += texture.get_size()
+
+        self._refcounts[key] += 1
+        self._unused.pop(key, None)
+        return texture
+
+    def retain(self, texture):
+        """
+        Add a reference to a texture already returned by the cache.
+        :return: True if the texture is owned by the cache, False otherwise
+        """
+        key = self._keys.get(id(texture))
+        if key is None:
+            return False
+        self._refcounts[key] += 1
+        self._unused.pop(key, None)
+        return True
+
+    def release(self, texture):
+        """
+        Drop one reference to a texture returned by the cache. Textures that are no longer used stay
+        resident (so that e.g. switching back to a skybox is free) until purge is called.
+        """
+        key = self._keys.get(id(texture))
+        if key is None:
+            return
+
+        if self._refcounts[key] == 0:
+            print('(W) Warning: releasing texture {} more times than it was acquired'.format(texture.name))
+            return
+
+        self._refcounts[key] -= 1
+        if self._refcounts[key] == 0:
+            self._releases += 1
+            self._unused[key] = self._releases
+
+    def purge(self, keep=0):
+        """
+        Delete the textures that are no longer referenced, but the keep most recently released.
+        :return: the number of textures deleted
+        """
+        unused = sorted(self._unused, key=self._unused.get)
+        unused = unused[:max(len(unused) - keep, 0)]
+        for key in unused:
+            texture = self._textures.pop(key)
+            del self._refcounts[key]
+            del self._unused[key]
+            del self._keys[id(texture)]
+        return len(unused)
+
+    def swap_done(self):
+        """ Called once a model or skybox was replaced, deletes the unused textures beyond max_unused """
+        deleted = self.purge(keep=self.max_unused)
+        if deleted:
+            print('Deleted {} unused textures'.format(deleted))
+        return deleted
+
+    def get_refcount(self, texture):
+        """ Return the number of users of a texture, 0 for textures not owned by the cache """
+        key = self._keys.get(id(texture))
+        return 0 if key is None else self._refcounts[key]
+
+    def get_texture_count(self):
+        """ Return the number of textures held by the cache """
+        return len(self._textures)
+
+    def get_gpu_bytes(self):
+        """ Return the GPU memory used by the textures held by the cache """
+        return sum(texture.get_size() for texture in self._textures.values())
+
+
+# textures are shared by every model of the application
+texture_cache = TextureCache()
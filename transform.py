@@ -9,8 +9,22 @@ class TransformMatrix():
         """
         Initializes a new instance of the TransformMatrix class.
         """
+        self.version = 0
         self.matrix = glm.mat4(1.0)  # Initialize with an identity matrix
 
+    @property
+    def matrix(self):
+        """
+        The transformation matrix.
+        """
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        # every change bumps the version, so that bounds derived from the matrix know to update
+        self._matrix = matrix
+        self.version += 1
+
     def translate(self, translation):
         """
         Translates the matrix by the specified translation vector.
@@ -119,6 +133,7 @@ class TransformMatrix():
         self.matrix[3][0] = position[0]
         self.matrix[3][1] = position[1]
         self.matrix[3][2] = position[2]
+        self.version += 1
 
     def set_rotation(self, rotation):
         """
@@ -164,6 +179,7 @@ class TransformMatrix():
         self.matrix[0][0] = scale[0]
         self.matrix[1][1] = scale[1]
         self.matrix[2][2] = scale[2]
+        self.version += 1
 
     def get_transform(self):
         """
@@ -0,0 +1,169 @@
+import OpenGL.GL as gl
+import numpy as np
+
+# binding points shared by every shader program, see BaseShaderProgram.bind_uniform_blocks
+UNIFORM_BLOCK_BINDINGS = {
+    'Frame': 0,
+    'Lights': 1,
+}
+
+class UniformBuffer:
+
+    def __init__(self, size, binding):
+        """ Create a uniform buffer of the given size in bytes and attach it to a binding point """
+        self._UBO = gl.glGenBuffers(1)
+        self._size = size
+        self._binding = binding
+
+        self.bind()
+        gl.glBufferData(gl.GL_UNIFORM_BUFFER, size, None, gl.GL_DYNAMIC_DRAW)
+        self.unbind()
+
+        gl.glBindBufferBase(gl.GL_UNIFORM_BUFFER, binding, self._UBO)
+
+    def __del__(self):
+        """ Delete the uniform buffer """
+        gl.glDeleteBuffers(1, [self._UBO])
+
+    def update(self, data):
+        """ Update the uniform buffer with the given data """
+        self.bind()
+        gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, 0, data.nbytes, data)
+        self.unbind()
+
+    def bind(self):
+        """ Bind the uniform buffer """
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self._UBO)
+
+    def unbind(self):
+        """ Unbind the uniform buffer """
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+
+    def get_size(self):
+        """ Return the size of the uniform buffer in bytes """
+        return self._size
+
+    def get_binding(self):
+        """ Return the binding point of the uniform buffer """
+        return self._binding
+
+
+class FrameUniformBuffer(UniformBuffer):
+    '''
+    Holds the per-frame camera constants in the std140 'Frame' block declared in utils/frame_block.glsl.
+    '''
+
+    def __init__(self):
+        """ Create the frame buffer: P, V, PV and inverse V followed by the camera position and time """
+        self._data = np.zeros(4 * 16 + 4, 'f')
+        UniformBuffer.__init__(self, self._data.nbytes, UNIFORM_BLOCK_BINDINGS['Frame'])
+
+    def update(self, camera, time=0.0):
+        """
+        Compute the camera matrices once and upload them, called once per frame (and once per
+        environment map face).
+        :param camera: the camera the frame is rendered from
+        :param time: the scene time in seconds
+        """
+        P = np.array(camera.projection(), 'f')
+        V = np.array(camera.view(), 'f')
+        PV = np.matmul(P, V)
+
+        # GLSL matrices are column major, so the transposes are stored
+        data = self._data
+        data[0:16] = P.T.flatten()
+        data[16:32] = V.T.flatten()
+        data[32:48] = PV.T.flatten()
+        data[48:64] = np.linalg.inv(V).T.flatten()
+        data[64:67] = np.array(camera.position(), 'f')
+        data[67] = time
+
+        UniformBuffer.update(self, data)
+
+
+class LightUniformBuffer(UniformBuffer):
+    '''
+    Holds every light of the scene in the std140 'Lights' block declared in utils/light_block.glsl.
+    All offsets below are in floats.
+    '''
+
+    # header: light_count, spot_light_count, padding, then the directional light
+    DIR_LIGHT_OFFSET = 4
+    DIR_LIGHT_SIZE = 16
+    # struct sizes are rounded up to a multiple of vec4 by std140
+    POINT_LIGHT_SIZE = 20
+    SPOT_LIGHT_SIZE = 28
+
+    def __init__(self, max_lights=30, max_spot_lights=3):
+        """
+        Create the light buffer.
+        :param max_lights: the number of point lights the buffer has room for
+        :param max_spot_lights: the number of spot lights the buffer has room for
+        """
+        self.max_lights = max_lights
+        self.max_spot_lights = max_spot_lights
+
+        self._point_lights_offset = self.DIR_LIGHT_OFFSET + self.DIR_LIGHT_SIZE
+        self._spot_lights_offset = self._point_lights_offset + max_lights * self.POINT_LIGHT_SIZE
+        self._data = np.zeros(self._spot_lights_offset + max_spot_lights * self.SPOT_LIGHT_SIZE, 'f')
+
+        UniformBuffer.__init__(self, self._data.nbytes, UNIFORM_BLOCK_BINDINGS['Lights'])
+
+    def update(self, dir_light, point_lights, spot_lights):
+        """
+        Pack the scene lights into the buffer and upload them, called once per frame.
+        :param dir_light: the directional light of the scene
+        :param point_lights: the list of point lights
+        :param spot_lights: the list of spot lights
+        """
+        if len(point_lights) > self.max_lights:
+            print(f'(E) Warning: Max light count of {self.max_lights} exceeded')
+            point_lights = point_lights[:self.max_lights]
+
+        if len(spot_lights) > self.max_spot_lights:
+            print(f'(E) Warning: Max spot light count of {self.max_spot_lights} exceeded')
+            spot_lights = spot_lights[:self.max_spot_lights]
+
+        data = self._data
+        counts = data[:2].view(np.int32)
+        counts[0] = len(point_lights)
+        counts[1] = len(spot_lights)
+
+        d = self.DIR_LIGHT_OFFSET
+        if dir_light is not None:
+            data[d:d + 3] = self._vec3(dir_light.direction)
+            data[d + 4:d + 7] = self._vec3(dir_light.Ia)
+            data[d + 8:d + 11] = self._vec3(dir_light.Id)
+            data[d + 12:d + 15] = self._vec3(dir_light.Is)
+
+        for index, light in enumerate(point_lights):
+            o = self._point_lights_offset + index * self.POINT_LIGHT_SIZE
+            data[o:o + 3] = self._vec3(light.position)
+            data[o + 4:o + 7] = self._vec3(light.Ia)
+            data[o + 8:o + 11] = self._vec3(light.Id)
+            data[o + 12:o + 15] = self._vec3(light.Is)
+            # a float following a vec3 is packed into its fourth component
+            data[o + 15] = light.constant
+            data[o + 16] = light.linear
+            data[o + 17] = light.quadratic
+            data[o + 18] = light.intensity
+
+        for index, light in enumerate(spot_lights):
+            o = self._spot_lights_offset + index * self.SPOT_LIGHT_SIZE
+            data[o:o + 3] = self._vec3(light.position)
+            data[o + 4:o + 7] = self._vec3(light.direction)
+            data[o + 8:o + 11] = self._vec3(light.Ia)
+            data[o + 12:o + 15] = self._vec3(light.Id)
+            data[o + 16:o + 19] = self._vec3(light.Is)
+            data[o + 19] = light.constant
+            data[o + 20] = light.linear
+            data[o + 21] = light.quadratic
+            data[o + 22] = light.intensity
+            data[o + 23] = np.cos(np.radians(light.cutoff))
+            data[o + 24] = np.cos(np.radians(light.outer_cutoff))
+
+        UniformBuffer.update(self, data)
+
+    @staticmethod
+    def _vec3(value):
+        return np.asarray(value, dtype=np.float32).reshape(-1)[:3]
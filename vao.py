@@ -2,6 +2,8 @@ import OpenGL.GL as gl
 import ctypes
 import numpy as np
 
+from gl_state import state_cache
+
 class VertexArray:
 
     def __init__(self):
@@ -11,25 +13,59 @@ class VertexArray:
         self._IBO = None
         self._index_count = 0
 
-    def add_vertex_buffer(self, buffer):
-        """ Add a vertex buffer to the vertex array """
+    def add_vertex_buffer(self, buffer, location=None):
+        """ Add a vertex buffer to the vertex array, optionally starting at a fixed attribute location """
+        self.bind()
+        buffer.bind()
+
+        if location is not None:
+            self._index_count = max(self._index_count, location)
+
+        self._index_count = self._set_attribute_pointers(buffer, self._index_count)
+        self._VBOs.append(buffer)
+
+    def set_vertex_buffer_offset(self, buffer, location, offset):
+        """
+        Point the attributes of a buffer already added at the given location to a byte offset into it,
+        used to draw a range of instances of an instance buffer
+        """
         self.bind()
         buffer.bind()
+        self._set_attribute_pointers(buffer, location, offset)
 
+    def replace_vertex_buffer(self, old, new, location):
+        """ Point the attributes of a buffer already added at the given location to another buffer with the same layout """
+        self.bind()
+        new.bind()
+        self._set_attribute_pointers(new, location)
+        self._VBOs[self._VBOs.index(old)] = new
+
+    def _set_attribute_pointers(self, buffer, location, offset=0):
+        """ Set the attribute pointers of a bound buffer from the given location, return the next free location """
         layout = buffer.get_layout()
         for element in layout.get_elements():
-            gl.glEnableVertexAttribArray(self._index_count)
-            gl.glVertexAttribPointer(self._index_count,
-                                     element.get_count(),
-                                     gl.GL_FLOAT,
-                                     gl.GL_TRUE if element.get_normalized()
-                                     else gl.GL_FALSE,
-                                     layout.get_stride(),
-                                     ctypes.c_void_p(element.get_offset()))
-            gl.glVertexAttribDivisor(self._index_count,
-                                     element.get_vertex_divisor())
-            self._index_count += 1
-        self._VBOs.append(buffer)
+            # matrix elements are split into one attribute per column
+            for column in range(element.get_columns()):
+                pointer = ctypes.c_void_p(offset + element.get_offset() + column * element.get_column_size())
+                gl.glEnableVertexAttribArray(location)
+                if element.is_integer():
+                    gl.glVertexAttribIPointer(location,
+                                              element.get_count(),
+                                              element.get_gl_type(),
+                                              layout.get_stride(),
+                                              pointer)
+                else:
+                    gl.glVertexAttribPointer(location,
+                                             element.get_count(),
+                                             element.get_gl_type(),
+                                             gl.GL_TRUE if element.get_normalized()
+                                             else gl.GL_FALSE,
+                                             layout.get_stride(),
+                                             pointer)
+                gl.glVertexAttribDivisor(location,
+                                         element.get_vertex_divisor())
+                location += 1
+        return location
 
     def set_index_buffer(self, buffer):
         """ Set the index buffer of the vertex array """
@@ -51,14 +87,15 @@ class VertexArray:
 
     def bind(self):
         """ Bind the vertex array """
-        gl.glBindVertexArray(self._VAO)
+        state_cache.bind_vertex_array(self._VAO)
 
     def unbind(self):
         """ Unbind the vertex array """
-        gl.glBindVertexArray(0)
+        state_cache.bind_vertex_array(0)
 
     def __del__(self):
         """ Delete the vertex array """
+        state_cache.forget_vertex_array(self._VAO)
         gl.glDeleteVertexArrays(1, [self._VAO])
 
     def get_vertex_count(self):
@@ -1,4 +1,5 @@
 import OpenGL.GL as gl
+import numpy as np
 from enum import Enum
 
 class BufferType(Enum):
@@ -13,6 +14,10 @@ class BufferType(Enum):
     BOOL_1 = 8
     MATF_3 = 9
     MATF_4 = 10
+    # compact types: two half floats, four packed 10/10/10/2 bit signed integers and four unsigned shorts
+    HALF_2 = 11
+    INT_2_10_10_10_REV = 12
+    USHORT_4 = 13
 
 class BufferElement:
 
@@ -25,6 +30,8 @@ class BufferElement:
         self._normalized = normalized
         self._vertex_divisor = vertex_divisor
         self._offset = 0
+        self._columns = 1
+        self._gl_type = gl.GL_FLOAT
 
         if type == BufferType.FLOAT_1:
             self._count = 1
@@ -41,24 +48,45 @@ class BufferElement:
         elif type == BufferType.INT_1:
             self._count = 1
             self._size = 4
+            self._gl_type = gl.GL_INT
         elif type == BufferType.INT_2:
             self._count = 2
             self._size = 4 * 2
+            self._gl_type = gl.GL_INT
         elif type == BufferType.INT_3:
             self._count = 3
             self._size = 4 * 3
+            self._gl_type = gl.GL_INT
         elif type == BufferType.INT_4:
             self._count = 4
             self._size = 4 * 4
+            self._gl_type = gl.GL_INT
         elif type == BufferType.BOOL_1:
             self._count = 1
             self._size = 1
+            self._gl_type = gl.GL_UNSIGNED_BYTE
         elif type == BufferType.MATF_3:
-            self._count = 1
+            # matrices take one attribute location per column
+            self._count = 3
+            self._columns = 3
             self._size = 36
         elif type == BufferType.MATF_4:
-            self._count = 1
+            self._count = 4
+            self._columns = 4
             self._size = 64
+        elif type == BufferType.HALF_2:
+            self._count = 2
+            self._size = 2 * 2
+            self._gl_type = gl.GL_HALF_FLOAT
+        elif type == BufferType.INT_2_10_10_10_REV:
+            # packed types are read as floats, normalized to [-1, 1] when the element is normalized
+            self._count = 4
+            self._size = 4
+            self._gl_type = gl.GL_INT_2_10_10_10_REV
+        elif type == BufferType.USHORT_4:
+            self._count = 4
+            self._size = 2 * 4
+            self._gl_type = gl.GL_UNSIGNED_SHORT
 
     def get_type(self):
         """ Return the type of the buffer element """
@@ -68,6 +96,22 @@ class BufferElement:
         """ Return the count of the buffer element """
         return self._count
 
+    def get_columns(self):
+        """ Return the number of attribute locations the buffer element takes up """
+        return self._columns
+
+    def get_column_size(self):
+        """ Return the size of a single column of the buffer element """
+        return self._size // self._columns
+
+    def get_gl_type(self):
+        """ Return the OpenGL type of the components of the buffer element """
+        return self._gl_type
+
+    def is_integer(self):
+        """ Return whether the buffer element is read by the shader as integers rather than floats """
+        return self._type in (BufferType.INT_1, BufferType.INT_2, BufferType.INT_3, BufferType.INT_4, BufferType.BOOL_1)
+
     def get_normalized(self):
         """ Return whether the buffer element is normalized """
         return self._normalized
@@ -135,7 +179,7 @@ class VertexBuffer:
 
         total_count = 0
         for elem in layout.get_elements():
-            total_count += elem.get_count()
+            total_count += elem.get_count() * elem.get_columns()
 
         self._layout_count = total_count
 
@@ -158,6 +202,12 @@ class VertexBuffer:
         gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, data.nbytes, data.flatten())
         self.unbind()
 
+    def write(self, offset, data):
+        """ Write data at a byte offset into the buffer, leaving the rest untouched """
+        self.bind()
+        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, offset, data.nbytes, np.ascontiguousarray(data))
+        self.unbind()
+
     def bind(self):
         """ Bind the vertex buffer """
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self._VBO)
@@ -169,3 +219,116 @@ class VertexBuffer:
     def get_vertex_count(self):
         """ Return the vertex count of the vertex buffer """
         return self._data_size // self._layout_count
+
+
+
+class InstanceBuffer(VertexBuffer):
+
+    def __init__(self, type: BufferType, capacity=1):
+        """ Create a per-instance vertex buffer with room for capacity instances """
+        self._element_size = BufferElement(type).get_size()
+        self._capacity = max(capacity, 1)
+        self._instance_count = 0
+
+        VertexBuffer.__init__(self, buffer_size=self._capacity * self._element_size)
+        self.set_layout(BufferLayout([
+            BufferElement(type, vertex_divisor=1)
+        ]))
+
+    def set_data(self, data):
+        """ Upload the instance data, one row per instance, growing the buffer if needed """
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        self._instance_count = len(data)
+
+        self.bind()
+        if self._instance_count > self._capacity:
+            # reallocating keeps the buffer name, so VAOs pointing at it stay valid
+            while self._capacity < self._instance_count:
+                self._capacity *= 2
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, self._capacity * self._element_size,
+                            None, gl.GL_DYNAMIC_DRAW)
+
+        if self._instance_count > 0:
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, data.nbytes, data)
+        self.unbind()
+
+    def get_instance_count(self):
+        """ Return the number of instances currently stored in the buffer """
+        return self._instance_count
+
+    def get_capacity(self):
+        """ Return the number of instances the buffer can hold without growing """
+        return self._capacity
+
+
+def attribute_bytes(data, element, count):
+    """
+    Return the (count, element size) bytes of one attribute, to be written in the element's columns of an interleaved buffer.
+    :raises ValueError: when the data does not have the element's size per vertex
+    """
+    rows = np.ascontiguousarray(data).reshape(count, -1)
+    if rows.nbytes != count * element.get_size():
+        raise ValueError('(E) Error: attribute data of {} bytes per vertex does not match its {} byte element'.format(
+            rows.nbytes // max(count, 1), element.get_size()))
+    return rows.view(np.uint8).reshape(count, element.get_size())
+
+
+class InterleavedBuffer(VertexBuffer):
+
+    def __init__(self, streams):
+        """
+        Create one vertex buffer holding several attributes, interleaved vertex by vertex.
+        :param streams: a list of (name, data, BufferElement), every data array having one row per vertex
+        """
+        self._names = [name for name, _, _ in streams]
+        layout = BufferLayout([element for _, _, element in streams])
+        self._count = len(streams[0][1]) if streams else 0
+
+        # CPU copy of the buffer, compared against by update_attributes to find the rows that changed
+        self._data = np.zeros((self._count, layout.get_stride()), dtype=np.uint8)
+        for name, data, element in streams:
+            self._data[:, self._columns(element)] = self._bytes(data, element)
+
+        VertexBuffer.__init__(self, self._data)
+        self.set_layout(layout)
+
+    def _columns(self, element):
+        return slice(element.get_offset(), element.get_offset() + element.get_size())
+
+    def _bytes(self, data, element):
+        return attribute_bytes(data, element, self._count)
+
+    def get_names(self):
+        """ Return the attribute names, in the order of the layout elements """
+        return self._names
+
+    def update_attributes(self, attributes):
+        """
+        Rewrite the given attributes, only the range of vertices that actually changed is uploaded.
+        :param attributes: a dict of attribute name -> data, attributes that are missing or None are kept
+        :return: the number of bytes uploaded
+        """
+        elements = dict(zip(self._names, self._layout.get_elements()))
+        changed = np.zeros(self._count, dtype=bool)
+
+        for name, data in attributes.items():
+            if data is None or name not in elements:
+                continue
+            columns = self._columns(elements[name])
+            new = self._bytes(data, elements[name])
+            rows = (self._data[:, columns] != new).any(axis=1)
+            if rows.any():
+                self._data[rows, columns] = new[rows]
+                changed |= rows
+
+        if not changed.any():
+            return 0
+
+        # one upload over the span of changed vertices, whose rows are contiguous in the buffer
+        rows = np.flatnonzero(changed)
+        first, last = rows[0], rows[-1] + 1
+        self.bind()
+        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, first * self._data.shape[1], (last - first) * self._data.shape[1], self._data[first:last])
+        self.unbind()
+
+        return (last - first) * self._data.shape[1]
@@ -0,0 +1,176 @@
+import numpy as np
+
+from vbo import BufferType
+import mesh_kernels
+
+# Compact vertex layout: positions quantized to 16 bits against the mesh bounding box, normals and
+# tangents packed into GL_INT_2_10_10_10_REV and texture coordinates stored as half floats, 40 bytes
+# of float streams per vertex (without bitangents) down to 16.
+#
+# The positions are decoded by the model matrix: the shaders transform normals and tangents with the
+# inverse transpose of M, so folding the decode scale into M is undone by storing them pre-scaled.
+
+# texture coordinates past this are kept as floats, half floats lose a texel of a 1024 texture beyond it
+MAX_HALF_TEXCOORD = 2.0
+
+
+def pack_2_10_10_10(vectors, w=None):
+    '''
+    Packs (N, 3) vectors in [-1, 1] into signed normalized 10/10/10/2 bit integers, x in the low bits.
+    :param w: (optional) (N,) values of -1, 0 or 1 stored in the top two bits
+    :return: (N,) uint32 array
+    '''
+    vectors = np.clip(np.asarray(vectors, dtype=np.float32), -1.0, 1.0)
+    components = np.round(vectors * 511.0).astype(np.int32) & 0x3FF
+    packed = components[:, 0] | (components[:, 1] << 10) | (components[:, 2] << 20)
+    if w is not None:
+        packed |= (np.round(np.asarray(w)).astype(np.int32) & 0x3) << 30
+    return packed.astype(np.uint32)
+
+
+def unpack_2_10_10_10(packed):
+    '''
+    Returns the (N, 4) float vectors of packed 10/10/10/2 bit integers, as the GPU reads them.
+    '''
+    packed = np.asarray(packed, dtype=np.uint32).astype(np.int64)
+    x, y, z, w = packed & 0x3FF, (packed >> 10) & 0x3FF, (packed >> 20) & 0x3FF, (packed >> 30) & 0x3
+    xyz = np.stack([x, y, z], axis=1)
+    xyz = np.where(xyz >= 512, xyz - 1024, xyz)
+    w = np.where(w >= 2, w - 4, w)
+    return np.maximum(np.concatenate([xyz, w[:, np.newaxis]], axis=1) / np.array([511.0, 511.0, 511.0, 1.0]), -1.0).astype(np.float32)
+
+
+def quantize_positions(vertices):
+    '''
+    Quantizes positions to 16 bit unsigned normalized integers over their bounding box.
+    :return: (N, 4) uint16 positions (w unused) and the 4x4 matrix that decodes them to the original space
+    '''
+    vertices = np.asarray(vertices, dtype=np.float32)
+    lower = vertices.min(axis=0)
+    extent = vertices.max(axis=0) - lower
+    # flat meshes keep a unit scale on their flat axis so that the decode matrix stays invertible
+    extent = np.where(extent > 0.0, extent, 1.0)
+
+    quantized = np.zeros((len(vertices), 4), dtype=np.uint16)
+    quantized[:, :3] = np.round((vertices - lower) / extent * 65535.0)
+
+    decode = np.eye(4, dtype=np.float32)
+    decode[:3, :3] = np.diag(extent)
+    decode[:3, 3] = lower
+    return quantized, decode
+
+
+def compact_streams(mesh):
+    '''
+    Builds the compact vertex streams of a mesh.
+    :return: a dict of attribute name -> (data, BufferType, normalized), and the 4x4 matrix that
+             decodes the positions, to be applied after the model matrix
+    '''
+    positions, decode = quantize_positions(mesh.vertices)
+    scale = np.diag(decode)[:3]
+    streams = {'position': (positions, BufferType.USHORT_4, True)}
+
+    if mesh.normals is not None:
+        normals = mesh_kernels.normalize(mesh.normals * scale)
+        streams['normal'] = (pack_2_10_10_10(normals), BufferType.INT_2_10_10_10_REV, True)
+
+    if mesh.tangents is not None:
+        # handedness of the tangent frame in w, the bitangent is rebuilt as cross(normal, tangent)
+        handedness = getattr(mesh, 'handedness', None)
+        if handedness is None and mesh.bitangents is not None and mesh.normals is not None:
+            handedness = np.where(np.einsum('ij,ij->i', np.cross(mesh.normals, mesh.tangents), mesh.bitangents) < 0.0, -1.0, 1.0)
+        tangents = mesh_kernels.normalize(mesh.tangents * scale)
+        streams['tangent'] = (pack_2_10_10_10(tangents, handedness), BufferType.INT_2_10_10_10_REV, True)
+
+    if mesh.textureCoords is not None:
+        texture_coordinates = np.asarray(mesh.textureCoords, dtype=np.float32)
+        if np.abs(texture_coordinates).max(initial=0.0) <= MAX_HALF_TEXCOORD:
+            streams['texCoord'] = (texture_coordinates.astype(np.float16), BufferType.HALF_2, False)
+        else:
+            streams['texCoord'] = (texture_coordinates, BufferType.FLOAT_2, False)
+
+    if mesh.colors is not None:
+        streams['color'] = (np.asarray(mesh.colors, dtype=np.float32), BufferType.FLOAT_3 if mesh.colors.shape[1] == 3 else BufferType.FLOAT_4, False)
+
+    return streams, decode
+
+
+def float_buffer_type(width):
+    '''
+    Returns the float buffer type of an attribute with the given number of components.
+    '''
+    return {1: BufferType.FLOAT_1, 2: BufferType.FLOAT_2, 3: BufferType.FLOAT_3, 4: BufferType.FLOAT_4}.get(width, BufferType.FLOAT_3)
+
+
+def index_dtype(vertex_count):
+    '''
+    Returns the narrowest index type that addresses the given number of vertices.
+    '''
+    return np.uint16 if vertex_count < 65536 else np.uint32
+
+
+if __name__ == "__main__":
+    # Compare separate and interleaved vertex buffers, and the geometry arenas, across the city scene:
+    # each layout is run in its own process, with the same frames, and reports its buffers, frame time
+    # and update() time
+    import subprocess
+    import sys
+    import time
+
+    FRAMES = 300
+
+    if len(sys.argv) < 2:
+        for layout in ['separate', 'interleaved', 'arena']:
+            subprocess.run([sys.executable, __file__, layout], check=True)
+        sys.exit()
+
+    import glfw
+    import imgui
+    import OpenGL.GL as gl
+    from model import BaseModel, CompModel, ModelFromObj
+    from city import City
+
+    BaseModel.INTERLEAVED = sys.argv[1] == 'interleaved'
+    # the obj models draw from the arenas by default, which would leave them out of the separate and interleaved runs
+    ModelFromObj.ARENA = sys.argv[1] == 'arena'
+    city = City()
+
+    def leaves(models):
+        for model in models:
+            if isinstance(model, CompModel):
+                yield from leaves(model.components)
+            elif isinstance(model, BaseModel) and model.mesh is not None:
+                yield model
+
+    models = list(leaves(city.models))
+    buffers = {id(vbo): vbo for model in models for name, vbo in model.vbos.items()}
+    vertex_bytes = sum(buffer.get_layout().get_stride() * buffer._data_size for buffer in buffers.values())
+    # models drawn from an arena share its vertex buffer
+    arenas = {id(model.allocation.arena): model.allocation.arena for model in models if model.allocation is not None}
+    buffers.update({id(arena.vbo): arena.vbo for arena in arenas.values()})
+    vertex_bytes += sum(arena.vertices.used * arena.stride for arena in arenas.values())
+
+    frame_times = []
+    for _ in range(FRAMES):
+        start = time.perf_counter()
+        glfw.poll_events()
+        imgui.new_frame()
+        city.update()
+        city.update_uniform_buffers()
+        city.draw()
+        imgui.render()
+        gl.glFinish()
+        frame_times.append(time.perf_counter() - start)
+        glfw.swap_buffers(city._window)
+
+    start = time.perf_counter()
+    for model in models:
+        model.update()
+    gl.glFinish()
+    update_time = time.perf_counter() - start
+
+    frame_times = np.sort(frame_times[FRAMES // 10:])
+    print(f'{sys.argv[1]}: {len(buffers)} vertex buffers ({vertex_bytes / 1e6:.2f} MB) for {len(models)} models, '
+          f'frame {frame_times.mean() * 1000:.2f} ms (median {np.median(frame_times) * 1000:.2f} ms), '
+          f'update() of every model {update_time * 1000:.1f} ms')
+    glfw.terminate()